@@ -0,0 +1,287 @@
+"""A local stand-in for the parts of a ServiceNow instance sparky talks to, for benchmarking.
+
+It serves the Table API (/api/now/table/*), the Aggregate API (/api/now/stats/*) and the Batch API
+(/api/now/v1/batch) over plain HTTP, backed by generated records:
+
+- sys_dictionary lists a script, an html and an xml field on every generated table
+- u_bench_<n> tables hold the records, a share of which contain NEEDLE in each of those fields. Their
+  sys_updated_on is one of a few timestamps, so many records share each one like after a bulk update
+- wf_activity and sys_variable_value hold published workflow activities and their script variables
+
+Encoded queries understand what sparky sends: ^ and ^OR, LIKE (case-insensitive), IN, =, !=, <, <=, >, >=,
+ISEMPTY, ISNOTEMPTY, dot-walked fields and any number of ORDERBY and ORDERBYDESC. Every response is delayed by the configured latency, and requests can be
+throttled with a 429 either above a rate or at random.
+
+Run it on its own with 'python benchmarks/mock_instance.py --port 8080', or let benchmarks/run.py start it.
+"""
+import base64
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import click
+
+NEEDLE = "SPARKY_NEEDLE"
+
+DEFAULT_CONFIG = {
+    "tables": 20,
+    "rows": 500,
+    "payload": 1024,
+    "hit_ratio": 0.02,
+    "workflows": 20,
+    "activities": 25,
+    "timestamps": 10,
+    "latency": 20.0,
+    "jitter": 5.0,
+    "throttle_rps": 0.0,
+    "throttle_ratio": 0.0,
+    "retry_after": 1.0,
+    "seed": 1,
+}
+
+FIELD_TYPES = [("script", "script"), ("u_html", "html"), ("u_xml", "xml")]
+
+QUERY_TERM = re.compile(r"^([\w.]+?)(LIKE|STARTSWITH|NOT IN|IN|ISNOTEMPTY|ISEMPTY|!=|>=|<=|=|>|<)(.*)$")
+
+def sys_id(rng: random.Random) -> str:
+    return "%032x" % rng.getrandbits(128)
+
+def payload(rng: random.Random, size: int, hit: bool) -> str:
+    """Returns roughly size bytes of script-like text over several lines, with NEEDLE somewhere in it if hit."""
+    words = ["var", "gr", "=", "new", "GlideRecord('incident');", "gr.query();", "while", "(gr.next())", "{", "}", "current.update();", "gs.info('done');"]
+    lines = []
+    length = 0
+    while length < size:
+        line = " ".join(rng.choice(words) for _ in range(8))
+        lines.append(line)
+        length += len(line) + 1
+    if hit:
+        lines.insert(rng.randrange(len(lines) + 1), "gs.log('" + NEEDLE + "');")
+    return "\n".join(lines)
+
+def generate(config: dict) -> dict:
+    """Builds every table of the instance from the config. The same config always gives the same records."""
+    rng = random.Random(config["seed"])
+    # a generator of its own, so the records themselves are the same as before timestamps were added
+    stamps = random.Random(config["seed"] + 1)
+    tables = {"sys_dictionary": [], "sys_db_object": [], "wf_activity": [], "sys_variable_value": []}
+    for n in range(config["tables"]):
+        name = "u_bench_" + str(n)
+        tables["sys_db_object"].append({"sys_id": sys_id(rng), "name": name, "super_class.name": ""})
+        for element, internal_type in FIELD_TYPES:
+            tables["sys_dictionary"].append({"sys_id": sys_id(rng), "name": name, "element": element, "internal_type": internal_type, "active": "true"})
+        rows = []
+        for r in range(config["rows"]):
+            row = {"sys_id": sys_id(rng), "name": name + " record " + str(r), "sys_class_name": name,
+                "sys_updated_on": "2024-01-01 00:%02d:00" % stamps.randrange(max(config["timestamps"], 1))}
+            for element, _ in FIELD_TYPES:
+                row[element] = payload(rng, config["payload"], rng.random() < config["hit_ratio"])
+            rows.append(row)
+        tables[name] = rows
+
+    for w in range(config["workflows"]):
+        version = sys_id(rng)
+        for a in range(config["activities"]):
+            activity = sys_id(rng)
+            tables["wf_activity"].append({"sys_id": activity, "name": "Activity " + str(a), "workflow_version": {"value": version},
+                "workflow_version.published": "true", "workflow_version.name": "Workflow " + str(w)})
+            tables["sys_variable_value"].append({"sys_id": sys_id(rng), "document": "wf_activity", "document_key": activity,
+                "variable.internal_type": "script", "value": payload(rng, config["payload"], rng.random() < config["hit_ratio"])})
+    for rows in tables.values():
+        rows.sort(key=lambda row: row["sys_id"])
+    return tables
+
+def parse_query(query: str):
+    """Returns the conditions of an encoded query as a list of OR groups that must all match, and the (field,
+    descending) sort keys in order."""
+    groups = []
+    order = []
+    for part in query.split("^"):
+        if part == "" or part.startswith("NQ"):
+            continue
+        if part.startswith("ORDERBYDESC"):
+            order.append((part[len("ORDERBYDESC"):], True))
+            continue
+        if part.startswith("ORDERBY"):
+            order.append((part[len("ORDERBY"):], False))
+            continue
+        alternative = part.startswith("OR") and len(groups) > 0
+        term = QUERY_TERM.match(part[2:] if alternative else part)
+        if term == None:
+            continue
+        field, op, value = term.groups()
+        if op == "LIKE":
+            value = unquote(value).lower()
+        elif op in ("IN", "NOT IN"):
+            value = set(value.split(","))
+        if alternative:
+            groups[-1].append((field, op, value))
+        else:
+            groups.append([(field, op, value)])
+    return groups, order
+
+def field_value(row: dict, field: str) -> str:
+    value = row.get(field, "")
+    if isinstance(value, dict):
+        value = value.get("value", "")
+    return str(value)
+
+def matches(row: dict, groups) -> bool:
+    for group in groups:
+        for field, op, value in group:
+            actual = field_value(row, field)
+            if ((op == "LIKE" and value in actual.lower()) or (op == "STARTSWITH" and actual.startswith(value))
+                    or (op == "IN" and actual in value) or (op == "NOT IN" and actual not in value)
+                    or (op == "ISEMPTY" and actual == "") or (op == "ISNOTEMPTY" and actual != "")
+                    or (op == "=" and actual == value) or (op == "!=" and actual != value)
+                    or (op == ">" and actual > value) or (op == ">=" and actual >= value)
+                    or (op == "<" and actual < value) or (op == "<=" and actual <= value)):
+                break
+        else:
+            return False
+    return True
+
+class Instance:
+    """The state shared by every request: the records, the config and the throttling window."""
+
+    def __init__(self, config: dict):
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.tables = generate(self.config)
+        self.rng = random.Random(self.config["seed"])
+        self.lock = threading.Lock()
+        self.sent = []
+
+    def throttle(self) -> bool:
+        """Returns whether a request should get a 429."""
+        with self.lock:
+            if self.config["throttle_ratio"] > 0 and self.rng.random() < self.config["throttle_ratio"]:
+                return True
+            if self.config["throttle_rps"] > 0:
+                now = time.time()
+                self.sent = [t for t in self.sent if t > now - 1]
+                if len(self.sent) >= self.config["throttle_rps"]:
+                    return True
+                self.sent.append(now)
+        return False
+
+    def delay(self):
+        with self.lock:
+            latency = self.config["latency"] + self.rng.uniform(-1, 1) * self.config["jitter"]
+        time.sleep(max(latency, 0) / 1000.0)
+
+    def table(self, name: str, params: dict):
+        if name not in self.tables:
+            return 400, {"error": {"message": "Invalid table " + name}}
+        groups, order = parse_query(params.get("sysparm_query", ""))
+        rows = [row for row in self.tables[name] if matches(row, groups)]
+        # the rows are kept in sys_id order, and a stable sort by each key from the last one up gives the full order
+        for field, descending in reversed(order):
+            rows.sort(key=lambda row: field_value(row, field), reverse=descending)
+        offset = int(params.get("sysparm_offset", 0))
+        rows = rows[offset:offset + int(params.get("sysparm_limit", 10000))]
+        if params.get("sysparm_fields"):
+            fields = params["sysparm_fields"].split(",")
+            rows = [dict((f, row.get(f, "")) for f in fields) for row in rows]
+        return 200, {"result": rows}
+
+    def stats(self, name: str, params: dict):
+        if name not in self.tables:
+            return 400, {"error": {"message": "Invalid table " + name}}
+        groups, _ = parse_query(params.get("sysparm_query", ""))
+        count = len([row for row in self.tables[name] if matches(row, groups)])
+        if params.get("sysparm_group_by") == "sys_class_name":
+            return 200, {"result": [{"stats": {"count": str(count)}, "groupby_fields": [{"field": "sys_class_name", "value": name}]}]}
+        return 200, {"result": {"stats": {"count": str(count)}}}
+
+    def get(self, path: str):
+        """Answers a GET of the Table or Aggregate API, returning the status code and body."""
+        url = urlparse(path)
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        table = re.match(r"^/api/now/(?:v\d/)?table/(\w+)$", url.path)
+        if table != None:
+            return self.table(table.group(1), params)
+        stats = re.match(r"^/api/now/(?:v\d/)?stats/(\w+)$", url.path)
+        if stats != None:
+            return self.stats(stats.group(1), params)
+        return 404, {"error": {"message": "Not found"}}
+
+    def batch(self, body: dict):
+        """Answers every request of a Batch API call. Rate limits count the batch call, not what is in it."""
+        serviced = []
+        for item in body.get("rest_requests", []):
+            status, result = self.get(item["url"])
+            serviced.append({"id": item["id"], "status_code": status, "status_text": "",
+                "headers": [{"name": "Content-Type", "value": "application/json"}],
+                "body": base64.b64encode(json.dumps(result).encode()).decode()})
+        return 200, {"batch_request_id": body.get("batch_request_id"), "serviced_requests": serviced, "unserviced_requests": []}
+
+def handler(instance: Instance):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately, which Nagle plus delayed ACKs would hold up for ~40ms each time
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            instance.delay()
+            if instance.throttle():
+                return self.reply(429, {"error": {"message": "Too many requests"}}, {"Retry-After": str(instance.config["retry_after"])})
+            self.reply(*instance.get(self.path))
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            instance.delay()
+            if not urlparse(self.path).path.endswith("/batch"):
+                return self.reply(404, {"error": {"message": "Not found"}})
+            if instance.throttle():
+                return self.reply(429, {"error": {"message": "Too many requests"}}, {"Retry-After": str(instance.config["retry_after"])})
+            self.reply(*instance.batch(body))
+
+        def reply(self, status: int, body: dict, headers: dict = None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+    return Handler
+
+def serve(config: dict, port: int = 0, ready=None):
+    """Serves an instance built from config until the process is stopped. ready, if given, is a queue that gets the
+    port once the instance is listening."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler(Instance(config)))
+    server.daemon_threads = True
+    if ready != None:
+        ready.put(server.server_port)
+    server.serve_forever()
+
+@click.command()
+@click.option('--port', help='Port to listen on', type=int, default=8080, show_default=True)
+@click.option('--tables', help='Number of tables with script, html and xml fields', type=int, default=DEFAULT_CONFIG["tables"], show_default=True)
+@click.option('--rows', help='Records per table', type=int, default=DEFAULT_CONFIG["rows"], show_default=True)
+@click.option('--payload', help='Approximate size in bytes of every script, html and xml value', type=int, default=DEFAULT_CONFIG["payload"], show_default=True)
+@click.option('--hit-ratio', help='Share of values that contain ' + NEEDLE, type=float, default=DEFAULT_CONFIG["hit_ratio"], show_default=True)
+@click.option('--workflows', help='Number of published workflows', type=int, default=DEFAULT_CONFIG["workflows"], show_default=True)
+@click.option('--activities', help='Activities per workflow', type=int, default=DEFAULT_CONFIG["activities"], show_default=True)
+@click.option('--timestamps', help='Distinct sys_updated_on values the records of a table share', type=int, default=DEFAULT_CONFIG["timestamps"], show_default=True)
+@click.option('--latency', help='Milliseconds every response is delayed by', type=float, default=DEFAULT_CONFIG["latency"], show_default=True)
+@click.option('--jitter', help='Milliseconds the latency varies by either way', type=float, default=DEFAULT_CONFIG["jitter"], show_default=True)
+@click.option('--throttle-rps', help='Requests per second above which requests get a 429 (0 for no limit)', type=float, default=DEFAULT_CONFIG["throttle_rps"], show_default=True)
+@click.option('--throttle-ratio', help='Share of requests that get a 429 at random', type=float, default=DEFAULT_CONFIG["throttle_ratio"], show_default=True)
+@click.option('--retry-after', help='Seconds sent in the Retry-After header of a 429', type=float, default=DEFAULT_CONFIG["retry_after"], show_default=True)
+@click.option('--seed', help='Seed for the generated records', type=int, default=DEFAULT_CONFIG["seed"], show_default=True)
+def main(port, **config):
+    """Runs a mock ServiceNow instance on localhost."""
+    click.echo("Mock instance listening on http://127.0.0.1:" + str(port))
+    serve(config, port)
+
+if __name__ == "__main__":
+    main()
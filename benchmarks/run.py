@@ -0,0 +1,233 @@
+"""Runs sparky's scan paths against a local mock instance and reports how fast they went.
+
+Every scenario drives the same functions the commands use, with a session built the same way, against a
+mock instance (see mock_instance.py) running in its own process. Each scenario runs in a fresh process too, so
+its peak RSS is its own. Results are saved under benchmarks/results/ so later runs can be compared with them.
+
+    python benchmarks/run.py
+    python benchmarks/run.py --scenario query-script --workers 8 --latency 50 --compare benchmarks/results/<file>.json
+"""
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import click
+
+import mock_instance
+
+try:
+    import sparky
+except ImportError:
+    # running from a checkout that hasn't been installed
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from sparky.cmd_funcs import query, single_search, sync
+from sparky.connection.conn import new_session
+from sparky.connection.stream import OrderedStream
+from sparky.connection.table import get_records
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+def ignore(message: str):
+    pass
+
+def prepare_none(s, url, options):
+    return None
+
+def prepare_targets(s, url, options):
+    """Collects the (table, sys_id) of every record to search in the textsearch scenario."""
+    targets = []
+    for table, _ in query.group_by_table(query.get_full_query_list(s, url, "script", options["page_size"])):
+        for i in get_records(s, url, table, {"sysparm_fields": "sys_id"}, options["page_size"]):
+            targets.append((table, i["sys_id"]))
+    return targets
+
+def run_query(query_type: str):
+    def run(s, url, options, state):
+        query_list = query.get_full_query_list(s, url, query_type, options["page_size"])
+        return sum(1 for _ in query.scan_tables(s, url, query_list, [mock_instance.NEEDLE], query.scan_workers(options["workers"], options["batch_size"]),
+            options["page_size"], ignore))
+    return run
+
+def run_workflow(s, url, options, state):
+    query_list = query.wf_activity_lookup(s, url, "", options["page_size"], "all")
+    return sum(1 for _ in query.scan_workflow(s, url, query_list, mock_instance.NEEDLE, options["page_size"], ignore, options["chunk_size"]))
+
+def run_textsearch(s, url, options, state):
+    by_table = {}
+    for table, sys_id in state:
+        by_table.setdefault(table, []).append(sys_id)
+    fragment = single_search.compile_fragments([mock_instance.NEEDLE])
+    return sum(1 for _ in single_search.bulk_matches(s, url, by_table, fragment, {table: ["script", "u_html", "u_xml"] for table in by_table},
+        options["workers"], options["page_size"], options["chunk_size"], lambda table, e: None))
+
+def sync_units(s, url, options) -> list:
+    units = []
+    for query_type in ("script", "html", "xml"):
+        units += [(str(table).strip(), str(field).strip()) for table, field in query.get_full_query_list(s, url, query_type, options["page_size"])]
+    return units
+
+def sync_pass(s, url, options, marks: dict) -> int:
+    """Reads what changed after the marks of every field the way 'sparky sync' does, moving the marks up. Returns the
+    number of records read."""
+    count = 0
+    with OrderedStream(options["workers"]) as stream:
+        for table, field in sync_units(s, url, options):
+            hw = marks.get((table, field))
+            stream.submit((table, field), sync.fetch_changes, s, url, table, field, None if hw == None else hw[0], None if hw == None else hw[1],
+                options["page_size"])
+        for key, pages in stream:
+            for page in pages:
+                count += len(page)
+                marks[key] = (page[-1]["sys_updated_on"], page[-1]["sys_id"])
+    return count
+
+def prepare_synced(s, url, options):
+    """Syncs everything once, so the timed run only has to look for changes."""
+    marks = {}
+    sync_pass(s, url, options, marks)
+    return marks
+
+def run_sync(s, url, options, state):
+    return sync_pass(s, url, options, state or {})
+
+# name: (untimed preparation, timed run returning the number of hits, or of records read for the sync scenarios)
+SCENARIOS = {
+    "query-script": (prepare_none, run_query("script")),
+    "query-html": (prepare_none, run_query("html")),
+    "query-xml": (prepare_none, run_query("xml")),
+    "query-workflow": (prepare_none, run_workflow),
+    "textsearch": (prepare_targets, run_textsearch),
+    "sync": (prepare_none, run_sync),
+    "sync-incremental": (prepare_synced, run_sync),
+}
+
+def percentile(values: list, q: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+def run_scenario(name: str, url: str, options: dict, results):
+    """Runs a single scenario in this process and puts its measurements on the results queue."""
+    prepare, run = SCENARIOS[name]
+    s = new_session(options["workers"], options["batch_size"], options["rate"], options["max_retries"])
+    state = prepare(s, url, options)
+    latencies = []
+    s.hooks["response"].append(lambda resp, *args, **kwargs: latencies.append(resp.elapsed.total_seconds()))
+    start = time.perf_counter()
+    hits = run(s, url, options, state)
+    wall = time.perf_counter() - start
+    results.put({
+        "requests": len(latencies),
+        "throttled": s.scheduler.throttled,
+        "wall": wall,
+        "rps": len(latencies) / wall if wall > 0 else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+        "hits": hits,
+    })
+
+def measure(name: str, url: str, options: dict) -> dict:
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_scenario, args=(name, url, options, results))
+    process.start()
+    try:
+        return results.get(timeout=options["timeout"])
+    finally:
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+
+def median_run(runs: list) -> dict:
+    """Returns the run with the median wall time."""
+    return sorted(runs, key=lambda run: run["wall"])[len(runs) // 2]
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+def print_results(results: dict, baseline: dict = None):
+    click.secho("{:<16} {:>9} {:>9} {:>9} {:>10} {:>9} {:>9} {:>10} {:>7}".format("Scenario", "Requests", "429s", "Wall s",
+        "Req/s", "p50 ms", "p99 ms", "Peak MB", "Hits"), fg="bright_white", bold=True)
+    for name, r in results.items():
+        line = "{:<16} {:>9} {:>9} {:>9.2f} {:>10.1f} {:>9.1f} {:>9.1f} {:>10.1f} {:>7}".format(name, r["requests"], r["throttled"], r["wall"],
+            r["rps"], r["p50_ms"], r["p99_ms"], r["peak_rss_mb"], r["hits"])
+        old = (baseline or {}).get(name)
+        if old != None and old["wall"] > 0:
+            change = (r["wall"] - old["wall"]) / old["wall"] * 100
+            line += click.style("  wall {:+.1f}%".format(change), fg="green" if change <= 0 else "red")
+            if old["hits"] != r["hits"]:
+                line += click.style("  hits were " + str(old["hits"]), fg="yellow")
+        click.echo(line)
+
+@click.command()
+@click.option('--scenario', 'scenarios', help='Scenario to run, can be given more than once', type=click.Choice(list(SCENARIOS)), multiple=True, default=list(SCENARIOS), show_default=True)
+@click.option('--repeat', help='Runs per scenario, the one with the median wall time is reported', type=click.IntRange(1), default=1, show_default=True)
+@click.option('-w', '--workers', help='Parallel requests', type=int, default=8, show_default=True)
+@click.option('--page-size', help='Records per page', type=int, default=query.DEFAULT_PAGE_SIZE, show_default=True)
+@click.option('--chunk-size', help='Records or activities per request in the workflow and textsearch scenarios', type=int, default=query.DEFAULT_CHUNK_SIZE, show_default=True)
+@click.option('--batch-size', help='Requests per Batch API call (0 to send them one by one)', type=int, default=0, show_default=True)
+@click.option('--rate', help='Starting requests per second (0 for no limit until throttled)', type=float, default=0, show_default=True)
+@click.option('--max-retries', help='Retries per throttled request', type=int, default=query.DEFAULT_MAX_RETRIES, show_default=True)
+@click.option('--tables', help='Tables on the mock instance', type=int, default=mock_instance.DEFAULT_CONFIG["tables"], show_default=True)
+@click.option('--rows', help='Records per table', type=int, default=mock_instance.DEFAULT_CONFIG["rows"], show_default=True)
+@click.option('--payload', help='Approximate bytes per script, html and xml value', type=int, default=mock_instance.DEFAULT_CONFIG["payload"], show_default=True)
+@click.option('--hit-ratio', help='Share of values that match', type=float, default=mock_instance.DEFAULT_CONFIG["hit_ratio"], show_default=True)
+@click.option('--workflows', help='Published workflows', type=int, default=mock_instance.DEFAULT_CONFIG["workflows"], show_default=True)
+@click.option('--activities', help='Activities per workflow', type=int, default=mock_instance.DEFAULT_CONFIG["activities"], show_default=True)
+@click.option('--timestamps', help='Distinct sys_updated_on values the records of a table share', type=int, default=mock_instance.DEFAULT_CONFIG["timestamps"], show_default=True)
+@click.option('--latency', help='Milliseconds every response is delayed by', type=float, default=mock_instance.DEFAULT_CONFIG["latency"], show_default=True)
+@click.option('--jitter', help='Milliseconds the latency varies by either way', type=float, default=mock_instance.DEFAULT_CONFIG["jitter"], show_default=True)
+@click.option('--throttle-rps', help='Requests per second above which the instance answers 429 (0 for no limit)', type=float, default=mock_instance.DEFAULT_CONFIG["throttle_rps"], show_default=True)
+@click.option('--throttle-ratio', help='Share of requests answered with a 429 at random', type=float, default=mock_instance.DEFAULT_CONFIG["throttle_ratio"], show_default=True)
+@click.option('--retry-after', help='Seconds sent in the Retry-After header of a 429', type=float, default=mock_instance.DEFAULT_CONFIG["retry_after"], show_default=True)
+@click.option('--seed', help='Seed for the generated records', type=int, default=mock_instance.DEFAULT_CONFIG["seed"], show_default=True)
+@click.option('--timeout', help='Seconds a single run may take', type=int, default=600, show_default=True)
+@click.option('--label', help='Label saved with the results and added to their file name', type=str, default="", show_default=False)
+@click.option('--compare', help='Saved results to compare this run with', type=click.Path(exists=True, dir_okay=False), default=None, show_default=False)
+@click.option('--save/--no-save', help='Save the results under benchmarks/results', default=True, show_default=True)
+def main(scenarios, repeat, label, compare, save, **options):
+    """Benchmarks sparky against a local mock instance."""
+    config = dict((k, options[k]) for k in mock_instance.DEFAULT_CONFIG)
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=mock_instance.serve, args=(config, 0, ready), daemon=True)
+    server.start()
+    try:
+        url = "http://127.0.0.1:" + str(ready.get(timeout=120))
+        results = {}
+        for name in scenarios:
+            click.echo("[ Running " + click.style(name, fg="green") + " ]")
+            results[name] = median_run([measure(name, url, options) for _ in range(repeat)])
+    finally:
+        server.terminate()
+
+    baseline = None
+    if compare != None:
+        with open(compare) as file:
+            baseline = json.load(file)["results"]
+    print_results(results, baseline)
+    if save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        filename = os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ("-" + label if label != "" else "") + ".json")
+        with open(filename, "w") as file:
+            json.dump({"label": label, "created": time.time(), "revision": git_revision(), "python": platform.python_version(),
+                "repeat": repeat, "options": options, "results": results}, file, indent=2)
+        click.echo("Results saved to " + filename)
+
+if __name__ == "__main__":
+    main()
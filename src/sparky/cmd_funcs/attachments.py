@@ -0,0 +1,181 @@
+from typing import Iterator, List, Tuple
+import click
+import codecs
+import re
+import requests
+import sys
+import zlib
+from itertools import chain
+from ..connection import conn, stats
+from ..connection.stream import OrderedStream
+from ..connection.table import DEFAULT_PAGE_SIZE, TableError, get_records, read_result
+from . import output
+from .single_search import DEFAULT_CHUNK_SIZE, compile_fragments, print_results
+
+DOWNLOAD_CHUNK = 1024 * 1024
+# A line longer than this is searched in pieces instead of being held whole, keeping OVERLAP characters between
+# pieces so that matches shorter than that are still found where the line was cut
+MAX_LINE = 4 * 1024 * 1024
+OVERLAP = 64 * 1024
+# Shown around a match instead of the whole line when the line is longer than this
+MAX_SNIPPET = 300
+SKIPPED_TYPES = ("image/", "video/", "audio/")
+
+ATTACHMENT_FIELDS = "sys_id,file_name,table_name,table_sys_id,size_bytes,content_type"
+
+def list_attachments(s: requests.Session, url: str, table: str = None, targets: List[Tuple[str, str]] = None, file_name: str = None,
+        page_size: int = DEFAULT_PAGE_SIZE, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[dict]:
+    """Yields the sys_attachment records of every record of a table, or of the (table, sys_id) records given.
+    file_name limits them to the attachments whose name contains it. Attachments are filed under the class of their
+    record rather than the table it was found in (incident rather than task), so records given by sys_id are looked
+    up by sys_id alone."""
+    name_query = "" if file_name == None else "^file_nameLIKE" + file_name
+    if table != None:
+        for i in get_records(s, url, "sys_attachment", {"sysparm_fields": ATTACHMENT_FIELDS, "sysparm_query": "table_name=" + table + name_query}, page_size):
+            yield i
+        return
+    sys_ids = list(dict((sys_id, None) for _, sys_id in targets or []))
+    for start in range(0, len(sys_ids), chunk_size):
+        query = "table_sys_idIN" + ",".join(sys_ids[start:start + chunk_size]) + name_query
+        for i in get_records(s, url, "sys_attachment", {"sysparm_fields": ATTACHMENT_FIELDS, "sysparm_query": query}, page_size):
+            yield i
+
+def download(s: requests.Session, url: str, sys_id: str, chunk_size: int = DOWNLOAD_CHUNK) -> Iterator[bytes]:
+    """Yields the content of an attachment chunk by chunk as it downloads, gunzipped if it is a gzip file, so only
+    a chunk or so is ever in memory. Raises a TableError if it can't be downloaded."""
+    resp = s.get(url + "/api/now/attachment/" + sys_id + "/file", stream=True, headers={"Accept": "*/*"})
+    try:
+        if resp.status_code != 200:
+            read_result(resp) # raises with the instance's error message
+            raise TableError(resp.status_code)
+        size = 0
+        chunks = resp.iter_content(chunk_size)
+        first = next(chunks, b"")
+        gunzip = zlib.decompressobj(16 + zlib.MAX_WBITS) if first[:2] == b"\x1f\x8b" else None
+        for chunk in chain([first], chunks):
+            size += len(chunk)
+            if gunzip == None:
+                yield chunk
+                continue
+            # bounded output per step, so a small compressed chunk can't blow up in memory
+            data = gunzip.decompress(chunk, chunk_size)
+            while len(data) > 0:
+                yield data
+                data = gunzip.decompress(gunzip.unconsumed_tail, chunk_size)
+        stats.record(resp, 0, size=size)
+    finally:
+        resp.close()
+
+def decode(chunks: Iterator[bytes]) -> Iterator[str]:
+    """Turns byte chunks into text with every newline style as \\n, even where a character or \\r\\n is cut in two."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    held = ""
+    for chunk in chain(chunks, [None]):
+        text = held + (decoder.decode(b"", final=True) if chunk == None else decoder.decode(chunk))
+        held = ""
+        if chunk != None and text.endswith("\r"):
+            text, held = text[:-1], "\r"
+        yield text.replace("\r\n", "\n").replace("\r", "\n")
+
+def snippet(line: str, start: int, end: int) -> str:
+    if len(line) <= MAX_SNIPPET:
+        return line
+    pad = max((MAX_SNIPPET - (end - start)) // 2, 0)
+    return ("..." if start - pad > 0 else "") + line[max(start - pad, 0):end + pad] + ("..." if end + pad < len(line) else "")
+
+def search_stream(fragment, texts: Iterator[str]) -> Iterator[Tuple[str, int, str, str]]:
+    """Yields (term, line number, line or part of it, pattern) for every match in a stream of text, like search in
+    single_search does for a whole value. Only complete lines are searched, the rest is carried over to the next
+    chunk, so a match is never missed because it was cut in two."""
+    combined, each = fragment
+    line = 1
+    rest = ""
+    for text in chain(texts, [None]):
+        if text == None:
+            block, rest = rest, ""
+        else:
+            rest += text
+            cut = rest.rfind("\n")
+            if cut == -1:
+                if len(rest) > MAX_LINE:
+                    # one enormous line (minified or encoded content): search all but its end and keep going
+                    for result in search_block(combined, each, rest, line, len(rest) - OVERLAP):
+                        yield result
+                    rest = rest[len(rest) - OVERLAP:]
+                continue
+            block, rest = rest[:cut], rest[cut + 1:]
+        for result in search_block(combined, each, block, line):
+            yield result
+        line += block.count("\n") + (1 if text != None else 0)
+
+def search_block(combined, each, block: str, line: int, stop: int = None) -> Iterator[Tuple[str, int, str, str]]:
+    """Searches complete lines starting at the given line number, reporting only matches that start before stop."""
+    m = combined.search(block)
+    pos = 0
+    while m != None and (stop == None or m.start() < stop):
+        line += block.count("\n", pos, m.start())
+        pos = m.start()
+        start = block.rfind("\n", 0, m.start()) + 1
+        end = block.find("\n", m.end())
+        end = len(block) if end == -1 else end
+        pattern = next((p for p in each if p.match(block, m.start())), each[0])
+        yield m.group(), line, snippet(block[start:end], m.start() - start, m.end() - start), pattern.pattern
+        m = combined.search(block, m.end() if m.end() > m.start() else m.end() + 1)
+
+def search_attachment(s: requests.Session, url: str, attachment: dict, fragment) -> Iterator[Tuple[str, int, str, str]]:
+    return search_stream(fragment, decode(download(s, url, attachment.get('sys_id'))))
+
+def attachment_search(patterns: List[str], table: str = None, targets: List[Tuple[str, str]] = None, file_name: str = None, profile_id: int = None,
+        workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE, chunk_size: int = DEFAULT_CHUNK_SIZE, flags: int = 0):
+    """Searches the attachments of a table or of a set of records. Attachments are downloaded in parallel and
+    searched as they stream in, so memory use doesn't grow with their size."""
+    fragment = compile_fragments(patterns, flags)
+    profile = conn.get_selected_profile() if profile_id == None else conn.get_profiles([str(profile_id)])[0]
+    s, url = conn.setup_connection(workers, profile)
+    try:
+        attachments = list(list_attachments(s, url, table, targets, file_name, page_size, chunk_size))
+    except TableError as e:
+        click.secho("Received status code " + str(e.status_code) + " while listing attachments" + ("" if e.message == None else ": " + e.message) + ". Aborting.", fg="red")
+        sys.exit()
+    skipped = [i for i in attachments if str(i.get('content_type') or "").startswith(SKIPPED_TYPES)]
+    attachments = [i for i in attachments if not str(i.get('content_type') or "").startswith(SKIPPED_TYPES)]
+    click.echo("[ Searching " + click.style(str(len(attachments)), fg="blue") + " attachments ("
+        + "{:.1f}".format(sum(int(i.get('size_bytes') or 0) for i in attachments) / (1024.0 * 1024.0)) + " MB) on " + click.style(profile[1], fg="green")
+        + ("" if len(skipped) == 0 else ", skipping " + str(len(skipped)) + " images, videos and audio files") + " ]")
+
+    found = 0
+    with OrderedStream(workers) as stream:
+        for attachment in attachments:
+            stream.submit(attachment, search_attachment, s, url, attachment, fragment)
+        for attachment, results in stream:
+            shown = False
+            try:
+                for result in results:
+                    if not shown:
+                        found += 1
+                        shown = True
+                        if output.sink == None:
+                            click.secho("\n" + str(attachment.get('table_name')) + " " + str(attachment.get('table_sys_id')) + " "
+                                + click.style(str(attachment.get('file_name')), fg="green") + " (" + str(attachment.get('sys_id')) + ")", bold=True)
+                    print_results([result], len(patterns) > 1, {"instance": profile[1], "table": attachment.get('table_name'), "field": "attachment",
+                        "sys_id": attachment.get('table_sys_id'), "name": attachment.get('file_name'), "attachment_sys_id": attachment.get('sys_id')})
+            except TableError as e:
+                if e.status_code == 401:
+                    click.secho("Received status code 401 while downloading " + str(attachment.get('file_name')) + ". Aborting.", fg="red")
+                    sys.exit()
+                click.secho("Could not download " + str(attachment.get('file_name')) + " (status " + str(e.status_code) + ")" + ("" if e.message == None else ": " + e.message), fg="yellow")
+            except (requests.ConnectionError, requests.Timeout, zlib.error) as e:
+                click.secho("Could not search " + str(attachment.get('file_name')) + ": " + str(e), fg="yellow")
+    click.secho("\nFinished. " + str(found) + " attachments matched.", fg="bright_white", bold=True)
+
+def attachment_search_scan(scan_id: int = None, patterns: List[str] = None, file_name: str = None, workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+        chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Searches the attachments of the records a saved scan found. Without patterns of its own, the scan's strings
+    are looked for the way the scan did: literally and ignoring case."""
+    from .checkpoint import scan_hits
+    profile_id, scan_patterns, hits = scan_hits(scan_id)
+    targets = [(t, i) for t, _, i in hits]
+    if patterns == None or len(patterns) == 0:
+        attachment_search([re.escape(p) for p in scan_patterns], None, targets, file_name, profile_id, workers, page_size, chunk_size, re.IGNORECASE)
+    else:
+        attachment_search(patterns, None, targets, file_name, profile_id, workers, page_size, chunk_size)
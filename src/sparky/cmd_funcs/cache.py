@@ -0,0 +1,91 @@
+from typing import List, Tuple
+import click
+import sqlite3
+import time
+import requests
+from ..connection import db
+from ..connection.table import DEFAULT_PAGE_SIZE, TableError, read_result
+
+DEFAULT_TTL = 24 * 60 # minutes
+
+def setup_target_cache(conn: sqlite3.Connection):
+    cur = conn.cursor()
+    cur.execute('''CREATE TABLE IF NOT EXISTS target_cache (
+        profile_id int,
+        query_type text,
+        tbl text,
+        field text
+    );''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS target_cache_state (
+        profile_id int,
+        query_type text,
+        fetched_on real,
+        fingerprint text,
+        primary key (profile_id, query_type)
+    );''')
+    conn.commit()
+
+def dictionary_fingerprint(s: requests.Session, url: str, query_type: str) -> str:
+    """Cheaply identifies the current state of the dictionary rows behind a target list: the newest sys_updated_on
+    of the matching rows plus their total count, so that both edits and deletions are noticed. Returns None if
+    the instance couldn't tell us."""
+    from .query import dictionary_query
+    resp = s.get(url + "/api/now/table/sys_dictionary", params={
+        "sysparm_fields": "sys_updated_on",
+        "sysparm_query": dictionary_query(query_type) + "^ORDERBYDESCsys_updated_on",
+        "sysparm_limit": "1",
+    })
+    try:
+        result = read_result(resp)
+    except TableError:
+        return None
+    newest = result[0].get('sys_updated_on') if len(result) > 0 else ""
+    return newest + "|" + str(resp.headers.get("X-Total-Count", ""))
+
+def get_target_list(s: requests.Session, url: str, profile_id: int, query_type: str, page_size: int = DEFAULT_PAGE_SIZE,
+        ttl: int = DEFAULT_TTL, refresh: bool = False) -> List[Tuple[str, str]]:
+    """Returns the list of tables and fields to query for the given type, reusing the list cached for the profile
+    while it is younger than the TTL (in minutes). Once it is older, the dictionary fingerprint decides whether the
+    cached list can be kept for another TTL or has to be fetched again."""
+    from .query import get_full_query_list
+    conn = db.connect()
+    try:
+        setup_target_cache(conn)
+        cur = conn.cursor()
+        state = cur.execute("SELECT fetched_on, fingerprint FROM target_cache_state WHERE profile_id = ? AND query_type = ?;", (profile_id, query_type)).fetchone()
+        fingerprint = None
+        if state != None and not refresh and ttl > 0:
+            if time.time() - state[0] < ttl * 60:
+                return load_target_list(cur, profile_id, query_type)
+            fingerprint = dictionary_fingerprint(s, url, query_type)
+            if fingerprint != None and fingerprint == state[1]:
+                cur.execute("UPDATE target_cache_state SET fetched_on = ? WHERE profile_id = ? AND query_type = ?;", (time.time(), profile_id, query_type))
+                conn.commit()
+                return load_target_list(cur, profile_id, query_type)
+        elif ttl > 0:
+            fingerprint = dictionary_fingerprint(s, url, query_type)
+
+        query_list = get_full_query_list(s, url, query_type, page_size)
+        if ttl > 0:
+            cur.execute("DELETE FROM target_cache WHERE profile_id = ? AND query_type = ?;", (profile_id, query_type))
+            cur.executemany("INSERT INTO target_cache VALUES (?, ?, ?, ?);", [(profile_id, query_type, t, f) for t, f in query_list])
+            cur.execute("INSERT OR REPLACE INTO target_cache_state VALUES (?, ?, ?, ?);", (profile_id, query_type, time.time(), fingerprint))
+            conn.commit()
+        return query_list
+    finally:
+        conn.close()
+
+def load_target_list(cur: sqlite3.Cursor, profile_id: int, query_type: str) -> List[Tuple[str, str]]:
+    click.secho("Using cached list of " + query_type + " tables. (use --refresh-tables to reload)", dim=True)
+    return cur.execute("SELECT tbl, field FROM target_cache WHERE profile_id = ? AND query_type = ? ORDER BY rowid;", (profile_id, query_type)).fetchall()
+
+def clear_target_cache(profile_id: int):
+    """Forgets every cached target list of a profile."""
+    conn = db.connect()
+    try:
+        setup_target_cache(conn)
+        conn.execute("DELETE FROM target_cache WHERE profile_id = ?;", (profile_id,))
+        conn.execute("DELETE FROM target_cache_state WHERE profile_id = ?;", (profile_id,))
+        conn.commit()
+    finally:
+        conn.close()
@@ -0,0 +1,231 @@
+from typing import Iterator, List, Tuple
+import click
+import requests
+import sqlite3
+import sys
+import time
+from ..connection import db
+from ..connection.conn import get_profiles, get_selected_profile, setup_connection
+from ..connection.table import DEFAULT_PAGE_SIZE
+from . import output
+
+def setup_checkpoints(conn: sqlite3.Connection):
+    cur = conn.cursor()
+    cur.execute('''CREATE TABLE IF NOT EXISTS scan (
+        id integer primary key,
+        profile_id int,
+        query_type text,
+        query_string text,
+        started_on real,
+        finished int,
+        search_id int
+    );''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS scan_unit (
+        scan_id int,
+        seq int,
+        tbl text,
+        fields text,
+        shard text,
+        done int,
+        primary key (scan_id, seq)
+    );''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS scan_hit (
+        scan_id int,
+        seq int,
+        tbl text,
+        field text,
+        sys_id text,
+        name text,
+        pattern text
+    );''')
+    try:
+        cur.execute("ALTER TABLE scan_hit ADD COLUMN pattern text;")
+    except sqlite3.OperationalError: # already there
+        pass
+    try:
+        cur.execute("ALTER TABLE scan ADD COLUMN search_id int;")
+    except sqlite3.OperationalError: # already there
+        pass
+    cur.execute("CREATE INDEX IF NOT EXISTS scan_hit_seq ON scan_hit (scan_id, seq);")
+    conn.commit()
+
+def start_scan(conn: sqlite3.Connection, profile_id: int, query_type: str, patterns: List[str], units: List[Tuple[str, List[str], str]],
+        search_id: int = None) -> int:
+    """Records a new scan and the units it is made of, returning its ID. The patterns are saved one per line. Scans
+    checking a saved search carry its search_id and are kept apart from the user's own queries."""
+    setup_checkpoints(conn)
+    cur = conn.cursor()
+    cur.execute("INSERT INTO scan (profile_id, query_type, query_string, started_on, finished, search_id) VALUES (?, ?, ?, ?, 0, ?);",
+        (profile_id, query_type, "\n".join(patterns), time.time(), search_id))
+    scan_id = cur.lastrowid
+    cur.executemany("INSERT INTO scan_unit VALUES (?, ?, ?, ?, ?, 0);", [(scan_id, n, table, ",".join(fields), shard) for n, (table, fields, shard) in enumerate(units)])
+    conn.commit()
+    return scan_id
+
+def checkpointed(conn: sqlite3.Connection, scan_id: int, matches: Iterator[Tuple[int, str, str, dict, str]], seqs: List[int] = None) -> Iterator[Tuple[str, str, dict, str]]:
+    """Passes on the (table, field, record, pattern) of every match of a scan while saving it under the unit it came from.
+    seqs maps the scan's unit indexes to the saved units when only some of them are scanned."""
+    from .query import record_name
+    cur = conn.cursor()
+    for n, table, field, i, pattern in matches:
+        cur.execute("INSERT INTO scan_hit (scan_id, seq, tbl, field, sys_id, name, pattern) VALUES (?, ?, ?, ?, ?, ?, ?);",
+            (scan_id, n if seqs == None else seqs[n], table, field, i.get('sys_id'), record_name(i), pattern))
+        yield table, field, i, pattern
+
+def mark_done(conn: sqlite3.Connection, scan_id: int, seq: int):
+    """Checkpoints a unit once all of its matches have been saved, so a resumed scan doesn't repeat it."""
+    conn.execute("UPDATE scan_unit SET done = 1 WHERE scan_id = ? AND seq = ?;", (scan_id, seq))
+    conn.commit()
+
+def finish_scan(conn: sqlite3.Connection, scan_id: int) -> bool:
+    """Marks a scan as finished if every unit of it is done, dropping the older finished queries of the same profile
+    so only the latest one can be replayed. A check of a saved search only drops the earlier checks of that search,
+    which its next run covers anyway. Returns whether the scan is finished."""
+    cur = conn.cursor()
+    left = cur.execute("SELECT count(*) FROM scan_unit WHERE scan_id = ? AND done = 0;", (scan_id,)).fetchone()[0]
+    if left > 0:
+        conn.commit()
+        return False
+    profile_id, search_id = cur.execute("SELECT profile_id, search_id FROM scan WHERE id = ?;", (scan_id,)).fetchone()
+    if search_id == None:
+        older = cur.execute("SELECT id FROM scan WHERE profile_id = ? AND finished = 1 AND search_id IS NULL AND id != ?;", (profile_id, scan_id)).fetchall()
+    else:
+        older = cur.execute("SELECT id FROM scan WHERE search_id = ? AND id != ?;", (search_id, scan_id)).fetchall()
+    for (old,) in older:
+        forget_scan(cur, old)
+    cur.execute("UPDATE scan SET finished = 1 WHERE id = ?;", (scan_id,))
+    conn.commit()
+    return True
+
+def forget_scan(cur: sqlite3.Cursor, scan_id: int):
+    cur.execute("DELETE FROM scan_hit WHERE scan_id = ?;", (scan_id,))
+    cur.execute("DELETE FROM scan_unit WHERE scan_id = ?;", (scan_id,))
+    cur.execute("DELETE FROM scan WHERE id = ?;", (scan_id,))
+
+def clear_search_scans(search_id: int):
+    """Forgets every check of a saved search."""
+    conn = db.connect()
+    try:
+        setup_checkpoints(conn)
+        cur = conn.cursor()
+        for (scan_id,) in cur.execute("SELECT id FROM scan WHERE search_id = ?;", (search_id,)).fetchall():
+            forget_scan(cur, scan_id)
+        conn.commit()
+    finally:
+        conn.close()
+
+def clear_scans(profile_id: int):
+    """Forgets every saved scan of a profile."""
+    conn = db.connect()
+    try:
+        setup_checkpoints(conn)
+        cur = conn.cursor()
+        for (scan_id,) in cur.execute("SELECT id FROM scan WHERE profile_id = ?;", (profile_id,)).fetchall():
+            forget_scan(cur, scan_id)
+        conn.commit()
+    finally:
+        conn.close()
+
+def scan_hits(scan_id: int = None) -> Tuple[int, List[str], List[Tuple[str, str, str]]]:
+    """Returns the profile ID, patterns and (table, field, sys_id) hits of a saved scan, by default the latest scan of
+    the selected profile. Exits if there is no such scan."""
+    conn = db.connect()
+    try:
+        setup_checkpoints(conn)
+        cur = conn.cursor()
+        if scan_id == None:
+            row = cur.execute("SELECT id, profile_id, query_string FROM scan WHERE profile_id = ? AND search_id IS NULL ORDER BY id DESC LIMIT 1;", (get_selected_profile()[0],)).fetchone()
+        else:
+            row = cur.execute("SELECT id, profile_id, query_string FROM scan WHERE id = ?;", (scan_id,)).fetchone()
+        if row == None:
+            click.secho("No saved scan found. Use 'sparky query resume --list' to see the saved scans.", fg="red")
+            sys.exit()
+        hits = cur.execute("SELECT tbl, field, sys_id FROM scan_hit WHERE scan_id = ? ORDER BY seq, rowid;", (row[0],)).fetchall()
+        return row[1], row[2].split("\n"), hits
+    finally:
+        conn.close()
+
+def resume_hint(scan_id: int):
+    click.secho("Progress has been saved. Run 'sparky query resume --scan " + str(scan_id) + "' to carry on where the scan stopped.", fg="yellow")
+
+def list_scans():
+    """Lists the saved scans of every profile, leaving out the checks of saved searches."""
+    conn = db.connect()
+    try:
+        setup_checkpoints(conn)
+        click.secho("{:<8} {:<20} {:<8} {:<30} {:<20} {:<12} {:<10}".format('ID', 'Profile', 'Type', 'Query', 'Started', 'Progress', 'Status'), fg="bright_white", bold=True)
+        names = dict((p[0], p[1]) for p in get_profiles())
+        for scan_id, profile_id, query_type, query_string, started_on, finished, done, total in conn.execute('''SELECT s.id, s.profile_id, s.query_type,
+                s.query_string, s.started_on, s.finished, sum(u.done), count(u.seq) FROM scan s LEFT JOIN scan_unit u ON u.scan_id = s.id WHERE s.search_id IS NULL
+                GROUP BY s.id ORDER BY s.id;'''):
+            click.echo("{:<8} {:<20} {:<8} {:<30} {:<20} {:<12} {}".format(scan_id, names.get(profile_id, "(deleted)"), query_type, query_string.replace("\n", " | "),
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(started_on)), str(done or 0) + "/" + str(total),
+                click.style("finished", fg="green") if finished else click.style("unfinished", fg="yellow")))
+    finally:
+        conn.close()
+
+def resume_scan(scan_id: int = None, workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE):
+    """Scans the units an interrupted scan didn't finish, then prints every result of the scan. Without a scan ID the
+    latest unfinished scan of the selected profile is resumed."""
+    from .query import ScanAborted, print_result, print_result_header, print_throttling, scan
+    conn = db.connect()
+    try:
+        setup_checkpoints(conn)
+        cur = conn.cursor()
+        if scan_id == None:
+            row = cur.execute("SELECT id, profile_id, query_type, query_string FROM scan WHERE profile_id = ? AND finished = 0 AND search_id IS NULL ORDER BY id DESC LIMIT 1;",
+                (get_selected_profile()[0],)).fetchone()
+        else:
+            row = cur.execute("SELECT id, profile_id, query_type, query_string FROM scan WHERE id = ?;", (scan_id,)).fetchone()
+        if row == None:
+            click.secho("No scan to resume. Use 'sparky query resume --list' to see the saved scans.", fg="red")
+            return
+        scan_id, profile_id, query_type, query_string = row
+        patterns = query_string.split("\n")
+        profile = get_profiles([str(profile_id)])[0]
+        pending = cur.execute("SELECT seq, tbl, fields, shard FROM scan_unit WHERE scan_id = ? AND done = 0 ORDER BY seq;", (scan_id,)).fetchall()
+        total = cur.execute("SELECT count(*) FROM scan_unit WHERE scan_id = ?;", (scan_id,)).fetchone()[0]
+        click.echo("[ Resuming " + query_type + " scan " + str(scan_id) + " for '" + "', '".join(patterns) + "' on " + click.style(profile[1], fg="green") + ": "
+            + click.style(str(len(pending)), fg="blue") + " of " + click.style(str(total), fg="blue") + " tables left ]")
+
+        if len(pending) > 0:
+            # whatever an unfinished unit found before the scan stopped is found again
+            cur.executemany("DELETE FROM scan_hit WHERE scan_id = ? AND seq = ?;", [(scan_id, seq) for seq, _, _, _ in pending])
+            conn.commit()
+            s, url = setup_connection(workers, profile)
+            units = [(table, fields.split(","), shard) for _, table, fields, shard in pending]
+            seqs = [seq for seq, _, _, _ in pending]
+            found = 0
+            try:
+                for _ in checkpointed(conn, scan_id, scan(s, url, units, patterns, workers, page_size, on_done=lambda n: mark_done(conn, scan_id, seqs[n])), seqs):
+                    found += 1
+            except ScanAborted as e:
+                conn.commit()
+                click.secho(str(e) + " Aborting.", fg="red")
+                resume_hint(scan_id)
+                sys.exit()
+            except requests.RequestException as e:
+                conn.commit()
+                click.secho("Lost the connection to the instance: " + str(e) + ". Aborting.", fg="red")
+                resume_hint(scan_id)
+                sys.exit()
+            except KeyboardInterrupt:
+                conn.commit()
+                click.secho("Scan interrupted.", fg="red")
+                resume_hint(scan_id)
+                sys.exit()
+            print_throttling(s)
+            click.echo("[ Found " + click.style(str(found), fg="blue") + " new results ]")
+
+        print_result_header(False, len(patterns) > 1)
+        for sys_id, table, field, name, pattern in cur.execute("SELECT sys_id, tbl, field, name, pattern FROM scan_hit WHERE scan_id = ? ORDER BY seq, rowid;", (scan_id,)).fetchall():
+            if output.sink != None:
+                print_result(sys_id, table, field, name, profile[1], pattern)
+            else:
+                print_result(sys_id, table, field, name, None, pattern if len(patterns) > 1 else None)
+        if finish_scan(conn, scan_id):
+            click.secho("Finished.", fg="bright_white", bold=True)
+        else:
+            resume_hint(scan_id)
+    finally:
+        conn.close()
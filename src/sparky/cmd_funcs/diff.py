@@ -0,0 +1,238 @@
+from typing import Dict, List, Tuple
+import click
+import difflib
+import hashlib
+import requests
+import sqlite3
+import sys
+from ..connection import db
+from ..connection.conn import get_profiles, setup_connection
+from ..connection.stream import OrderedStream
+from ..connection.table import DEFAULT_PAGE_SIZE, TableError, get_pages
+from .cache import DEFAULT_TTL, get_target_list
+from .query import get_list_from_file
+from .single_search import DEFAULT_CHUNK_SIZE
+from .sync import deleted_records, fetch_changes
+
+def setup_manifest(conn: sqlite3.Connection):
+    cur = conn.cursor()
+    cur.execute('''CREATE TABLE IF NOT EXISTS manifest (
+        profile_id int,
+        tbl text,
+        field text,
+        sys_id text,
+        name text,
+        updated_on text,
+        hash text,
+        primary key (profile_id, tbl, field, sys_id)
+    );''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS manifest_state (
+        profile_id int,
+        tbl text,
+        field text,
+        high_water text,
+        high_water_id text,
+        primary key (profile_id, tbl, field)
+    );''')
+    try:
+        cur.execute("ALTER TABLE manifest_state ADD COLUMN high_water_id text;")
+    except sqlite3.OperationalError: # already there
+        pass
+    conn.commit()
+
+def clear_manifest(profile_id: int):
+    """Forgets the manifest of a profile, so the next diff reads every record of it again."""
+    conn = db.connect()
+    try:
+        setup_manifest(conn)
+        conn.execute("DELETE FROM manifest WHERE profile_id = ?;", (profile_id,))
+        conn.execute("DELETE FROM manifest_state WHERE profile_id = ?;", (profile_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def normalize(value) -> str:
+    """Content as it is compared: line endings don't count as a difference."""
+    return str(value or "").replace("\r\n", "\n").replace("\r", "\n")
+
+def content_hash(value) -> str:
+    return hashlib.sha256(normalize(value).encode("utf-8")).hexdigest()
+
+def refresh_manifest(s: requests.Session, url: str, profile: Tuple[int, str, str, str], query_list: List[Tuple[str, str]], full: bool = False,
+        workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE) -> int:
+    """Brings the (table, field, sys_id) -> content hash manifest of a profile up to date, downloading only the records
+    updated since the last refresh (everything the first time, or with full). Only the hashes are kept. Records whose
+    field was emptied or that were deleted on the instance are dropped, the same way 'sparky sync' drops them.
+    Returns the number of records that were read."""
+    conn = db.connect()
+    try:
+        setup_manifest(conn)
+        cur = conn.cursor()
+        total = 0
+        refreshed = []
+        fresh = set()
+        with OrderedStream(workers) as stream:
+            for table, field in query_list:
+                if full:
+                    cur.execute("DELETE FROM manifest WHERE profile_id = ? AND tbl = ? AND field = ?;", (profile[0], table, field))
+                    cur.execute("DELETE FROM manifest_state WHERE profile_id = ? AND tbl = ? AND field = ?;", (profile[0], table, field))
+                    conn.commit()
+                hw = cur.execute("SELECT high_water, high_water_id FROM manifest_state WHERE profile_id = ? AND tbl = ? AND field = ?;", (profile[0], table, field)).fetchone()
+                if hw == None:
+                    fresh.add((table, field))
+                stream.submit((table, field), fetch_changes, s, url, table, field, None if hw == None else hw[0], None if hw == None else hw[1] or "", page_size)
+            # Only this thread writes to the database, the workers just download
+            for (table, field), pages in stream:
+                mark = None
+                try:
+                    for page in pages:
+                        for record in page:
+                            if normalize(record.get(field)) == "":
+                                cur.execute("DELETE FROM manifest WHERE profile_id = ? AND tbl = ? AND field = ? AND sys_id = ?;", (profile[0], table, field, record.get('sys_id')))
+                            else:
+                                cur.execute("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?);", (profile[0], table, field, record.get('sys_id'),
+                                    str(record.get('name') or record.get('sys_name') or record.get('u_name') or "").strip(), record.get('sys_updated_on'), content_hash(record.get(field))))
+                            if record.get('sys_updated_on'):
+                                mark = (record.get('sys_updated_on'), record.get('sys_id'))
+                            total += 1
+                except TableError as e:
+                    conn.commit()
+                    if e.status_code == 401:
+                        click.secho("Received status code 401 while reading table: " + table + ", field: " + field + " on " + profile[1] + ". Aborting.", fg="red")
+                        sys.exit()
+                    elif e.status_code != 403: # same as querying, skip tables we can't read
+                        click.secho("Could not read " + table + "." + field + " on " + profile[1] + " (status " + str(e.status_code) + ")"
+                            + ("" if e.message == None else ": " + e.message) + ". It will be read again next time.", fg="yellow")
+                    continue
+                if mark != None:
+                    cur.execute("INSERT OR REPLACE INTO manifest_state (profile_id, tbl, field, high_water, high_water_id) VALUES (?, ?, ?, ?, ?);",
+                        (profile[0], table, field) + mark)
+                conn.commit()
+                if (table, field) not in fresh:
+                    refreshed.append((table, field))
+
+        # a field read from scratch can't hold anything deleted
+        with OrderedStream(workers) as stream:
+            for table, field in refreshed:
+                known = set(row[0] for row in cur.execute("SELECT sys_id FROM manifest WHERE profile_id = ? AND tbl = ? AND field = ?;", (profile[0], table, field)))
+                stream.submit((table, field), lambda t, f, k: iter([deleted_records(s, url, t, f, k, page_size)]), table, field, known)
+            for (table, field), results in stream:
+                try:
+                    for sys_ids in results:
+                        cur.executemany("DELETE FROM manifest WHERE profile_id = ? AND tbl = ? AND field = ? AND sys_id = ?;", [(profile[0], table, field, i) for i in sys_ids])
+                except TableError: # checked again next time
+                    continue
+        conn.commit()
+        return total
+    finally:
+        conn.close()
+
+def load_manifest(profile_id: int, query_list: List[Tuple[str, str]]) -> Dict[Tuple[str, str, str], Tuple[str, str]]:
+    """Returns (table, field, sys_id) -> (hash, name) for the given table/field pairs of a profile's manifest."""
+    pairs = set(query_list)
+    conn = db.connect()
+    try:
+        setup_manifest(conn)
+        ret = {}
+        for table, field, sys_id, name, hash in conn.execute("SELECT tbl, field, sys_id, name, hash FROM manifest WHERE profile_id = ?;", (profile_id,)):
+            if (table, field) in pairs:
+                ret[(table, field, sys_id)] = (hash, name)
+        return ret
+    finally:
+        conn.close()
+
+def compare(a: dict, b: dict) -> Tuple[list, list, list]:
+    """Returns the keys only in a, only in b, and in both with different content, each sorted."""
+    only_a = sorted(set(a) - set(b))
+    only_b = sorted(set(b) - set(a))
+    changed = sorted(k for k in set(a) & set(b) if a[k][0] != b[k][0])
+    return only_a, only_b, changed
+
+def fetch_contents(s: requests.Session, url: str, keys: List[Tuple[str, str, str]], workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> Dict[Tuple[str, str, str], str]:
+    """Downloads the current content of just the given (table, field, sys_id) records, a chunk of sys_ids per request."""
+    by_table = {}
+    for table, field, sys_id in keys:
+        fields, sys_ids = by_table.setdefault(table, ([], []))
+        if field not in fields:
+            fields.append(field)
+        if sys_id not in sys_ids:
+            sys_ids.append(sys_id)
+    ret = {}
+    wanted = set(keys)
+    with OrderedStream(workers) as stream:
+        for table, (fields, sys_ids) in by_table.items():
+            for start in range(0, len(sys_ids), chunk_size):
+                stream.submit(table, get_pages, s, url, table, {"sysparm_fields": ",".join(["sys_id"] + fields),
+                    "sysparm_query": "sys_idIN" + ",".join(sys_ids[start:start + chunk_size])}, page_size)
+        for table, pages in stream:
+            for page in pages:
+                for record in page:
+                    for field in by_table[table][0]:
+                        if (table, field, record.get('sys_id')) in wanted:
+                            ret[(table, field, record.get('sys_id'))] = normalize(record.get(field))
+    return ret
+
+def print_diff(key: Tuple[str, str, str], old: str, new: str, old_label: str, new_label: str, context: int = 3):
+    table, field, sys_id = key
+    for line in difflib.unified_diff(old.split("\n"), new.split("\n"), old_label + ": " + table + "." + field + " " + sys_id,
+            new_label + ": " + table + "." + field + " " + sys_id, n=context, lineterm=""):
+        if line.startswith("+++") or line.startswith("---"):
+            click.secho(line, bold=True)
+        elif line.startswith("@@"):
+            click.secho(line, fg="cyan")
+        elif line.startswith("+"):
+            click.secho(line, fg="green")
+        elif line.startswith("-"):
+            click.secho(line, fg="red")
+        else:
+            click.echo(line)
+
+def diff_profiles(names: List[str], query_type: str, filename: str = None, full: bool = False, workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+        lines: bool = True, context: int = 3):
+    """Compares the script/html/xml fields of two profiles. Each side's manifest of content hashes is refreshed
+    incrementally and compared, and only the records that differ are downloaded again to show what changed."""
+    profiles = get_profiles(names)
+    if len(profiles) != 2:
+        click.secho("Give two different profiles to compare.", fg="red")
+        sys.exit()
+    file_list = None if filename == None else get_list_from_file(filename)
+    sessions = []
+    query_lists = []
+    for profile in profiles:
+        s, url = setup_connection(workers, profile)
+        query_list = file_list or get_target_list(s, url, profile[0], query_type, page_size, DEFAULT_TTL, full)
+        query_list = [(str(table).strip(), str(field).strip()) for table, field in query_list]
+        count = refresh_manifest(s, url, profile, query_list, full, workers, page_size)
+        click.echo("[ Read " + click.style(str(count), fg="blue") + " new or updated records of " + str(len(query_list)) + " fields on " + click.style(profile[1], fg="green") + " ]")
+        sessions.append((s, url))
+        query_lists.append(query_list)
+
+    # a field that only one side has counts as all of its records being only on that side
+    pairs = sorted(set(query_lists[0]) | set(query_lists[1]))
+    a = load_manifest(profiles[0][0], pairs)
+    b = load_manifest(profiles[1][0], pairs)
+    only_a, only_b, changed = compare(a, b)
+    click.echo("[ " + click.style(str(len(changed)), fg="blue") + " changed, " + click.style(str(len(only_a)), fg="blue") + " only on " + profiles[0][1] + ", "
+        + click.style(str(len(only_b)), fg="blue") + " only on " + profiles[1][1] + ", " + str(len(set(a) & set(b)) - len(changed)) + " the same ]")
+    if len(changed) + len(only_a) + len(only_b) == 0:
+        click.secho("Finished. No differences.", fg="bright_white", bold=True)
+        return
+
+    click.secho("{:<20} {:<35} {:<25} {:<25} {:<40}".format('Status', 'Sys ID', 'Table', 'Field', 'Name'), fg="bright_white", bold=True)
+    for status, keys, names_from in (("changed", changed, a), ("only on " + profiles[0][1], only_a, a), ("only on " + profiles[1][1], only_b, b)):
+        for table, field, sys_id in keys:
+            click.echo("{:<20} {:<35} {:<25} {:<25} {:<40}".format(status, sys_id, table, field, names_from[(table, field, sys_id)][1]))
+
+    if lines and len(changed) > 0:
+        click.echo()
+        try:
+            old = fetch_contents(sessions[0][0], sessions[0][1], changed, workers, page_size)
+            new = fetch_contents(sessions[1][0], sessions[1][1], changed, workers, page_size)
+        except TableError as e:
+            click.secho("Received status code " + str(e.status_code) + " while downloading the changed records. Aborting.", fg="red")
+            sys.exit()
+        for key in changed:
+            if key in old and key in new:
+                print_diff(key, old[key], new[key], profiles[0][1], profiles[1][1], context)
+    click.secho("Finished.", fg="bright_white", bold=True)
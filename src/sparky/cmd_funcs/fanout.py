@@ -0,0 +1,56 @@
+from typing import Any, Callable, Iterator, List, Tuple
+import click
+import queue
+import threading
+import time
+
+_DONE = object()
+
+def parse_profiles(profiles: str, all_profiles: bool) -> List[str]:
+    """Turns the --profiles/--all-profiles options into a list of profile names, an empty list meaning every profile.
+    Returns None when neither option was used, in which case only the selected profile is searched."""
+    if all_profiles:
+        return []
+    if profiles == None:
+        return None
+    return [p.strip() for p in profiles.split(",") if p.strip() != ""]
+
+def fan_out(profiles: List[Tuple[int, str, str, str]], fn: Callable[[Tuple[int, str, str, str]], Iterator[Any]]) -> Iterator[Tuple[Tuple[int, str, str, str], Any]]:
+    """Runs fn for every profile on its own thread and yields (profile, item) for each item the profiles produce, in
+    the order they arrive. Whatever a profile raises (including the SystemExit of a failed pre-flight check) only
+    stops that profile; it is recorded in the summary that is returned once every profile is done."""
+    q = queue.Queue(maxsize=1000)
+    summary = {}
+
+    def run(profile):
+        start = time.time()
+        hits = 0
+        status = "OK"
+        try:
+            for item in fn(profile):
+                hits += 1
+                q.put((profile, item))
+        except SystemExit:
+            status = "Failed"
+        except BaseException as e:
+            status = "Aborted: " + str(e)
+        summary[profile[0]] = (hits, time.time() - start, status)
+        q.put((profile, _DONE))
+
+    for profile in profiles:
+        threading.Thread(target=run, args=(profile,), daemon=True).start()
+    remaining = len(profiles)
+    while remaining > 0:
+        profile, item = q.get()
+        if item is _DONE:
+            remaining -= 1
+            continue
+        yield profile, item
+    print_summary(profiles, summary)
+
+def print_summary(profiles: List[Tuple[int, str, str, str]], summary: dict):
+    click.echo()
+    click.secho("{:<20} {:<10} {:<10} {:<50}".format('Instance', 'Hits', 'Time', 'Status'), fg="bright_white", bold=True)
+    for profile in profiles:
+        hits, elapsed, status = summary.get(profile[0], (0, 0, "Failed"))
+        click.echo("{:<20} {:<10} {:<10} {}".format(profile[1], hits, "{:.1f}s".format(elapsed), click.style(status, fg="green" if status == "OK" else "red")))
@@ -0,0 +1,126 @@
+from typing import List
+import abc
+import click
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+# The sink results go to while a command runs with --output jsonl/csv or --out, None when they are printed as usual.
+sink = None
+# stdout while a sink has taken it over
+_stdout = None
+
+FORMATS = ["table", "jsonl", "csv"]
+# Every row has these, in this order. Some results add their own columns after them.
+FIELDS = ["instance", "table", "field", "sys_id", "name", "pattern", "line", "text"]
+WIDTHS = {"instance": 20, "table": 25, "field": 25, "sys_id": 35, "name": 40, "pattern": 20, "line": 6}
+# Rows are written this many at a time, or as soon as a row comes in this long after the last write
+FLUSH_ROWS = 500
+FLUSH_SECONDS = 1.0
+FILE_BUFFER = 1024 * 1024
+
+class Sink(abc.ABC):
+    """Collects result rows and writes them in batches, so a scan with a huge number of hits isn't held up by a write
+    per row, while a slow scan still hands its rows downstream as it goes."""
+    def __init__(self, file, close_file: bool = False):
+        self.file = file
+        self.close_file = close_file
+        self.columns = None
+        self.rows = []
+        self.written = 0
+        self.flushed_on = time.time()
+
+    def write(self, row: dict):
+        if self.columns == None:
+            self.columns = FIELDS + [k for k in row if k not in FIELDS]
+        self.rows.append(row)
+        if len(self.rows) >= FLUSH_ROWS or time.time() - self.flushed_on >= FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) > 0:
+            try:
+                self.file.write(self.format(self.rows, self.written == 0))
+                self.file.flush()
+            except BrokenPipeError:
+                # whatever was reading the results (head, grep -m) has stopped, so there is no point in going on
+                # anything still buffered for it is dropped rather than failing again on the way out
+                self.rows = []
+                os.dup2(os.open(os.devnull, os.O_WRONLY), self.file.fileno())
+                sys.exit()
+            self.written += len(self.rows)
+            self.rows = []
+        self.flushed_on = time.time()
+
+    def close(self):
+        self.flush()
+        if self.close_file:
+            self.file.close()
+
+    @abc.abstractmethod
+    def format(self, rows: List[dict], first: bool) -> str:
+        """Returns the given rows as text, with a header first if the format has one."""
+
+class JsonlSink(Sink):
+    def format(self, rows: List[dict], first: bool) -> str:
+        return "".join(json.dumps(dict((k, row.get(k)) for k in self.columns), ensure_ascii=False) + "\n" for row in rows)
+
+class CsvSink(Sink):
+    def format(self, rows: List[dict], first: bool) -> str:
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, self.columns, extrasaction="ignore")
+        if first:
+            writer.writeheader()
+        writer.writerows(rows)
+        return buf.getvalue()
+
+class TableSink(Sink):
+    """The fixed-width table, for --out with the default output. Never styled, since it goes to a file."""
+    def format(self, rows: List[dict], first: bool) -> str:
+        lines = []
+        if first:
+            lines.append(self.line(dict((k, k.replace("_", " ").title().replace("Id", "ID")) for k in self.columns)))
+        for row in rows:
+            lines.append(self.line(row))
+        return "\n".join(lines) + "\n"
+
+    def line(self, row: dict) -> str:
+        return " ".join(("{:<" + str(WIDTHS.get(k, 35)) + "}").format("" if row.get(k) == None else str(row.get(k))) for k in self.columns).rstrip()
+
+def open_sink(output_format: str = "table", filename: str = None):
+    """Sets up where the results of the next command go. Tables on stdout are printed as they always were. jsonl and
+    csv on stdout take stdout over: everything else the command prints goes to stderr instead, so the results can be
+    piped straight into other tools."""
+    global sink, _stdout
+    close_sink()
+    if filename == None and output_format == "table":
+        return
+    if filename == None:
+        file = _stdout = sys.stdout
+        sys.stdout = sys.stderr
+    else:
+        try:
+            file = open(filename, "w", encoding="utf-8", newline="", buffering=FILE_BUFFER)
+        except OSError as e:
+            click.secho("Could not open " + filename + ": " + str(e), fg="red")
+            sys.exit()
+    sink = {"jsonl": JsonlSink, "csv": CsvSink}.get(output_format, TableSink)(file, filename != None)
+
+def flush():
+    """Writes out the rows collected so far, for commands that wait a long time between results."""
+    if sink != None:
+        sink.flush()
+
+def close_sink():
+    global sink, _stdout
+    if sink == None:
+        return
+    try:
+        sink.close()
+    finally:
+        if _stdout != None:
+            sys.stdout = _stdout
+        sink = _stdout = None
@@ -0,0 +1,178 @@
+from typing import Dict, List, Tuple
+import click
+import sqlite3
+import time
+import requests
+from ..connection import db
+from ..connection.stream import OrderedStream
+from ..connection.table import DEFAULT_PAGE_SIZE, TableError, count_by_class, count_records, get_records
+
+def group_by_table(query_list: List[Tuple[str, str]]) -> List[Tuple[str, List[str]]]:
+    """Collapses the (table, field) pairs of a query list into one (table, [fields]) unit per table, so that every
+    table is scanned with a single request. Tables keep the order they first appear in."""
+    units = []
+    fields_of = {}
+    for item in query_list:
+        table = str(item[0]).strip()
+        field = str(item[1]).strip()
+        if table not in fields_of:
+            fields_of[table] = []
+            units.append((table, fields_of[table]))
+        if field not in fields_of[table]:
+            fields_of[table].append(field)
+    return units
+
+def setup_table_info(conn: sqlite3.Connection):
+    cur = conn.cursor()
+    cur.execute('''CREATE TABLE IF NOT EXISTS table_info (
+        profile_id int,
+        name text,
+        super_class text,
+        row_count int,
+        counted_on real,
+        primary key (profile_id, name)
+    );''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS table_info_state (
+        profile_id int primary key,
+        fetched_on real
+    );''')
+    conn.commit()
+
+def get_hierarchy(s: requests.Session, url: str, profile_id: int, ttl: int, refresh: bool = False, page_size: int = DEFAULT_PAGE_SIZE) -> Dict[str, str]:
+    """Returns the parent of every table on the instance (an empty string for tables that don't extend anything),
+    read from sys_db_object and cached per profile for ttl minutes. Returns None if sys_db_object can't be read."""
+    conn = db.connect()
+    try:
+        setup_table_info(conn)
+        cur = conn.cursor()
+        state = cur.execute("SELECT fetched_on FROM table_info_state WHERE profile_id = ?;", (profile_id,)).fetchone()
+        if state != None and not refresh and time.time() - state[0] < ttl * 60:
+            return dict(cur.execute("SELECT name, super_class FROM table_info WHERE profile_id = ?;", (profile_id,)).fetchall())
+        try:
+            hierarchy = {}
+            for i in get_records(s, url, "sys_db_object", {"sysparm_fields": "name,super_class.name"}, page_size):
+                hierarchy[i.get('name')] = i.get('super_class.name') or ""
+        except TableError:
+            return None
+        # Row counts are only as fresh as the hierarchy they were taken with
+        cur.execute("DELETE FROM table_info WHERE profile_id = ?;", (profile_id,))
+        cur.executemany("INSERT INTO table_info (profile_id, name, super_class) VALUES (?, ?, ?);", [(profile_id, k, v) for k, v in hierarchy.items()])
+        cur.execute("INSERT OR REPLACE INTO table_info_state VALUES (?, ?);", (profile_id, time.time()))
+        conn.commit()
+        return hierarchy
+    finally:
+        conn.close()
+
+def ancestors(table: str, hierarchy: Dict[str, str]) -> List[str]:
+    """Returns the parent, grandparent and so on of a table."""
+    ret = []
+    parent = hierarchy.get(table)
+    while parent and parent not in ret:
+        ret.append(parent)
+        parent = hierarchy.get(parent)
+    return ret
+
+def get_row_counts(s: requests.Session, url: str, profile_id: int, tables: List[str], hierarchy: Dict[str, str], workers: int = 1) -> Dict[str, int]:
+    """Returns how many records each table holds right now, children included. Counts are taken with one grouped
+    Aggregate API request per table hierarchy rather than one request per table, and never reused from an earlier
+    run, since a table that was empty then may not be anymore. Tables that couldn't be counted are left out."""
+    conn = db.connect()
+    try:
+        setup_table_info(conn)
+        cur = conn.cursor()
+        counts = {}
+        tables = list(dict((t, None) for t in tables))
+        if len(tables) == 0:
+            return counts
+
+        roots = []
+        for table in tables:
+            chain = ancestors(table, hierarchy)
+            root = chain[-1] if len(chain) > 0 else table
+            if root not in roots:
+                roots.append(root)
+        extended = set(hierarchy.values())
+        with OrderedStream(workers) as stream:
+            for root in roots:
+                if root in extended:
+                    stream.submit(root, lambda r: iter([count_by_class(s, url, r)]), root)
+                else:
+                    stream.submit(root, lambda r: iter([{r: count_records(s, url, r)}]), root)
+            for root, results in stream:
+                try:
+                    for by_class in results:
+                        for table in tables:
+                            if table != root and root not in ancestors(table, hierarchy):
+                                continue
+                            # a table holds its own records plus those of every class extending it
+                            counts[table] = sum(n for c, n in by_class.items() if c == table or table in ancestors(c, hierarchy))
+                            cur.execute("INSERT OR REPLACE INTO table_info VALUES (?, ?, ?, ?, ?);", (profile_id, table, hierarchy.get(table, ""), counts[table], time.time()))
+                except TableError:
+                    continue
+        conn.commit()
+        return counts
+    finally:
+        conn.close()
+
+def plan_scan(s: requests.Session, url: str, profile_id: int, query_list: List[Tuple[str, str]], workers: int = 1, ttl: int = 0,
+        refresh: bool = False, page_size: int = DEFAULT_PAGE_SIZE) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str, str]]]:
+    """Removes the entries of a query list that can't add anything to a scan. Querying a table also returns the records
+    of every table extending it, so an entry is dropped when the same field is already scanned on one of its parent
+    tables, and tables holding no records at all (counted again on every run) are dropped as well.
+    Returns the entries left to scan and the (table, field, reason) of every entry that was dropped."""
+    pairs = []
+    for item in query_list:
+        pair = (str(item[0]).strip(), str(item[1]).strip())
+        if pair not in pairs:
+            pairs.append(pair)
+    hierarchy = get_hierarchy(s, url, profile_id, ttl, refresh, page_size)
+    if hierarchy == None:
+        click.secho("Could not read the table hierarchy from sys_db_object, scanning every table.", fg="yellow")
+        return pairs, []
+
+    keep = []
+    skipped = []
+    wanted = set(pairs)
+    for table, field in pairs:
+        covered_by = [a for a in ancestors(table, hierarchy) if (a, field) in wanted]
+        if len(covered_by) > 0:
+            skipped.append((table, field, "covered by " + covered_by[-1]))
+        else:
+            keep.append((table, field))
+
+    counts = get_row_counts(s, url, profile_id, [t for t, _ in keep], hierarchy, workers)
+    ret = []
+    for table, field in keep:
+        if counts.get(table) == 0:
+            skipped.append((table, field, "empty"))
+        else:
+            ret.append((table, field))
+    return ret, skipped
+
+def print_plan(query_list: List[Tuple[str, str]], skipped: List[Tuple[str, str, str]]):
+    click.secho("{:<40} {:<40} {:<40}".format('Table', 'Fields', 'Plan'), fg="bright_white", bold=True)
+    for table, fields in group_by_table(query_list):
+        click.echo("{:<40} {:<40} {}".format(table, ",".join(fields), click.style("scan", fg="green")))
+    for table, field, reason in skipped:
+        click.echo("{:<40} {:<40} {}".format(table, field, click.style("skip (" + reason + ")", fg="yellow")))
+    click.echo("[ " + click.style(str(len(group_by_table(query_list))), fg="blue") + " requests, " + click.style(str(len(skipped)), fg="blue") + " entries skipped ]")
+
+def clear_table_info(profile_id: int):
+    """Forgets the cached table hierarchy and row counts of a profile."""
+    conn = db.connect()
+    try:
+        setup_table_info(conn)
+        conn.execute("DELETE FROM table_info WHERE profile_id = ?;", (profile_id,))
+        conn.execute("DELETE FROM table_info_state WHERE profile_id = ?;", (profile_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def table_sizes(profile_id: int) -> Dict[str, int]:
+    """Returns the row counts (children included) cached by the last scan plan of a profile."""
+    conn = db.connect()
+    try:
+        setup_table_info(conn)
+        return dict(conn.execute("SELECT name, row_count FROM table_info WHERE profile_id = ? AND row_count IS NOT NULL;", (profile_id,)).fetchall())
+    finally:
+        conn.close()
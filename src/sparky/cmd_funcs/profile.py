@@ -1,10 +1,12 @@
 import getpass
 import click
 import sqlite3
-import keyring
 from pathlib import Path
 import os
 
+# Bump whenever the tables created at startup change, so the schema is only checked when it could be out of date
+SCHEMA_VERSION = 2
+
 def startup_profile():
     import sys
     try:
@@ -21,12 +23,21 @@ def startup_profile():
             sys.exit()
     try:
         cur = conn.cursor()
+        if cur.execute("PRAGMA user_version;").fetchone()[0] >= SCHEMA_VERSION:
+            return
         cur.execute('''CREATE TABLE IF NOT EXISTS profile (
             profile_name text,
             url text,
             user text,
             selected int
         );''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS preflight (
+            profile_id int primary key,
+            url text,
+            user text,
+            checked_on real
+        );''')
+        cur.execute("PRAGMA user_version = " + str(SCHEMA_VERSION) + ";")
         conn.commit()
     except:
         click.secho("Error connecting to profile. Please check the sparky database or recreate if you are having issues.", fg="red")
@@ -35,6 +46,7 @@ def startup_profile():
         conn.close()
 
 def new_profile():
+    import keyring
     click.echo("\nEnter a profile name")
     pn = input(click.style(">> ", fg="bright_white", bold=True))
     click.echo("Enter a URL")
@@ -81,6 +93,7 @@ def list_profiles():
     return profs
 
 def delete_profile():
+    import keyring
     profiles = list_profiles()
     if len(profiles) > 0:
         click.echo("\nEnter the Row ID to delete")
@@ -109,6 +122,18 @@ def delete_profile():
         if del_resp.rowcount == 0:
             click.echo("Could not find row " + str(rowid) + " to delete")
         else:
+            from .cache import clear_target_cache
+            from .planner import clear_table_info
+            from .checkpoint import clear_scans
+            from .watch import clear_watch
+            from .diff import clear_manifest
+            from ..connection.conn import clear_preflight
+            clear_target_cache(int(rowid))
+            clear_table_info(int(rowid))
+            clear_scans(int(rowid))
+            clear_watch(int(rowid))
+            clear_manifest(int(rowid))
+            clear_preflight(int(rowid))
             click.echo("Profile deleted.")
     except Exception as e:
         click.secho("Error deleting profile with rowid " + rowid + ": " + str(e), fg="red")
@@ -116,6 +141,7 @@ def delete_profile():
         conn.close()
 
 def edit_profile():
+    import keyring
     profiles = list_profiles()
     if len(profiles) > 0:
         click.echo("\nEnter the Row ID to edit")
@@ -167,6 +193,19 @@ def edit_profile():
             pass
         cur.execute("""UPDATE profile SET profile_name = ?, url = ?, user = ?, selected = ? WHERE rowid = ?;""", (edit_profile_name, edit_url, edit_user, selected, rowid) )
         conn.commit()
+        # the credentials may have changed, so check them again on the next connection
+        from ..connection.conn import clear_preflight
+        clear_preflight(int(rowid))
+        if edit_url != url or edit_user != user:
+            # the cached table lists may belong to a different instance (or be visible to a different user) now
+            from .cache import clear_target_cache
+            from .planner import clear_table_info
+            from .watch import clear_watch
+            from .diff import clear_manifest
+            clear_target_cache(int(rowid))
+            clear_table_info(int(rowid))
+            clear_watch(int(rowid), False)
+            clear_manifest(int(rowid))
 
     except Exception as e:
         click.secho("Error editing profile with rowid " + rowid + ": " + str(e), fg="red")
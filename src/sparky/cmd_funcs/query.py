@@ -1,28 +1,40 @@
-from typing import List, Tuple
+from typing import Callable, Dict, Iterator, List, Tuple
 import click
-import os, sys
+import os, re, sys
 import requests
+import sqlite3
 from urllib.parse import quote
-from ..connection.conn import setup_connection
+from ..connection import db
+from ..connection.conn import get_profiles, get_selected_profile, setup_connection
+from ..connection.scheduler import DEFAULT_MAX_RETRIES
+from ..connection.stream import OrderedStream
+from ..connection.table import DEFAULT_PAGE_SIZE, TableError, count_records, get_pages, get_records
+from . import output
+from .cache import DEFAULT_TTL, get_target_list
+from .checkpoint import checkpointed, finish_scan, mark_done, resume_hint, start_scan
+from .fanout import fan_out, parse_profiles
+from .planner import group_by_table, plan_scan, print_plan, table_sizes
 
-def get_full_query_list(s: requests.Session, url: str, query_type: str) -> List[Tuple[str, str]]:
-    """Queries for the entire list of tables with the corresponding """
-    sd_query = "internal_type=script_plain^ORinternal_type=script_server^ORinternal_type=script^active=true"
+def dictionary_query(query_type: str) -> str:
+    """Returns the sys_dictionary query that finds every field of the given type."""
     if query_type == "xml":
-        sd_query = "internal_type=xml^active=true"
+        return "internal_type=xml^active=true"
     elif query_type == "html":
-        sd_query = "internal_type=html^ORinternal_type=html_script^ORinternal_type=html_template^active=true"
+        return "internal_type=html^ORinternal_type=html_script^ORinternal_type=html_template^active=true"
+    return "internal_type=script_plain^ORinternal_type=script_server^ORinternal_type=script^active=true"
+
+def get_full_query_list(s: requests.Session, url: str, query_type: str, page_size: int = DEFAULT_PAGE_SIZE) -> List[Tuple[str, str]]:
+    """Queries for the entire list of tables with the corresponding """
+    sd_query = dictionary_query(query_type)
 
     # on sys_dictionary, name is the table name and element is the field name
-    resp = s.get(url + "/api/now/table/sys_dictionary", params={"sysparm_fields": "name,element", "sysparm_query": sd_query})
-    if resp.status_code != 200:
-        click.secho("Received status code " + str(resp.status_code) + " while retrieving list of " + query_type + " tables to query. Aborting.", fg="red")
-        sys.exit()
-    resp_json = resp.json()
     ret = []
-    if resp_json['result'] != None:
-        for i in resp_json['result']:
+    try:
+        for i in get_records(s, url, "sys_dictionary", {"sysparm_fields": "name,element", "sysparm_query": sd_query}, page_size):
             ret.append((i['name'], i['element']))
+    except TableError as e:
+        click.secho("Received status code " + str(e.status_code) + " while retrieving list of " + query_type + " tables to query. Aborting.", fg="red")
+        sys.exit()
     return ret
 
 def get_list_from_file(filename: str) -> List[Tuple[str, str]]:
@@ -45,93 +57,542 @@ def get_list_from_file(filename: str) -> List[Tuple[str, str]]:
         sys.exit()
     return ret
 
-def generic_lookup(s: requests.Session, url: str, query_list: List[Tuple[str, str]], query_string: str):
-    click.echo("[ Found " + click.style(str(len(query_list)), fg="blue") + " entries to scan ]")
-    click.echo(click.style("{:<35} {:<25} {:<25} {:<50}".format('Sys ID', 'Table', 'Field', 'Name'), fg="bright_white", bold=True) )
-    for item in query_list:
-        table = str(item[0]).strip()
-        field = str(item[1]).strip()
-        resp = s.get(url + "/api/now/table/" + table, params={"sysparm_fields":"sys_id,name,u_name,sys_name", "sysparm_query": field + "LIKE" + quote(query_string)})
-        if resp.status_code == 401 or resp.status_code == 500 or resp.status_code == 429:
-            click.secho("Received status code " + str(resp.status_code) + " while retrieving data for table: " + table + ", field: " + field + ". Aborting.", fg="red")
+DEFAULT_CHUNK_SIZE = 100
+
+# Statuses that mean the instance was too busy rather than that the table can't be queried
+RETRY_LATER = (429, 500, 502, 503, 504)
+DEFAULT_SHARD_SIZE = 50000
+MAX_SHARDS = 32
+
+class ScanAborted(Exception):
+    """Raised when a status code means the rest of a scan can't succeed either."""
+
+def print_result_header(instance: bool = False, pattern: bool = False):
+    if output.sink != None:
+        return
+    header = "{:<35} {:<25} {:<25} {:<50}".format('Sys ID', 'Table', 'Field', 'Name')
+    if instance:
+        header = "{:<20} ".format('Instance') + header
+    if pattern:
+        header += " Pattern"
+    click.echo(click.style(header, fg="bright_white", bold=True) )
+
+def print_result(sys_id: str, table: str, field: str, name: str, instance: str = None, pattern: str = None):
+    if output.sink != None:
+        output.sink.write({"instance": instance, "table": table, "field": field, "sys_id": sys_id, "name": name, "pattern": pattern})
+        return
+    line = "{:<35} {:<25} {:<25} {:<50}".format(sys_id, table, field, name)
+    if instance != None:
+        line = "{:<20} ".format(instance) + line
+    if pattern != None:
+        line += " " + click.style(pattern, fg="blue")
+    click.echo(line)
+
+def get_patterns(patterns: List[str] = None, patterns_file: str = None) -> List[str]:
+    """Returns the patterns given on the command line and in the patterns file (one per line), or asks for a single
+    one if there are none."""
+    ret = [p for p in patterns or [] if p != ""]
+    if patterns_file != None:
+        try:
+            with open(patterns_file, 'r') as file:
+                ret += [line.strip() for line in file.read().splitlines() if line.strip() != ""]
+        except Exception as e:
+            click.secho("Could not open " + patterns_file + ": " + str(e), fg="red")
             sys.exit()
-        elif resp.status_code == 403: # sometimes we don't have access to query a table. Let's just skip these.
-            continue
+    if len(ret) == 0:
+        click.echo("Input query string for lookup")
+        ret = [input(click.style(">> ", fg="bright_white", bold=True))]
+    # keep the first of any duplicates so results aren't reported twice
+    return list(dict((p, None) for p in ret))
+
+def context_printer(patterns: List[str], context: int = None, regex: bool = False, ignore_case: bool = True) -> Callable[[str, str, dict, str], None]:
+    """Returns a function printing the lines of a result's field that matched, with context lines around them, or a
+    function printing nothing if context is None. Each pattern is compiled once, the way the scan matched it:
+    literally and ignoring case like LIKE does unless told otherwise."""
+    if context == None:
+        return lambda table, field, record, pattern: None
+    from .single_search import print_context
+    fragments = pattern_fragments(patterns, regex, ignore_case)
+
+    def print_record(table: str, field: str, record: dict, pattern: str):
+        for f in field.split(","):
+            if record.get(f) != None:
+                print_context(table + "." + f, fragments.get(pattern, fragments[""]), record.get(f), context)
+    return print_record
+
+def pattern_fragments(patterns: List[str], regex: bool = False, ignore_case: bool = True) -> dict:
+    from .single_search import compile_fragments
+    flags = re.IGNORECASE if ignore_case else 0
+    fragments = dict((p, compile_fragments([p if regex else re.escape(p)], flags)) for p in patterns)
+    # hits we couldn't attribute to a single pattern show every pattern's matches
+    fragments[""] = compile_fragments([p if regex else re.escape(p) for p in patterns], flags)
+    return fragments
+
+def hit_printer(patterns: List[str], context: int = None, regex: bool = False, ignore_case: bool = True) -> Callable[[str, str, dict, str, str, str], None]:
+    """Returns a function printing a hit as a result line, followed by its matching lines if context is set. When the
+    results go to an output sink it writes the hit as a row instead, with the first line of the field that matched."""
+    if output.sink == None:
+        print_context = context_printer(patterns, context, regex, ignore_case)
+
+        def print_hit(table: str, field: str, record: dict, name: str, pattern: str, instance: str = None):
+            print_result(record.get('sys_id'), table, field, name, instance, pattern if len(patterns) > 1 else None)
+            print_context(table, field, record, pattern)
+        return print_hit
+    from .single_search import first_line
+    fragments = pattern_fragments(patterns, regex, ignore_case)
+
+    def write_hit(table: str, field: str, record: dict, name: str, pattern: str, instance: str = None):
+        line, text = None, None
+        for f in field.split(","):
+            if record.get(f) != None:
+                line, text = first_line(fragments.get(pattern, fragments[""]), record.get(f))
+                if line != None:
+                    field = f
+                    break
+        output.sink.write({"instance": instance, "table": table, "field": field, "sys_id": record.get('sys_id'), "name": name,
+            "pattern": pattern or None, "line": line, "text": text})
+    return write_hit
+
+def record_name(record: dict) -> str:
+    return str(record.get('name') or record.get('sys_name') or record.get('u_name')).strip()
+
+def warn(message: str):
+    click.secho(message, fg="yellow")
+
+def lookup_table(s: requests.Session, url: str, table: str, fields: List[str], patterns: List[str], page_size: int = DEFAULT_PAGE_SIZE,
+        shard: str = "", offset: int = 0) -> Iterator[List[dict]]:
+    """Yields the records of a table where any of the given fields match any of the patterns, one page at a time. The
+    fields themselves are returned too so each hit can be attributed to the right column. A shard query from
+    shard_queries limits the lookup to part of the table, and offset skips that many of its records.
+    Raises a TableError if the table can't be queried."""
+    query = match_query(fields, patterns) + ("^" + shard if shard != "" else "")
+    return get_pages(s, url, table, {"sysparm_fields": ",".join(["sys_id", "name", "u_name", "sys_name"] + fields), "sysparm_query": query},
+        page_size, offset)
+
+def shard_queries(size: int, shard_size: int = DEFAULT_SHARD_SIZE) -> List[str]:
+    """Splits a table of the given size into sys_id ranges of roughly shard_size records each, returning the query
+    for every range in sys_id order. sys_ids are random hex, so even ranges of their leading digits hold about as
+    many records each. Returns a single empty query if the table isn't worth splitting."""
+    if shard_size <= 0 or size <= shard_size:
+        return [""]
+    n = min(MAX_SHARDS, -(-size // shard_size))
+    bounds = ["{:02x}".format(256 * k // n) for k in range(1, n)]
+    ret = []
+    for k in range(n):
+        # the first and last ranges are left open so no sys_id can fall outside all of them
+        parts = []
+        if k > 0:
+            parts.append("sys_id>=" + bounds[k - 1])
+        if k < n - 1:
+            parts.append("sys_id<" + bounds[k])
+        ret.append("^".join(parts))
+    return ret
+
+def match_query(fields: List[str], patterns: List[str]) -> str:
+    """Returns the encoded query matching records where any of the fields contain any of the patterns, so that a
+    table is searched for every pattern with a single request."""
+    return "^OR".join(field + "LIKE" + quote(pattern) for pattern in patterns for field in fields)
+
+def matched_fields(record: dict, fields: List[str], patterns: List[str]) -> List[Tuple[str, str]]:
+    """Returns (field, pattern) for every field of a record that contains one of the patterns, case-insensitively
+    like LIKE does. If the instance matched on something we can't see here, every field is returned together so
+    the hit isn't lost."""
+    terms = [(pattern, pattern.lower()) for pattern in patterns]
+    found = []
+    for field in fields:
+        value = str(record.get(field) or "").lower()
+        for pattern, term in terms:
+            if term in value:
+                found.append((field, pattern))
+    if len(found) == 0:
+        return [(",".join(fields), patterns[0] if len(patterns) == 1 else "")]
+    return found
+
+def check_table_error(e: TableError, description: str, on_warning: Callable[[str], None]):
+    """Applies the usual handling for a table that failed for a reason retrying won't fix."""
+    if e.status_code == 401:
+        raise ScanAborted("Received status code " + str(e.status_code) + " while retrieving data for " + description + ".")
+    elif e.status_code == 403: # sometimes we don't have access to query a table. Let's just skip these.
+        return
+    elif e.message != None: # This could hit if the user fat-fingered a custom query list.
+        on_warning("Error while querying: " + e.message)
+
+def scan_units(query_list: List[Tuple[str, str]], sizes: Dict[str, int] = None, shard_size: int = DEFAULT_SHARD_SIZE,
+        filters: Dict[str, str] = None) -> List[Tuple[str, List[str], str]]:
+    """Returns the (table, fields, shard) units a scan of the query list is made of: one per table, or one per sys_id
+    range for tables that sizes lists with more than shard_size records. filters adds an encoded query per table to
+    every unit of it."""
+    units = []
+    for table, fields in group_by_table(query_list):
+        extra = (filters or {}).get(table, "")
+        for shard in shard_queries((sizes or {}).get(table, 0), shard_size):
+            units.append((table, fields, "^".join(q for q in (extra, shard) if q != "")))
+    return units
+
+def scan_tables(s: requests.Session, url: str, query_list: List[Tuple[str, str]], patterns: List[str], workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+        on_warning: Callable[[str], None] = warn, sizes: Dict[str, int] = None, shard_size: int = DEFAULT_SHARD_SIZE) -> Iterator[Tuple[str, str, dict, str]]:
+    """Yields (table, field, record, pattern) for every match, in the order of the query list, while later pages and
+    tables are still downloading. All the fields of a table are searched for every pattern with a single request.
+    Tables that sizes lists with more than shard_size records are split into sys_id ranges fetched in parallel. The
+    ranges don't overlap and are yielded in sys_id order, so the results are the same as for an unsplit table."""
+    for _, table, field, i, pattern in scan(s, url, scan_units(query_list, sizes, shard_size), patterns, workers, page_size, on_warning):
+        yield table, field, i, pattern
+
+def scan(s: requests.Session, url: str, units: List[Tuple[str, List[str], str]], patterns: List[str], workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+        on_warning: Callable[[str], None] = warn, on_done: Callable[[int], None] = None) -> Iterator[Tuple[int, str, str, dict, str]]:
+    """Yields (unit index, table, field, record, pattern) for every match of the given scan units, in order, while later units
+    are still downloading. Tables we can't read are skipped and other per-table errors are passed to on_warning.
+    on_done is called with the index of every unit once all of its matches have been yielded (or it was skipped).
+    Units that are still throttled or failing after the session's own retries are queued and tried once more at
+    the end of the scan, carrying on from the last record they returned.
+    Raises ScanAborted on a status code that would fail every other table too."""
+    retry_queue = []
+    with OrderedStream(workers) as stream:
+        for n, (table, fields, shard) in enumerate(units):
+            stream.submit(n, lookup_table, s, url, table, fields, patterns, page_size, shard)
+        for n, pages in stream:
+            table, fields, shard = units[n]
+            done = 0
+            try:
+                for page in pages:
+                    for i in page:
+                        done += 1
+                        for field, pattern in matched_fields(i, fields, patterns):
+                            yield n, table, field, i, pattern
+            except TableError as e:
+                if e.status_code in RETRY_LATER:
+                    retry_queue.append((n, done))
+                    continue
+                check_table_error(e, "table: " + table + ", fields: " + ",".join(fields), on_warning)
+            if on_done != None:
+                on_done(n)
+
+    failed = []
+    if len(retry_queue) > 0:
+        on_warning("Retrying " + str(len(retry_queue)) + " tables that were throttled or failed.")
+    for n, done in retry_queue:
+        table, fields, shard = units[n]
         try:
-            resp_json = resp.json()
-            if resp_json.get('result') != None:
-                for i in resp_json['result']:
-                    click.echo("{:<35} {:<25} {:<25} {:<50}".format(i.get('sys_id'), table, field, str(i.get('name') or i.get('sys_name') or i.get('u_name')).strip() ))
-            elif resp.json.get('error') != None:
-                click.secho("Error while querying: " + str(resp_json['error']), fg="yellow")
-        except: # This could hit if the user fat-fingered a custom query list.
-            if resp_json.get('error') != None:
-                click.secho("Error while querying: " + str(resp_json['error']), fg="yellow")
+            # pages are ordered by sys_id, so starting after what was already returned picks up where the table left off
+            for page in lookup_table(s, url, table, fields, patterns, page_size, shard, done):
+                for i in page:
+                    for field, pattern in matched_fields(i, fields, patterns):
+                        yield n, table, field, i, pattern
+        except TableError as e:
+            if e.status_code in RETRY_LATER:
+                if table + " (" + str(e.status_code) + ")" not in failed:
+                    failed.append(table + " (" + str(e.status_code) + ")")
+                continue
+            check_table_error(e, "table: " + table + ", fields: " + ",".join(fields), on_warning)
+        if on_done != None:
+            on_done(n)
+    if len(failed) > 0:
+        on_warning("Could not scan " + str(len(failed)) + " tables after retrying: " + ", ".join(failed))
+
+def count_matches(s: requests.Session, url: str, query_list: List[Tuple[str, str]], patterns: List[str], workers: int = 1,
+        on_warning: Callable[[str], None] = warn) -> Dict[str, int]:
+    """Counts the matching records of every table in the query list with the Aggregate API, which is much cheaper for
+    the instance than building the result set. Tables that couldn't be counted are left out so they still get scanned.
+    Raises ScanAborted on a status code that would fail every other table too."""
+    counts = {}
+    with OrderedStream(workers) as stream:
+        for table, fields in group_by_table(query_list):
+            stream.submit(table, lambda t, f: iter([count_records(s, url, t, match_query(f, patterns))]), table, fields)
+        for table, results in stream:
+            try:
+                for n in results:
+                    counts[table] = n
+            except TableError as e:
+                if e.status_code == 401:
+                    check_table_error(e, "table: " + table, on_warning)
+                elif e.status_code == 403: # can't be read, the scan would skip it anyway
+                    counts[table] = 0
+    return counts
+
+def precount(s: requests.Session, url: str, query_list: List[Tuple[str, str]], patterns: List[str], workers: int = 1, instance: str = None,
+        on_warning: Callable[[str], None] = warn) -> List[Tuple[str, str]]:
+    """Returns the entries of the query list whose table has at least one match (or couldn't be counted), printing
+    how many matches there are up front."""
+    counts = count_matches(s, url, query_list, patterns, workers, on_warning)
+    ret = [(table, field) for table, field in query_list if counts.get(str(table).strip()) != 0]
+    hits = [n for n in counts.values() if n > 0]
+    line = "[ Counted " + click.style(str(sum(hits)), fg="blue") + " matching records in " + click.style(str(len(hits)), fg="blue") + " tables"
+    uncounted = len(group_by_table(query_list)) - len(counts)
+    if uncounted > 0:
+        line += ", " + click.style(str(uncounted), fg="blue") + " tables could not be counted"
+    if instance != None:
+        line += " on " + instance
+    click.echo(line + " ]")
+    return ret
+
+def print_scan_size(query_list: List[Tuple[str, str]], instance: str = None):
+    line = "[ Found " + click.style(str(len(query_list)), fg="blue") + " entries to scan across " + click.style(str(len(group_by_table(query_list))), fg="blue") + " tables"
+    if instance != None:
+        line += " on " + instance
+    click.echo(line + " ]")
+
+def generic_lookup(s: requests.Session, url: str, query_list: List[Tuple[str, str]], patterns: List[str], workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+        count_first: bool = False, sizes: Dict[str, int] = None, shard_size: int = DEFAULT_SHARD_SIZE, profile_id: int = None, query_type: str = None,
+        context: int = None, filters: Dict[str, str] = None, search_id: int = None) -> int:
+    """Scans the query list and prints every match. The scan is checkpointed in sparky.db as it goes, so that if it
+    stops for any reason 'sparky query resume' can finish it without starting over. filters limits the records
+    scanned per table (see scan_units), and search_id marks the scan as a check of that saved search. Returns the ID
+    of the saved scan. Raises ScanAborted once progress is saved if the scan can't go on."""
+    print_scan_size(query_list)
+    print_hit = hit_printer(patterns, context)
+    instance = None if output.sink == None or profile_id == None else get_profiles([str(profile_id)])[0][1]
+    conn = db.connect()
+    scan_id = None
+    try:
+        if count_first:
+            query_list = precount(s, url, query_list, patterns, workers)
+        units = scan_units(query_list, sizes, shard_size, filters)
+        scan_id = start_scan(conn, profile_id, query_type, patterns, units, search_id)
+        print_result_header(False, len(patterns) > 1)
+        matches = scan(s, url, units, patterns, workers, page_size, on_done=lambda n: mark_done(conn, scan_id, n))
+        for table, field, i, pattern in checkpointed(conn, scan_id, matches):
+            print_hit(table, field, i, record_name(i), pattern, instance)
+    except ScanAborted as e:
+        click.secho(str(e) + " Aborting.", fg="red")
+        stop_scan(conn, scan_id, search_id)
+        raise
+    except requests.RequestException as e:
+        # out of retries, most likely because the network or VPN went away
+        click.secho("Lost the connection to the instance: " + str(e) + ". Aborting.", fg="red")
+        stop_scan(conn, scan_id, search_id)
+        raise ScanAborted("Lost the connection to the instance: " + str(e) + ".")
+    except KeyboardInterrupt:
+        click.secho("Scan interrupted.", fg="red")
+        stop_scan(conn, scan_id, search_id)
+        sys.exit()
+    print_throttling(s)
+    if not finish_scan(conn, scan_id) and search_id == None:
+        resume_hint(scan_id)
+    conn.close()
+    click.secho("Finished.", fg="bright_white", bold=True)
+    return scan_id
+
+def stop_scan(conn: sqlite3.Connection, scan_id: int, search_id: int = None):
+    """Saves the progress of a scan that is stopping early. Checks of saved searches pick up on their next run instead
+    of being resumed."""
+    if scan_id != None:
+        conn.commit()
+        if search_id == None:
+            resume_hint(scan_id)
+    conn.close()
+
+def print_throttling(s: requests.Session):
+    """Lets the user know if the instance pushed back during the scan, and what the scan slowed down to."""
+    scheduler = getattr(s, "scheduler", None)
+    if scheduler != None and scheduler.throttled > 0:
+        click.secho("The instance throttled " + str(scheduler.throttled) + " requests (" + str(scheduler.retried) + " retries). Settled at "
+            + "{:.1f}".format(scheduler.rate or scheduler.throughput()) + " requests/sec with " + str(int(scheduler.limit)) + " in flight.", dim=True)
+
+def multi_lookup(profiles: List[Tuple[int, str, str, str]], query_type: str, filename: str, patterns: List[str], workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+        cache_ttl: int = DEFAULT_TTL, refresh_tables: bool = False, batch_size: int = 0, rate: float = 0, max_retries: int = DEFAULT_MAX_RETRIES, plan: bool = True,
+        count_first: bool = False, shard_size: int = DEFAULT_SHARD_SIZE, context: int = None):
+    """Scans every profile at the same time, printing the merged results tagged with the instance they came from."""
+    file_list = None if filename == None else get_list_from_file(filename)
+
+    def scan_profile(profile):
+        s, url = setup_connection(workers, profile, batch_size, rate, max_retries)
+        query_list = file_list or get_target_list(s, url, profile[0], query_type, page_size, cache_ttl, refresh_tables)
+        if plan:
+            query_list, skipped = plan_scan(s, url, profile[0], query_list, workers, cache_ttl, refresh_tables, page_size)
+            print_skipped(skipped, profile[1])
+        print_scan_size(query_list, profile[1])
+        if count_first:
+            query_list = precount(s, url, query_list, patterns, scan_workers(workers, batch_size), profile[1], lambda m: warn(profile[1] + ": " + m))
+        return scan_tables(s, url, query_list, patterns, scan_workers(workers, batch_size), page_size, lambda m: warn(profile[1] + ": " + m),
+            table_sizes(profile[0]) if plan else None, shard_size)
+
+    print_hit = hit_printer(patterns, context)
+    print_result_header(True, len(patterns) > 1)
+    for profile, (table, field, i, pattern) in fan_out(profiles, scan_profile):
+        print_hit(table, field, i, record_name(i), pattern, profile[1])
     click.secho("Finished.", fg="bright_white", bold=True)
 
-def run_query(query_type: str, filename: str):
-    click.echo("Input query string for lookup")
-    query_string = input(click.style(">> ", fg="bright_white", bold=True))
-    s, url = setup_connection()
+def print_skipped(skipped: List[Tuple[str, str, str]], instance: str = None):
+    if len(skipped) > 0:
+        click.secho("Skipping " + str(len(skipped)) + " entries that are covered by a parent table or have no records" + ("" if instance == None else " on " + instance)
+            + ". (use --explain to see the plan)", dim=True)
+
+def explain_query(profiles: List[Tuple[int, str, str, str]], query_type: str, filename: str, workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+        cache_ttl: int = DEFAULT_TTL, refresh_tables: bool = False):
+    """Prints what a scan of each profile would query and what it would skip, without running it."""
+    for profile in profiles:
+        s, url = setup_connection(workers, profile)
+        query_list = get_list_from_file(filename) if filename != None else get_target_list(s, url, profile[0], query_type, page_size, cache_ttl, refresh_tables)
+        query_list, skipped = plan_scan(s, url, profile[0], query_list, workers, cache_ttl, refresh_tables, page_size)
+        if len(profiles) > 1:
+            click.echo("Scan plan for " + click.style(profile[1], fg="green") + ":")
+        print_plan(query_list, skipped)
+
+def scan_workers(workers: int, batch_size: int) -> int:
+    """Batches can only fill up if enough tables are waiting on them, so each worker gets a full batch worth of threads."""
+    return workers * batch_size if batch_size > 1 else workers
+
+def run_query(query_type: str, filename: str, workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE, local: bool = False, regex: bool = False, ignore_case: bool = False,
+        cache_ttl: int = DEFAULT_TTL, refresh_tables: bool = False, profiles: str = None, all_profiles: bool = False, batch_size: int = 0, rate: float = 0,
+        max_retries: int = DEFAULT_MAX_RETRIES, explain: bool = False, no_plan: bool = False, count_first: bool = False,
+        shard_size: int = DEFAULT_SHARD_SIZE, pattern: List[str] = None, patterns_file: str = None, context: int = None):
+    profile_names = parse_profiles(profiles, all_profiles)
+    if (regex or ignore_case) and not local:
+        click.secho("Regular expressions and case-insensitive matching are only available when searching the local mirror (--local).", fg="red")
+        sys.exit()
+    profile_list = [get_selected_profile()] if profile_names == None else get_profiles(profile_names or None)
+    if explain:
+        explain_query(profile_list, query_type, filename, workers, page_size, cache_ttl, refresh_tables)
+        return
+    patterns = get_patterns(pattern, patterns_file)
+    if local:
+        from .sync import local_lookup
+        for profile in profile_list:
+            local_lookup(query_type, None if filename == None else get_list_from_file(filename), patterns, regex, ignore_case, profile, context)
+        return
+    if profile_names != None:
+        multi_lookup(profile_list, query_type, filename, patterns, workers, page_size, cache_ttl, refresh_tables, batch_size, rate, max_retries, not no_plan, count_first, shard_size, context)
+        return
+    s, url = setup_connection(workers, profile_list[0], batch_size, rate, max_retries)
     if filename == None:
-        query_list = get_full_query_list(s, url, query_type)
+        query_list = get_target_list(s, url, profile_list[0][0], query_type, page_size, cache_ttl, refresh_tables)
     else:
         query_list = get_list_from_file(filename)
-    generic_lookup(s, url, query_list, query_string)
+    if not no_plan:
+        query_list, skipped = plan_scan(s, url, profile_list[0][0], query_list, workers, cache_ttl, refresh_tables, page_size)
+        print_skipped(skipped)
+    try:
+        generic_lookup(s, url, query_list, patterns, scan_workers(workers, batch_size), page_size, count_first,
+            None if no_plan else table_sizes(profile_list[0][0]), shard_size, profile_list[0][0], query_type, context)
+    except ScanAborted:
+        sys.exit()
+
+def lookup_wf_chunk(s: requests.Session, url: str, chunk: List[Tuple[str, str, str]], query_string: str, page_size: int = DEFAULT_PAGE_SIZE) -> dict:
+    """Returns the sys_ids of the matching script variable values of a chunk of activities, keyed by activity sys_id.
+    Raises a TableError if sys_variable_value can't be queried."""
+    query = "document=wf_activity^document_keyIN{}^variable.internal_type=script^ORvariable.internal_type=script_plain^valueLIKE{}".format(
+        ",".join(i[0] for i in chunk),
+        query_string.strip()
+    )
+    matches = {}
+    for i in get_records(s, url, "sys_variable_value", {"sysparm_fields":"sys_id,document_key", "sysparm_query": query}, page_size):
+        matches.setdefault(i.get('document_key'), []).append(i.get('sys_id'))
+    return matches
+
+def scan_workflow(s: requests.Session, url: str, query_list: List[Tuple[str, str, str]], query_string: str, page_size: int = DEFAULT_PAGE_SIZE,
+        on_warning: Callable[[str], None] = warn, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Tuple[str, str, str, str]]:
+    """Yields (wf_activity sys_id, wf_version sys_id, sys_variable_value sys_id, wf_activity name) for every activity
+    script that matches. Activities are looked up chunk_size at a time with document_keyIN and joined back to the
+    matching variable values in memory. Chunks that are still throttled or failing after the session's own retries
+    are tried once more at the end. Raises ScanAborted on a status code that would fail every other chunk too."""
+    chunks = []
+    for start in range(0, len(query_list), max(chunk_size, 1)):
+        chunks.append([(str(i[0]).strip(), str(i[1]).strip(), str(i[2]).strip()) for i in query_list[start:start + max(chunk_size, 1)]])
+    retry_queue = []
+    failed = 0
+    for attempt in range(2):
+        if attempt == 1:
+            if len(retry_queue) == 0:
+                break
+            on_warning("Retrying " + str(len(retry_queue)) + " chunks of activities that were throttled or failed.")
+            chunks, retry_queue = retry_queue, []
+        for chunk in chunks:
+            try:
+                matches = lookup_wf_chunk(s, url, chunk, query_string, page_size)
+            except TableError as e:
+                if e.status_code == 401:
+                    raise ScanAborted("Received status code " + str(e.status_code) + " while retrieving data for wf_activity: " + chunk[0][0] + ", name: " + chunk[0][1] + ".")
+                elif e.status_code in RETRY_LATER:
+                    if attempt == 0:
+                        retry_queue.append(chunk)
+                    else:
+                        failed += len(chunk)
+                elif e.status_code == 403: # This should never happen...
+                    on_warning("403 while querying sys_variable_value")
+                elif e.message != None: # This should also never happen, but just in case!
+                    on_warning("Error while querying: " + e.message)
+                continue
+            for wf_act_sys_id, wf_activity_name, wf_version_sys_id in chunk:
+                for svv_sys_id in matches.get(wf_act_sys_id, []):
+                    yield wf_act_sys_id, wf_version_sys_id, svv_sys_id, wf_activity_name
+    if failed > 0:
+        on_warning("Could not scan " + str(failed) + " activities after retrying.")
 
-def wf_script_lookup(s: requests.Session, url: str, query_list: List[Tuple[str, str, str]], query_string: str):
+def print_wf_result_header(instance: bool = False):
+    if output.sink != None:
+        return
+    header = "{:<35} {:<35} {:<35} {:<50}".format('WF Activity Sys ID', 'WF Version Sys ID', 'Sys Variable Value Sys ID', 'WF Activity Name')
+    if instance:
+        header = "{:<20} ".format('Instance') + header
+    click.echo(click.style(header, fg="bright_white", bold=True) )
+
+def print_wf_result(wf_act_sys_id: str, wf_version_sys_id: str, svv_sys_id: str, wf_activity_name: str, instance: str = None):
+    if output.sink != None:
+        output.sink.write({"instance": instance, "table": "sys_variable_value", "field": "value", "sys_id": svv_sys_id, "name": wf_activity_name,
+            "wf_activity_sys_id": wf_act_sys_id, "wf_version_sys_id": wf_version_sys_id})
+        return
+    line = "{:<35} {:<35} {:<35} {:<50}".format(wf_act_sys_id, wf_version_sys_id, svv_sys_id, wf_activity_name)
+    if instance != None:
+        line = "{:<20} ".format(instance) + line
+    click.echo(line)
+
+def wf_script_lookup(s: requests.Session, url: str, query_list: List[Tuple[str, str, str]], query_string: str, page_size: int = DEFAULT_PAGE_SIZE,
+        chunk_size: int = DEFAULT_CHUNK_SIZE, instance: str = None):
+    """Prints every activity of the list whose script contains the query string. The instance is only used to tag
+    rows written to an output sink."""
     click.echo("[ Found " + click.style(str(len(query_list)), fg="blue") + " entries to scan ]")
-    click.echo(click.style("{:<35} {:<35} {:<35} {:<50}".format('WF Activity Sys ID', 'WF Version Sys ID', 'Sys Variable Value Sys ID', 'WF Activity Name'), fg="bright_white", bold=True) )
-    for item in query_list:
-        wf_act_sys_id = str(item[0]).strip()
-        wf_activity_name = str(item[1]).strip()
-        wf_version_sys_id = str(item[2]).strip()
-        query = "document=wf_activity^document_key={}^variable.internal_type=script^ORvariable.internal_type=script_plain^valueLIKE{}".format(
-            wf_act_sys_id,
-            query_string.strip()
-        )
-        resp = s.get(url + "/api/now/table/sys_variable_value", params={"sysparm_fields":"sys_id", "sysparm_query": query})
-        if resp.status_code == 401 or resp.status_code == 500 or resp.status_code == 429:
-            click.secho("Received status code " + str(resp.status_code) + " while retrieving data for wf_activity: " + wf_act_sys_id + ", name: " + wf_activity_name + ". Aborting.", fg="red")
-            sys.exit()
-        elif resp.status_code == 403: # This should never happen...
-            click.secho("403 while querying sys_variable_value", fg="yellow")
-            continue
-        try:
-            resp_json = resp.json()
-            if resp_json.get('result') != None:
-                for i in resp_json['result']:
-                    click.echo("{:<35} {:<35} {:<35} {:<50}".format( wf_act_sys_id, wf_version_sys_id, i.get('sys_id'), wf_activity_name ))
-            elif resp.json.get('error') != None:
-                click.secho("Error while querying: " + str(resp_json['error']), fg="yellow")
-        except: # This should also never happen, but just in case!
-            if resp_json.get('error') != None:
-                click.secho("Error while querying: " + str(resp_json['error']), fg="yellow")
+    print_wf_result_header()
+    try:
+        for result in scan_workflow(s, url, query_list, query_string, page_size, warn, chunk_size):
+            print_wf_result(*result, instance=None if output.sink == None else instance)
+    except ScanAborted as e:
+        click.secho(str(e) + " Aborting.", fg="red")
+        sys.exit()
     click.secho("Finished.", fg="bright_white", bold=True)
 
-def wf_activity_lookup(s: requests.Session, url: str, wf_name: str) -> List[Tuple[str, str, str]]:
+def wf_activity_lookup(s: requests.Session, url: str, wf_name: str, page_size: int = DEFAULT_PAGE_SIZE, match: str = "exact") -> List[Tuple[str, str, str]]:
     """Grabs a list of all published wf_activity records that match the given workflow. This will build our initial list of activities to
-    query against, to be limited again by sys_variable_value's that reference a script variable."""
-    query = "workflow_version.published=true^workflow_version.name=" + wf_name
+    query against, to be limited again by sys_variable_value's that reference a script variable.
+    match can be "exact" for a single workflow, "contains" to treat wf_name as a name pattern, or "all" for every published workflow."""
+    query = "workflow_version.published=true"
+    if match == "contains":
+        query += "^workflow_version.nameLIKE" + wf_name
+    elif match != "all":
+        query += "^workflow_version.name=" + wf_name
 
-    resp = s.get(url + "/api/now/table/wf_activity", params={"sysparm_fields": "sys_id,name,workflow_version", "sysparm_query": query})
-    if resp.status_code != 200:
-        click.secho("Received status code " + str(resp.status_code) + " while retrieving list of wf_activity records to query. Aborting.", fg="red")
-        sys.exit()
-    resp_json = resp.json()
     ret = []
-    if resp_json.get('result') != None:
-        for i in resp_json['result']:
+    try:
+        for i in get_records(s, url, "wf_activity", {"sysparm_fields": "sys_id,name,workflow_version", "sysparm_query": query}, page_size):
             ret.append( (i.get('sys_id'), i.get('name'), i.get('workflow_version').get('value')) )
-    elif resp.json.get('error') != None:
-            click.secho("Error while querying: " + str(resp_json['error']), fg="yellow")
+    except TableError as e:
+        click.secho("Received status code " + str(e.status_code) + " while retrieving list of wf_activity records to query. Aborting.", fg="red")
+        sys.exit()
     return ret
 
-def query_workflow():
-    click.echo("Enter name of workflow to search")
-    wf_name = input(click.style(">> ", fg="bright_white", bold=True)).strip()
+def query_workflow(page_size: int = DEFAULT_PAGE_SIZE, profile_names: List[str] = None, match: str = "exact", chunk_size: int = DEFAULT_CHUNK_SIZE):
+    profiles = [get_selected_profile()] if profile_names == None else get_profiles(profile_names or None)
+    wf_name = ""
+    if match == "contains":
+        click.echo("Enter part of the name of the workflows to search")
+        wf_name = input(click.style(">> ", fg="bright_white", bold=True)).strip()
+    elif match != "all":
+        click.echo("Enter name of workflow to search")
+        wf_name = input(click.style(">> ", fg="bright_white", bold=True)).strip()
     click.echo("Enter script fragment to search")
     query_string = input(click.style(">> ", fg="bright_white", bold=True)).strip()
-    s, url = setup_connection()
-    query_list = wf_activity_lookup(s, url, wf_name)
-    wf_script_lookup(s, url, query_list, query_string)
+    if profile_names == None:
+        s, url = setup_connection(1, profiles[0])
+        query_list = wf_activity_lookup(s, url, wf_name, page_size, match)
+        wf_script_lookup(s, url, query_list, query_string, page_size, chunk_size, profiles[0][1])
+        return
+
+    def scan_profile(profile):
+        s, url = setup_connection(1, profile)
+        query_list = wf_activity_lookup(s, url, wf_name, page_size, match)
+        click.echo("[ Found " + click.style(str(len(query_list)), fg="blue") + " entries to scan on " + profile[1] + " ]")
+        return scan_workflow(s, url, query_list, query_string, page_size, lambda m: warn(profile[1] + ": " + m), chunk_size)
+
+    print_wf_result_header(True)
+    for profile, result in fan_out(profiles, scan_profile):
+        print_wf_result(*result, instance=profile[1])
+    click.secho("Finished.", fg="bright_white", bold=True)
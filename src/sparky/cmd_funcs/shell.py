@@ -0,0 +1,50 @@
+import click
+import shlex
+from .. import timings
+from ..connection import conn, stats
+
+def run_shell(cli: click.Group):
+    """Reads sparky commands one line at a time and runs them in this process, so that sessions (with their kept
+    alive connections), cached pre-flight checks and everything else loaded stay warm between commands."""
+    try:
+        import readline # arrow keys and history, where the platform has it
+    except ImportError:
+        pass
+    conn.keep_sessions()
+    click.secho("Sparky shell. Type any sparky command without 'sparky' in front, 'help' for the list of commands or 'exit' to leave.", fg="bright_white", bold=True)
+    while True:
+        try:
+            line = input(click.style("sparky> ", fg="green", bold=True)).strip()
+        except EOFError:
+            click.echo()
+            return
+        except KeyboardInterrupt:
+            click.echo()
+            continue
+        if line == "":
+            continue
+        if line in ("exit", "quit"):
+            return
+        try:
+            args = shlex.split(line)
+        except ValueError as e:
+            click.secho("Could not read command: " + str(e), fg="red")
+            continue
+        if args[0] == "help":
+            args = ["--help"]
+        elif args[0] == "shell":
+            click.secho("Already in the sparky shell.", fg="yellow")
+            continue
+        timings.reset()
+        stats.reset()
+        conn.preflight_ttl = conn.DEFAULT_PREFLIGHT_TTL
+        try:
+            cli.main(args, prog_name="sparky", standalone_mode=False)
+        except click.exceptions.Abort:
+            click.secho("Aborted.", fg="red")
+        except click.ClickException as e:
+            e.show()
+        except SystemExit:
+            pass # commands exit when they give up, the shell carries on
+        except KeyboardInterrupt:
+            click.secho("\nInterrupted.", fg="red")
@@ -1,13 +1,25 @@
+from typing import Callable, Dict, Iterator, List, Tuple
 import click
+import requests
 from ..connection import conn
+from ..connection.stream import OrderedStream
+from ..connection.table import DEFAULT_PAGE_SIZE, TableError, get_pages, read_result
+from . import output
+from .fanout import fan_out
+from bisect import bisect_right
 import sys
 import re
 
-def text_search():
+DEFAULT_CHUNK_SIZE = 100
+
+def text_search(profile_names: List[str] = None, patterns: List[str] = None):
+    profiles = None if profile_names == None else conn.get_profiles(profile_names or None)
     click.echo("Enter the table name and sys_id of a record to search")
     table_name = input(click.style("Table name >> ", fg="bright_white", bold=True)).strip()
     sys_id = input(click.style("sys_id >> ", fg="bright_white", bold=True)).strip()
-    fragment = input(click.style("Search string >> ", fg="bright_white", bold=True)).strip()
+    if patterns == None or len(patterns) == 0:
+        patterns = [input(click.style("Search string >> ", fg="bright_white", bold=True)).strip()]
+    fragment = compile_fragments(patterns)
 
     if table_name == "" or sys_id == "":
         click.secho("You must enter both a sys_id and table name to search", fg="red")
@@ -16,56 +28,255 @@ def text_search():
     if len(sys_id) != 32:
         click.secho("Invalid sys_id", fg="red")
         sys.exit()
+
+    if profiles != None:
+        multi_text_search(profiles, table_name, sys_id, fragment)
+        return
     
     s, url = conn.setup_connection()
-    resp = s.get(url + "/api/now/table/" + table_name, params={"sysparm_query": "sys_id=" + sys_id})
-
-    body = resp.json()
-    if resp.status_code != 200:
-        try:
-            err = body.get('error').get('message')
-            click.secho("Search failed with status " + str(resp.status_code) + ' - ' + err, fg="red")
-        except:
-            click.secho("Search failed with status " + str(resp.status_code), fg="red")
-        finally:
-            sys.exit()
-    
-    res = body.get('result')
-    if len(res) == 0:
+    try:
+        obj = fetch_record(s, url, table_name, sys_id)
+    except TableError as e:
+        if e.message != None:
+            click.secho("Search failed with status " + str(e.status_code) + ' - ' + e.message, fg="red")
+        else:
+            click.secho("Search failed with status " + str(e.status_code), fg="red")
+        sys.exit()
+
+    if obj == None:
         click.secho("No results found.", fg="bright_white", bold=True)
         sys.exit()
 
-    obj = res[0] # at this point, we have a full record in the form of a dict
     found_results = False
-    for prop in obj:
-        search_results = search(fragment, obj[prop])
-        if len(search_results) > 0:
+    instance = None if output.sink == None else conn.get_selected_profile()[1]
+    for prop, search_results in search_record(obj, fragment):
+        if output.sink == None:
             click.secho("\nIn column " + click.style(prop, fg="yellow") + ":")
-            print_results(search_results)
-            found_results = True
+        print_results(search_results, len(patterns) > 1, record_row(instance, table_name, prop, obj))
+        found_results = True
     if not found_results:
         click.secho("No results found", fg="yellow")
 
-"""Takes a string value with multiple newlines and searches it against a fragment.
-Returns a list of found results with the term
+def multi_text_search(profiles: List[Tuple[int, str, str, str]], table_name: str, sys_id: str, fragment):
+    """Searches the same record on every profile at once. Records promoted between instances keep their sys_id."""
+    def search_profile(profile):
+        s, url = conn.setup_connection(1, profile)
+        obj = fetch_record(s, url, table_name, sys_id)
+        if obj == None:
+            click.secho("No record found on " + profile[1] + ".", fg="yellow")
+            return iter([])
+        return search_record(obj, fragment)
+
+    for profile, (prop, search_results) in fan_out(profiles, search_profile):
+        if output.sink == None:
+            click.secho("\nIn instance " + click.style(profile[1], fg="green") + ", column " + click.style(prop, fg="yellow") + ":")
+        print_results(search_results, len(fragment[1]) > 1, record_row(profile[1], table_name, prop, {"sys_id": sys_id}))
+
+def bulk_text_search(targets: List[Tuple[str, str]], patterns: List[str], profile_id: int = None, fields: Dict[str, List[str]] = None,
+        workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE, chunk_size: int = DEFAULT_CHUNK_SIZE, flags: int = 0):
+    """Searches many records at once. Records are fetched per table in chunks with a sys_idIN query instead of one
+    request each, and every value is matched with patterns compiled only once. fields limits what is fetched (and
+    searched) per table, by default every field is."""
+    fragment = compile_fragments(patterns, flags)
+    profile = conn.get_selected_profile() if profile_id == None else conn.get_profiles([str(profile_id)])[0]
+    s, url = conn.setup_connection(workers, profile)
+
+    by_table = {}
+    for table, sys_id in targets:
+        if sys_id not in by_table.setdefault(table, []):
+            by_table[table].append(sys_id)
+    click.echo("[ Searching " + click.style(str(sum(len(i) for i in by_table.values())), fg="blue") + " records across "
+        + click.style(str(len(by_table)), fg="blue") + " tables on " + click.style(profile[1], fg="green") + " ]")
+
+    def on_error(table: str, e: TableError):
+        if e.status_code == 401:
+            click.secho("Received status code 401 while searching " + table + ". Aborting.", fg="red")
+            sys.exit()
+        click.secho("Could not search " + table + " (status " + str(e.status_code) + ")" + ("" if e.message == None else ": " + e.message), fg="yellow")
+
+    found = 0
+    for table, obj, results in bulk_matches(s, url, by_table, fragment, fields, workers, page_size, chunk_size, on_error):
+        found += 1
+        if output.sink == None:
+            click.secho("\n" + table + " " + str(obj.get('sys_id')) + " " + click.style(str(obj.get('name') or obj.get('sys_name') or obj.get('u_name') or ""), fg="green"), bold=True)
+        for prop, search_results in results:
+            if output.sink == None:
+                click.secho("In column " + click.style(prop, fg="yellow") + ":")
+            print_results(search_results, len(patterns) > 1, record_row(profile[1], table, prop, obj))
+    click.secho("\nFinished. " + str(found) + " records matched.", fg="bright_white", bold=True)
+
+def bulk_matches(s: requests.Session, url: str, by_table: Dict[str, List[str]], fragment, fields: Dict[str, List[str]] = None, workers: int = 1,
+        page_size: int = DEFAULT_PAGE_SIZE, chunk_size: int = DEFAULT_CHUNK_SIZE, on_error: Callable[[str, TableError], None] = None) -> Iterator[Tuple[str, dict, list]]:
+    """Yields (table, record, results) for every matching record of the sys_ids listed per table, in order. Tables that
+    can't be searched are passed to on_error and skipped, or raise their TableError without one."""
+    with OrderedStream(workers) as stream:
+        for table, sys_ids in by_table.items():
+            params = {}
+            if fields != None and table in fields:
+                params["sysparm_fields"] = ",".join(["sys_id", "name", "u_name", "sys_name"] + fields[table])
+            for i in range(0, len(sys_ids), chunk_size):
+                stream.submit(table, get_pages, s, url, table, dict(params, sysparm_query="sys_idIN" + ",".join(sys_ids[i:i + chunk_size])), page_size)
+        for table, pages in stream:
+            try:
+                for page in pages:
+                    for obj in page:
+                        results = list(search_record(obj, fragment))
+                        if len(results) > 0:
+                            yield table, obj, results
+            except TableError as e:
+                if on_error == None:
+                    raise
+                on_error(table, e)
+
+def get_targets_from_file(filename: str) -> List[Tuple[str, str]]:
+    """Reads table,sys_id pairs from a file, one per line."""
+    ret = []
+    try:
+        with open(filename, 'r') as file:
+            lines = file.read().splitlines()
+    except Exception as e:
+        click.secho("Could not open " + filename + ": " + str(e), fg="red")
+        sys.exit()
+    for line in lines:
+        if line.strip() == "":
+            continue
+        line_arr = line.split(',')
+        if len(line_arr) != 2 or line_arr[0].strip() == "" or len(line_arr[1].strip()) != 32:
+            click.secho("File " + filename + " is not formatted correctly (expected table,sys_id on every line). Aborting search.", fg="red")
+            sys.exit()
+        ret.append((line_arr[0].strip(), line_arr[1].strip()))
+    return ret
+
+def bulk_search_scan(scan_id: int = None, patterns: List[str] = None, workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Shows where in each record the hits of a saved scan matched. Without patterns of its own, the scan's strings
+    are looked for the way the scan did: literally and ignoring case."""
+    from .checkpoint import scan_hits
+    profile_id, scan_patterns, hits = scan_hits(scan_id)
+    fields = {}
+    for table, field, _ in hits:
+        for f in str(field).split(","):
+            if f not in fields.setdefault(table, []):
+                fields[table].append(f)
+    if patterns == None or len(patterns) == 0:
+        bulk_text_search([(t, i) for t, _, i in hits], [re.escape(p) for p in scan_patterns], profile_id, fields, workers, page_size, chunk_size, re.IGNORECASE)
+    else:
+        bulk_text_search([(t, i) for t, _, i in hits], patterns, profile_id, fields, workers, page_size, chunk_size)
+
+def fetch_record(s: requests.Session, url: str, table_name: str, sys_id: str) -> dict:
+    """Returns the full record as a dict, or None if it doesn't exist. Raises a TableError if the lookup fails."""
+    res = read_result(s.get(url + "/api/now/table/" + table_name, params={"sysparm_query": "sys_id=" + sys_id}))
+    if len(res) == 0:
+        return None
+    return res[0]
+
+def compile_fragments(patterns: List[str], flags: int = 0):
+    """Compiles the search patterns (regular expressions, like a single search string always was) into one
+    expression matching any of them, plus each of them on its own to tell which ones a line contains."""
+    try:
+        each = [re.compile(p, flags) for p in patterns]
+        return re.compile("|".join("(?:" + p + ")" for p in patterns), flags | re.MULTILINE), each
+    except re.error as e:
+        click.secho("Invalid search string: " + str(e), fg="red")
+        sys.exit()
+
+def search_record(obj: dict, fragment) -> Iterator[Tuple[str, list]]:
+    """Yields (column, results) for every column of the record that contains the fragment."""
+    for prop in obj:
+        search_results = search(fragment, obj[prop])
+        if len(search_results) > 0:
+            yield prop, search_results
+
+"""Takes a string value with multiple newlines and searches it against the fragments from compile_fragments.
+Returns a list of found results with the term and the pattern that found it
 """
 def search(fragment, value):
+    combined, each = fragment
     value = str(value)
     ret = []
-    lines = value.split("\r\n")
-    for inx, item in enumerate(lines):
-        term = re.search(fragment, item)
-        if term != None:
-            #Search term found, line count, full line
-            ret.append((term.group(), inx + 1, item))
+    m = combined.search(value)
+    if m == None:
+        return ret
+    # Any newline style counts, and the line index is only built for values that match somewhere
+    if "\r" in value:
+        value = value.replace("\r\n", "\n").replace("\r", "\n")
+        m = combined.search(value)
+    starts = line_starts(value)
+    while m != None:
+        inx = bisect_right(starts, m.start()) - 1
+        end = value.find("\n", starts[inx])
+        end = len(value) if end == -1 else end
+        item = value[starts[inx]:end]
+        for pattern in each:
+            term = pattern.search(item)
+            if term != None:
+                #Search term found, line count, full line, pattern
+                ret.append((term.group(), inx + 1, item, pattern.pattern))
+        # every pattern has been tried on this line, carry on from the next one
+        m = combined.search(value, end + 1) if end < len(value) else None
+    return ret
+
+def first_line(fragment, value) -> Tuple[int, str]:
+    """Returns the number and text of the first line of a value that matches, or (None, None) if none does."""
+    combined, _ = fragment
+    value = str(value).replace("\r\n", "\n").replace("\r", "\n")
+    m = combined.search(value)
+    if m == None:
+        return None, None
+    start = value.rfind("\n", 0, m.start()) + 1
+    end = value.find("\n", m.end())
+    return value.count("\n", 0, m.start()) + 1, value[start:len(value) if end == -1 else end].strip()
+
+"""Returns the offset every line of a value starts at"""
+def line_starts(value: str) -> List[int]:
+    ret = [0]
+    pos = value.find("\n")
+    while pos != -1:
+        ret.append(pos + 1)
+        pos = value.find("\n", pos + 1)
     return ret
 
-"""Color prints the list of search results for each field"""
-def print_results(results):
+"""Prints the matching lines of a value grep-style as label:line: text, highlighted, with up to context lines
+around each of them. Groups of lines that aren't next to each other are separated by --
+"""
+def print_context(label: str, fragment, value, context: int = 0):
+    results = search(fragment, value)
+    if len(results) == 0:
+        return
+    lines = str(value).replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    terms = {}
+    for term, line_num, _, _ in results:
+        terms.setdefault(line_num, term)
+    wanted = sorted(set(n for line_num in terms for n in range(max(1, line_num - context), min(len(lines), line_num + context) + 1)))
+    prev = None
+    for n in wanted:
+        if prev != None and n > prev + 1:
+            click.secho("\t--", dim=True)
+        if n in terms:
+            click.echo("\t" + click.style(label + ":" + str(n) + ":", fg="bright_white", bold=True) + " " + color(lines[n - 1], terms[n], "blue"))
+        else:
+            click.echo("\t" + click.style(label + "-" + str(n) + "- " + lines[n - 1], dim=True))
+        prev = n
+
+def record_row(instance: str, table: str, field: str, obj: dict) -> dict:
+    """Returns the columns an output sink row shares for every match in one field of a record."""
+    return {"instance": instance, "table": table, "field": field, "sys_id": obj.get('sys_id'),
+        "name": str(obj.get('name') or obj.get('sys_name') or obj.get('u_name') or "").strip() or None}
+
+def print_results(results, tag: bool = False, where: dict = None):
+    """Color prints the list of search results for each field, tagged with the pattern that matched if asked to. With
+    an output sink the results are written as rows about the record described by where instead."""
+    if output.sink != None:
+        for item in results:
+            row = dict(where or {})
+            row.update({"pattern": str(item[3]), "line": item[1], "text": str(item[2]).strip()})
+            output.sink.write(row)
+        return
     for item in results:
         line_num = str(item[1])
         line_found = color(str(item[2]).strip(), str(item[0]), "blue")
-        
+        if tag:
+            line_found = click.style("[" + str(item[3]) + "] ", fg="yellow") + line_found
+
         click.secho(click.style("\tLine " + line_num + ": ", fg="bright_white", bold=True) + line_found)
 
 """Colors input word found in given line by CLI color"""
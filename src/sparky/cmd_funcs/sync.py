@@ -0,0 +1,285 @@
+from typing import Iterator, List, Tuple
+import click
+import re
+import sqlite3
+import sys
+import requests
+from ..connection import db
+from ..connection.conn import get_selected_profile, setup_connection
+from ..connection.stream import OrderedStream
+from ..connection.table import DEFAULT_PAGE_SIZE, TableError, count_records, get_records, read_result
+from .cache import DEFAULT_TTL, get_target_list
+from . import output
+from .query import hit_printer, print_result_header
+
+def setup_mirror(conn: sqlite3.Connection, profile_id: int) -> str:
+    """Creates the mirror tables if needed and returns the name of the profile's full-text index. The index is an
+    external content FTS5 table over mirror_record, using the trigram tokenizer where SQLite supports it so that
+    arbitrary substrings (not just whole words) can be looked up."""
+    fts = "mirror_fts_" + str(int(profile_id))
+    cur = conn.cursor()
+    cur.execute('''CREATE TABLE IF NOT EXISTS mirror_record (
+        id integer primary key,
+        profile_id int,
+        query_type text,
+        tbl text,
+        field text,
+        sys_id text,
+        name text,
+        updated_on text,
+        content text,
+        unique (profile_id, tbl, field, sys_id)
+    );''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS mirror_state (
+        profile_id int,
+        query_type text,
+        tbl text,
+        field text,
+        high_water text,
+        high_water_id text,
+        primary key (profile_id, tbl, field)
+    );''')
+    try:
+        cur.execute("ALTER TABLE mirror_state ADD COLUMN high_water_id text;")
+    except sqlite3.OperationalError: # already there
+        pass
+    try:
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS " + fts + " USING fts5(content, content='mirror_record', content_rowid='id', tokenize='trigram');")
+    except sqlite3.OperationalError: # SQLite older than 3.34 has no trigram tokenizer
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS " + fts + " USING fts5(content, content='mirror_record', content_rowid='id');")
+    conn.commit()
+    return fts
+
+def fetch_changes(s: requests.Session, url: str, table: str, field: str, high_water: str = None, high_water_id: str = None,
+        page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[List[dict]]:
+    """Yields the records updated after the (sys_updated_on, sys_id) high water mark one page at a time, in that order,
+    including records whose field has been emptied since so their old content can be dropped. Without a mark only
+    records with content in the field are returned. An empty high_water_id rereads every record of the high water
+    second. Pages are read by keyset instead of by offset, so records sharing a timestamp or updated while the pages
+    are read can't slip between two pages. Each page starts at the second of the last record and drops what was
+    already read of it, so a field that hasn't changed costs a single request."""
+    params = {"sysparm_fields": "sys_id,name,u_name,sys_name,sys_updated_on," + field, "sysparm_limit": str(page_size), "sysparm_no_count": "true"}
+    base = field + "ISNOTEMPTY^" if high_water == None else ""
+    last, last_id = high_water, high_water_id if high_water != None else None
+    ties = False
+    while True:
+        if last == None:
+            query = base + "ORDERBYsys_updated_on^ORDERBYsys_id"
+        elif last == "": # no sys_updated_on on this table, so only sys_id can order it
+            query = base + "sys_id>" + last_id + "^ORDERBYsys_id"
+        elif ties:
+            # a full page of the last second was read already, so read the rest of it on its own to get past it
+            query = base + "sys_updated_on=" + last + ("^sys_id>" + last_id if last_id else "") + "^ORDERBYsys_id"
+        elif last_id == None:
+            query = base + "sys_updated_on>" + last + "^ORDERBYsys_updated_on^ORDERBYsys_id"
+        else:
+            query = base + "sys_updated_on>=" + last + "^ORDERBYsys_updated_on^ORDERBYsys_id"
+        params["sysparm_query"] = query
+        page = read_result(s.get(url + "/api/now/table/" + table, params=params, headers={"Accept": "application/json"}))
+        fresh = page
+        if last not in (None, "") and last_id != None:
+            fresh = [i for i in page if (i.get('sys_updated_on') or "", i.get('sys_id') or "") > (last, last_id)]
+        if len(fresh) > 0:
+            yield fresh
+            last, last_id = fresh[-1].get('sys_updated_on') or "", fresh[-1].get('sys_id')
+        if len(page) < page_size:
+            if not ties:
+                return
+            # the last second is done, carry on after it
+            ties, last_id = False, None
+        elif len(fresh) == 0:
+            ties = True
+
+def deleted_records(s: requests.Session, url: str, table: str, field: str, known: set, page_size: int = DEFAULT_PAGE_SIZE) -> List[str]:
+    """Returns the sys_ids among known that no longer have content in the field on the instance, because the record
+    was deleted. When the instance counts as many records as are known, that single Aggregate API request settles
+    it. Otherwise the sys_ids that are left are listed."""
+    if len(known) == 0 or count_records(s, url, table, field + "ISNOTEMPTY") == len(known):
+        return []
+    live = set(i.get('sys_id') for i in get_records(s, url, table, {"sysparm_fields": "sys_id", "sysparm_query": field + "ISNOTEMPTY"}, page_size))
+    return sorted(known - live)
+
+def clear_unit(cur: sqlite3.Cursor, fts: str, profile_id: int, table: str, field: str):
+    """Drops everything mirrored for a table/field pair, including its entries in the full-text index."""
+    for row in cur.execute("SELECT id, content FROM mirror_record WHERE profile_id = ? AND tbl = ? AND field = ?;", (profile_id, table, field)).fetchall():
+        cur.execute("INSERT INTO " + fts + " (" + fts + ", rowid, content) VALUES ('delete', ?, ?);", row)
+    cur.execute("DELETE FROM mirror_record WHERE profile_id = ? AND tbl = ? AND field = ?;", (profile_id, table, field))
+    cur.execute("DELETE FROM mirror_state WHERE profile_id = ? AND tbl = ? AND field = ?;", (profile_id, table, field))
+
+def store_record(cur: sqlite3.Cursor, fts: str, profile_id: int, query_type: str, table: str, field: str, record: dict):
+    """Inserts or replaces a single mirrored record, keeping the full-text index in step with it."""
+    sys_id = record.get('sys_id')
+    name = str(record.get('name') or record.get('sys_name') or record.get('u_name')).strip()
+    content = str(record.get(field) or "")
+    old = cur.execute("SELECT id, content FROM mirror_record WHERE profile_id = ? AND tbl = ? AND field = ? AND sys_id = ?;", (profile_id, table, field, sys_id)).fetchone()
+    if old != None:
+        cur.execute("INSERT INTO " + fts + " (" + fts + ", rowid, content) VALUES ('delete', ?, ?);", old)
+        cur.execute("UPDATE mirror_record SET query_type = ?, name = ?, updated_on = ?, content = ? WHERE id = ?;",
+            (query_type, name, record.get('sys_updated_on'), content, old[0]))
+        rowid = old[0]
+    else:
+        cur.execute("INSERT INTO mirror_record (profile_id, query_type, tbl, field, sys_id, name, updated_on, content) VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+            (profile_id, query_type, table, field, sys_id, name, record.get('sys_updated_on'), content))
+        rowid = cur.lastrowid
+    cur.execute("INSERT INTO " + fts + " (rowid, content) VALUES (?, ?);", (rowid, content))
+
+def drop_record(cur: sqlite3.Cursor, fts: str, profile_id: int, table: str, field: str, sys_id: str) -> bool:
+    """Removes a single mirrored record and its entry in the full-text index. Returns whether there was one."""
+    old = cur.execute("SELECT id, content FROM mirror_record WHERE profile_id = ? AND tbl = ? AND field = ? AND sys_id = ?;", (profile_id, table, field, sys_id)).fetchone()
+    if old == None:
+        return False
+    cur.execute("INSERT INTO " + fts + " (" + fts + ", rowid, content) VALUES ('delete', ?, ?);", old)
+    cur.execute("DELETE FROM mirror_record WHERE id = ?;", (old[0],))
+    return True
+
+def sync_mirror(query_types: List[str], full: bool = False, workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE):
+    """Mirrors the content of every script/html/xml field into sparky.db. Only records updated since the last sync
+    are downloaded unless a full sync is requested. Records whose field was emptied are dropped from the mirror, and
+    so are records deleted on the instance once a count shows some are missing."""
+    profile = get_selected_profile()
+    s, url = setup_connection(workers, profile)
+    conn = db.connect()
+    try:
+        fts = setup_mirror(conn, profile[0])
+        cur = conn.cursor()
+        units = []
+        for query_type in query_types:
+            for item in get_target_list(s, url, profile[0], query_type, page_size, DEFAULT_TTL, full):
+                units.append((query_type, str(item[0]).strip(), str(item[1]).strip()))
+        click.echo("[ Found " + click.style(str(len(units)), fg="blue") + " entries to sync ]")
+
+        total = 0
+        removed = 0
+        synced = []
+        fresh = set()
+        with OrderedStream(workers) as stream:
+            for query_type, table, field in units:
+                if full:
+                    clear_unit(cur, fts, profile[0], table, field)
+                    conn.commit()
+                hw = cur.execute("SELECT high_water, high_water_id FROM mirror_state WHERE profile_id = ? AND tbl = ? AND field = ?;", (profile[0], table, field)).fetchone()
+                if hw == None:
+                    fresh.add((table, field))
+                stream.submit((query_type, table, field), fetch_changes, s, url, table, field, None if hw == None else hw[0], None if hw == None else hw[1] or "", page_size)
+            # Only this thread writes to the database, the workers just download
+            for (query_type, table, field), pages in stream:
+                count = 0
+                mark = None
+                try:
+                    for page in pages:
+                        for record in page:
+                            if str(record.get(field) or "") == "":
+                                removed += drop_record(cur, fts, profile[0], table, field, record.get('sys_id'))
+                            else:
+                                store_record(cur, fts, profile[0], query_type, table, field, record)
+                                count += 1
+                            if record.get('sys_updated_on'):
+                                # pages come in (sys_updated_on, sys_id) order, so the last record is the new mark
+                                mark = (record.get('sys_updated_on'), record.get('sys_id'))
+                except TableError as e:
+                    if e.status_code == 401 or e.status_code == 500 or e.status_code == 429:
+                        conn.commit()
+                        click.secho("Received status code " + str(e.status_code) + " while syncing table: " + table + ", field: " + field + ". Aborting.", fg="red")
+                        sys.exit()
+                    elif e.status_code == 403: # same as querying, skip tables we can't read
+                        continue
+                    elif e.message != None:
+                        click.secho("Error while syncing: " + e.message, fg="yellow")
+                        continue
+                if mark != None:
+                    cur.execute("INSERT OR REPLACE INTO mirror_state (profile_id, query_type, tbl, field, high_water, high_water_id) VALUES (?, ?, ?, ?, ?, ?);",
+                        (profile[0], query_type, table, field) + mark)
+                conn.commit()
+                if count > 0:
+                    click.echo("{:<50} {}".format(table + "." + field, click.style(str(count) + " updated", fg="blue")))
+                total += count
+                # a field downloaded from scratch can't hold anything deleted
+                if (table, field) not in fresh:
+                    synced.append((table, field))
+
+        removed += prune_deleted(s, url, cur, fts, profile[0], synced, workers, page_size)
+        conn.commit()
+        click.secho("Finished. " + str(total) + " records updated" + ("" if removed == 0 else ", " + str(removed) + " removed") + ".", fg="bright_white", bold=True)
+    finally:
+        conn.close()
+
+def prune_deleted(s: requests.Session, url: str, cur: sqlite3.Cursor, fts: str, profile_id: int, units: List[Tuple[str, str]], workers: int = 1,
+        page_size: int = DEFAULT_PAGE_SIZE) -> int:
+    """Drops the mirrored records of the given table/field pairs that were deleted on the instance, returning how many
+    were dropped. Pairs that can't be checked are left as they are until the next sync."""
+    removed = 0
+    with OrderedStream(workers) as stream:
+        for table, field in units:
+            known = set(row[0] for row in cur.execute("SELECT sys_id FROM mirror_record WHERE profile_id = ? AND tbl = ? AND field = ?;", (profile_id, table, field)))
+            stream.submit((table, field), lambda t, f, k: iter([deleted_records(s, url, t, f, k, page_size)]), table, field, known)
+        for (table, field), results in stream:
+            try:
+                for sys_ids in results:
+                    for sys_id in sys_ids:
+                        removed += drop_record(cur, fts, profile_id, table, field, sys_id)
+            except TableError:
+                continue
+    return removed
+
+def compile_pattern(query_string: str, regex: bool, ignore_case: bool):
+    """Returns a compiled pattern that matches the query string the way the user asked for."""
+    try:
+        return re.compile(query_string if regex else re.escape(query_string), re.IGNORECASE if ignore_case else 0)
+    except re.error as e:
+        click.secho("Invalid regular expression: " + str(e), fg="red")
+        sys.exit()
+
+def compile_patterns(patterns: List[str], regex: bool, ignore_case: bool):
+    """Returns a single compiled pattern matching any of the patterns, plus each pattern compiled on its own. The
+    combined one rejects most text in a single pass, the others only run on text it matched to tell which of the
+    patterns were found (an alternation alone would hide patterns overlapping an earlier match)."""
+    each = [compile_pattern(p, regex, ignore_case) for p in patterns]
+    if len(each) == 1:
+        return each[0], each
+    return compile_pattern("|".join("(?:" + p.pattern + ")" for p in each), True, ignore_case), each
+
+def local_lookup(query_type: str, query_list: List[Tuple[str, str]], patterns: List[str], regex: bool = False, ignore_case: bool = False,
+        profile: Tuple[int, str, str, str] = None, context: int = None):
+    """Answers a query from the local mirror instead of the instance. When the search is for plain strings the
+    full-text index narrows down the candidates, everything is then confirmed with the compiled patterns. Every
+    record is only matched once no matter how many patterns there are."""
+    profile = profile or get_selected_profile()
+    conn = db.connect()
+    try:
+        exists = conn.execute("SELECT sql FROM sqlite_master WHERE name = ?;", ("mirror_fts_" + str(int(profile[0])),)).fetchone()
+        if exists == None:
+            click.secho("No local mirror found for profile " + profile[1] + ". Run 'sparky sync' first.", fg="red")
+            return
+        fts = setup_mirror(conn, profile[0])
+        combined, each = compile_patterns(patterns, regex, ignore_case)
+        print_hit = hit_printer(patterns, context, regex, ignore_case)
+        instance = None if output.sink == None else profile[1]
+        sql = "SELECT r.sys_id, r.tbl, r.field, r.name, r.content FROM mirror_record r"
+        args = [profile[0]]
+        if not regex and min(len(p) for p in patterns) >= 3 and "trigram" in exists[0]:
+            sql += " JOIN " + fts + " f ON f.rowid = r.id WHERE f.content MATCH ? AND"
+            args.insert(0, " OR ".join('"' + p.replace('"', '""') + '"' for p in patterns))
+        else:
+            sql += " WHERE"
+        sql += " r.profile_id = ?"
+        if query_list == None:
+            sql += " AND r.query_type = ?"
+            args.append(query_type)
+        targets = None if query_list == None else set((str(t).strip(), str(f).strip()) for t, f in query_list)
+
+        click.echo("Searching local mirror of profile " + click.style(profile[1], fg="green") + ".")
+        print_result_header(False, len(patterns) > 1)
+        for sys_id, table, field, name, content in conn.execute(sql + " ORDER BY r.tbl, r.field, r.name;", args):
+            if targets != None and (table, field) not in targets:
+                continue
+            if not combined.search(content):
+                continue
+            if len(patterns) == 1:
+                print_hit(table, field, {"sys_id": sys_id, field: content}, name, patterns[0], instance)
+                continue
+            for n, pattern in enumerate(each):
+                if pattern.search(content):
+                    print_hit(table, field, {"sys_id": sys_id, field: content}, name, patterns[n], instance)
+        click.secho("Finished.", fg="bright_white", bold=True)
+    finally:
+        conn.close()
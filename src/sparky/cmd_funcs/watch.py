@@ -0,0 +1,240 @@
+from typing import Dict, List, Tuple
+import click
+import requests
+import sqlite3
+import sys
+import time
+from ..connection import db
+from ..connection.conn import get_profiles, get_selected_profile, setup_connection
+from ..connection.scheduler import DEFAULT_MAX_RETRIES
+from ..connection.stream import OrderedStream
+from ..connection.table import DEFAULT_PAGE_SIZE, TableError, read_result
+from . import output
+from .cache import DEFAULT_TTL, get_target_list
+from .planner import group_by_table, plan_scan
+from .checkpoint import clear_search_scans, setup_checkpoints
+from .query import ScanAborted, generic_lookup, get_list_from_file, print_skipped, scan_workers
+
+# how many records updated in the same second a watch mark can tell apart
+SEEN_LIMIT = 100
+
+def setup_watch(conn: sqlite3.Connection):
+    cur = conn.cursor()
+    cur.execute('''CREATE TABLE IF NOT EXISTS saved_search (
+        id integer primary key,
+        name text unique,
+        profile_id int,
+        query_type text,
+        patterns text,
+        filename text,
+        created_on real,
+        checked_on real
+    );''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS watch_mark (
+        search_id int,
+        tbl text,
+        high_water text,
+        primary key (search_id, tbl)
+    );''')
+    try:
+        cur.execute("ALTER TABLE watch_mark ADD COLUMN seen text;")
+    except sqlite3.OperationalError: # already there
+        pass
+    conn.commit()
+
+def save_search(name: str, query_type: str, patterns: List[str], filename: str = None):
+    """Saves a search of the selected profile under a name, to be checked with 'sparky watch run'."""
+    profile = get_selected_profile()
+    if filename != None:
+        get_list_from_file(filename) # exits if the file can't be used
+    conn = db.connect()
+    try:
+        setup_watch(conn)
+        try:
+            conn.execute("INSERT INTO saved_search (name, profile_id, query_type, patterns, filename, created_on) VALUES (?, ?, ?, ?, ?, ?);",
+                (name, profile[0], query_type, "\n".join(patterns), filename, time.time()))
+        except sqlite3.IntegrityError:
+            click.secho("There is already a saved search named " + name + ".", fg="red")
+            sys.exit()
+        conn.commit()
+        click.secho("Saved search " + click.style(name, fg="green") + " for " + profile[1] + ". The first 'sparky watch run' scans everything, later runs only what changed.")
+    finally:
+        conn.close()
+
+def list_searches():
+    conn = db.connect()
+    try:
+        setup_watch(conn)
+        names = dict((p[0], p[1]) for p in get_profiles())
+        click.secho("{:<20} {:<20} {:<8} {:<40} {:<20}".format('Name', 'Profile', 'Type', 'Patterns', 'Last checked'), fg="bright_white", bold=True)
+        for name, profile_id, query_type, patterns, filename, checked_on in conn.execute("SELECT name, profile_id, query_type, patterns, filename, checked_on FROM saved_search ORDER BY name;"):
+            click.echo("{:<20} {:<20} {:<8} {:<40} {:<20}".format(name, names.get(profile_id, "(deleted)"), query_type,
+                patterns.replace("\n", " | ") + ("" if filename == None else " (" + filename + ")"),
+                "never" if checked_on == None else time.strftime("%Y-%m-%d %H:%M", time.localtime(checked_on))))
+    finally:
+        conn.close()
+
+def delete_search(name: str):
+    conn = db.connect()
+    try:
+        setup_watch(conn)
+        row = conn.execute("SELECT id FROM saved_search WHERE name = ?;", (name,)).fetchone()
+        if row == None:
+            click.secho("No saved search named " + name + ".", fg="red")
+            sys.exit()
+        conn.execute("DELETE FROM watch_mark WHERE search_id = ?;", row)
+        conn.execute("DELETE FROM saved_search WHERE id = ?;", row)
+        conn.commit()
+        clear_search_scans(row[0])
+        click.echo("Deleted saved search " + name + ".")
+    finally:
+        conn.close()
+
+def clear_watch(profile_id: int, searches: bool = True):
+    """Forgets how far the saved searches of a profile got, so they scan everything again, and the searches too if
+    searches is set."""
+    conn = db.connect()
+    try:
+        setup_watch(conn)
+        conn.execute("DELETE FROM watch_mark WHERE search_id IN (SELECT id FROM saved_search WHERE profile_id = ?);", (profile_id,))
+        if searches:
+            conn.execute("DELETE FROM saved_search WHERE profile_id = ?;", (profile_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def latest_update(s: requests.Session, url: str, table: str) -> Tuple[str, List[str]]:
+    """Returns the sys_updated_on of the most recently updated record of a table and the sys_ids of every record
+    updated in that same second, or None if it has none. sys_updated_on only goes down to the second, so the sys_ids
+    are what tells the records of that second seen now apart from ones updated later in it. They are None if more
+    than SEEN_LIMIT records share the second. This is a single small request, so checking an unchanged table costs
+    next to nothing."""
+    resp = s.get(url + "/api/now/table/" + table, params={"sysparm_fields": "sys_id,sys_updated_on", "sysparm_query": "ORDERBYDESCsys_updated_on",
+        "sysparm_limit": str(SEEN_LIMIT + 1), "sysparm_no_count": "true"}, headers={"Accept": "application/json"})
+    result = read_result(resp)
+    if len(result) == 0 or not result[0].get('sys_updated_on'):
+        return None
+    latest = result[0].get('sys_updated_on')
+    seen = [i.get('sys_id') for i in result if i.get('sys_updated_on') == latest]
+    return latest, seen if len(seen) <= SEEN_LIMIT else None
+
+def latest_updates(s: requests.Session, url: str, tables: List[str], workers: int = 1) -> Dict[str, Tuple[str, List[str]]]:
+    """Returns the latest_update of every table that has one and could be read."""
+    ret = {}
+    with OrderedStream(workers) as stream:
+        for table in tables:
+            stream.submit(table, lambda t: iter([latest_update(s, url, t)]), table)
+        for table, results in stream:
+            try:
+                for latest in results:
+                    if latest != None:
+                        ret[table] = latest
+            except TableError as e:
+                if e.status_code == 401:
+                    click.secho("Received status code 401 while checking " + table + " for changes. Aborting.", fg="red")
+                    sys.exit()
+                # anything else is left for the scan to report or skip, as it would for a normal query
+    return ret
+
+def delta_filters(tables: List[str], marks: Dict[str, Tuple[str, List[str]]], latest: Dict[str, Tuple[str, List[str]]]) -> Tuple[Dict[str, str], List[str]]:
+    """Returns the sys_updated_on filter of every table that changed since its mark, and the tables that didn't.
+    Marks and latest updates are (sys_updated_on, sys_ids updated in that second) as returned by latest_update.
+    Records updated in the second of a mark after it was taken are picked up by the next run, which scans that
+    second again without the records already seen in it. Tables without a mark are scanned whole."""
+    filters = {}
+    unchanged = []
+    for table in tables:
+        if table not in latest:
+            filters[table] = "" # empty, unreadable or without sys_updated_on, so all we can do is scan it
+            continue
+        upto, upto_seen = latest[table]
+        if table in marks:
+            mark, seen = marks[table]
+            if upto < mark or upto == mark and (seen == None or upto_seen != None and set(upto_seen) <= set(seen)):
+                unchanged.append(table)
+                continue
+            if seen == None:
+                since = "sys_updated_on>" + mark
+            else:
+                since = "sys_updated_on>" + mark + "^ORsys_idNOT IN" + ",".join(seen) + "^sys_updated_on>=" + mark
+        # leave what is updated during the scan for the next run instead of reporting it twice
+        if upto_seen == None:
+            until = "sys_updated_on<=" + upto
+        else:
+            until = "sys_updated_on<" + upto + "^ORsys_idIN" + ",".join(upto_seen) + "^sys_updated_on<=" + upto
+        filters[table] = since + "^" + until if table in marks else until
+    return filters, unchanged
+
+def run_search(search: tuple, workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE, batch_size: int = 0, rate: float = 0,
+        max_retries: int = DEFAULT_MAX_RETRIES, context: int = None):
+    """Scans the records a saved search hasn't seen yet and prints every hit among them, then moves its marks up to
+    what was scanned."""
+    search_id, name, profile_id, query_type, patterns, filename = search
+    patterns = patterns.split("\n")
+    profile = get_profiles([str(profile_id)])[0]
+    click.echo("[ Checking " + click.style(name, fg="green") + ": " + query_type + " fields for '" + "', '".join(patterns) + "' ]")
+    s, url = setup_connection(workers, profile, batch_size, rate, max_retries)
+    if filename == None:
+        query_list = get_target_list(s, url, profile[0], query_type, page_size, DEFAULT_TTL)
+    else:
+        query_list = get_list_from_file(filename)
+    query_list, skipped = plan_scan(s, url, profile[0], query_list, workers, DEFAULT_TTL, False, page_size)
+    print_skipped(skipped)
+
+    tables = [table for table, _ in group_by_table(query_list)]
+    conn = db.connect()
+    try:
+        setup_watch(conn)
+        marks = dict((table, (high_water, None if seen == None else seen.split(","))) for table, high_water, seen in
+            conn.execute("SELECT tbl, high_water, seen FROM watch_mark WHERE search_id = ?;", (search_id,)).fetchall())
+        latest = latest_updates(s, url, tables, scan_workers(workers, batch_size))
+        filters, unchanged = delta_filters(tables, marks, latest)
+        changed = [(table, field) for table, field in query_list if table in filters]
+        click.echo("[ " + click.style(str(len(unchanged)), fg="blue") + " tables unchanged since the last check ]")
+        if len(changed) > 0:
+            setup_checkpoints(conn)
+            before = conn.execute("SELECT max(id) FROM scan;").fetchone()[0]
+            try:
+                scan_id = generic_lookup(s, url, changed, patterns, scan_workers(workers, batch_size), page_size, False, None, 0, profile[0], query_type,
+                    context, filters, search_id)
+            except ScanAborted:
+                click.secho("What " + name + " didn't get to is checked again on the next run.", fg="yellow")
+                # only what this run's scan finished before it stopped can move its mark
+                scan_id = conn.execute("SELECT max(id) FROM scan WHERE search_id = ? AND id > ?;", (search_id, before or 0)).fetchone()[0]
+            done = set(table for table, left in conn.execute("SELECT tbl, sum(1 - done) FROM scan_unit WHERE scan_id = ? GROUP BY tbl;", (scan_id,)) if left == 0)
+            # tables that weren't fully scanned keep their old mark, so the next run covers them again
+            conn.executemany("INSERT OR REPLACE INTO watch_mark (search_id, tbl, high_water, seen) VALUES (?, ?, ?, ?);",
+                [(search_id, table, latest[table][0], None if latest[table][1] == None else ",".join(latest[table][1])) for table in done if table in latest])
+        conn.execute("UPDATE saved_search SET checked_on = ? WHERE id = ?;", (time.time(), search_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def watch(names: List[str] = None, workers: int = 1, page_size: int = DEFAULT_PAGE_SIZE, batch_size: int = 0, rate: float = 0,
+        max_retries: int = DEFAULT_MAX_RETRIES, context: int = None, every: int = 0):
+    """Checks the named saved searches (all of them by default) for new or changed hits, and again every so many
+    minutes if every is above 0."""
+    conn = db.connect()
+    try:
+        setup_watch(conn)
+        searches = conn.execute("SELECT id, name, profile_id, query_type, patterns, filename FROM saved_search ORDER BY name;").fetchall()
+    finally:
+        conn.close()
+    if names:
+        missing = [name for name in names if name not in [search[1] for search in searches]]
+        if len(missing) > 0:
+            click.secho("No saved search named " + ", ".join(missing) + ". Use 'sparky watch list' to see the saved searches.", fg="red")
+            sys.exit()
+        searches = [search for search in searches if search[1] in names]
+    if len(searches) == 0:
+        click.secho("There are no saved searches. Add one with 'sparky watch add'.", fg="red")
+        sys.exit()
+    while True:
+        for search in searches:
+            run_search(search, workers, page_size, batch_size, rate, max_retries, context)
+        # hand the hits of this round downstream now rather than after the wait
+        output.flush()
+        if every <= 0:
+            return
+        click.secho("Checking again in " + str(every) + " minutes. Press Ctrl+C to stop.", dim=True)
+        time.sleep(every * 60)
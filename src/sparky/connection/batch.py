@@ -0,0 +1,146 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+import base64
+import datetime
+import threading
+import time
+import uuid
+import requests
+from requests.structures import CaseInsensitiveDict
+from .scheduler import ScheduledSession, Scheduler
+from .table import TableError
+
+DEFAULT_BATCH_SIZE = 20
+
+class _BatchItem:
+    def __init__(self, url: str, params: dict, headers: dict):
+        self.url = url
+        self.params = params
+        self.headers = headers
+        self.response = None
+        self.error = None
+        self.done = threading.Event()
+
+class BatchSession(ScheduledSession):
+    """A session that packs concurrent Table API (and Aggregate API) GETs into /api/now/v1/batch calls.
+
+    Every thread calling get() for a Table API URL waits while its request is queued. A dispatcher thread sends up
+    to batch_size queued requests per batch call (waiting at most linger seconds for a batch to fill up) with no more
+    than in_flight batch calls running at once, then hands each caller a regular Response rebuilt from its part of
+    the batch envelope, so status and error handling downstream stays exactly the same. Anything else, and every
+    request after the instance turns out not to support the Batch API, is sent on its own."""
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, in_flight: int = 1, linger: float = 0.05, scheduler: Scheduler = None):
+        super().__init__(scheduler)
+        self.batch_size = batch_size
+        self.linger = linger
+        self._pending = []
+        self._lock = threading.Condition()
+        self._slots = threading.Semaphore(max(in_flight, 1))
+        self._pool = ThreadPoolExecutor(max_workers=max(in_flight, 1))
+        self._dispatcher = None
+        self._disabled = False
+
+    def get(self, url, params=None, **kwargs):
+        if self._disabled or self.batch_size <= 1 or not ("/api/now/table/" in url or "/api/now/stats/" in url) or set(kwargs) - {"headers"}:
+            return super().get(url, params=params, **kwargs)
+        item = _BatchItem(url, params or {}, kwargs.get("headers") or {})
+        with self._lock:
+            self._pending.append(item)
+            if self._dispatcher == None:
+                self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+                self._dispatcher.start()
+            self._lock.notify_all()
+        item.done.wait()
+        if item.error != None:
+            raise item.error
+        return item.response
+
+    def _dispatch(self):
+        while True:
+            # Waiting for a free slot first lets the next batch fill up while the previous ones are in flight
+            self._slots.acquire()
+            with self._lock:
+                while len(self._pending) == 0:
+                    self._lock.wait()
+                deadline = time.time() + self.linger
+                while len(self._pending) < self.batch_size and time.time() < deadline:
+                    self._lock.wait(deadline - time.time())
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+            self._pool.submit(self._send, batch)
+
+    def _send(self, batch):
+        try:
+            if self._disabled or len(batch) == 1:
+                self._send_each(batch)
+                return
+            base = batch[0].url[:batch[0].url.index("/api/now/")]
+            rest_requests = []
+            for i, item in enumerate(batch):
+                headers = dict(item.headers)
+                headers.setdefault("Accept", "application/json")
+                rest_requests.append({
+                    "id": str(i),
+                    "method": "GET",
+                    "url": item.url[len(base):] + ("?" + urlencode(item.params) if len(item.params) > 0 else ""),
+                    "headers": [{"name": k, "value": v} for k, v in headers.items()],
+                })
+            start = time.time()
+            resp = super().post(base + "/api/now/v1/batch", json={"batch_request_id": str(uuid.uuid4()), "rest_requests": rest_requests},
+                headers={"Accept": "application/json", "Content-Type": "application/json"})
+            if resp.status_code in (400, 404, 405):
+                # No Batch API on this instance (or it's been turned off), so stop trying
+                self._disabled = True
+                self._send_each(batch)
+                return
+            if resp.status_code != 200:
+                # Auth, throttling and server errors apply to every request in the batch alike
+                for item in batch:
+                    item.response = resp
+                return
+            try:
+                body = resp.json()
+            except ValueError:
+                body = None
+            if not isinstance(body, dict):
+                # most likely a login or maintenance page served with a 200
+                raise TableError(resp.status_code, "The Batch API answered with something other than JSON (status " + str(resp.status_code)
+                    + "). The instance may want you to log in again, try again without --batch-size.")
+            serviced = {}
+            for part in body.get("serviced_requests") or []:
+                serviced[str(part.get("id"))] = part
+            elapsed = datetime.timedelta(seconds=time.time() - start)
+            for i, item in enumerate(batch):
+                part = serviced.get(str(i))
+                if part == None: # unserviced, most likely because the batch ran out of time on the instance
+                    self._send_each([item])
+                else:
+                    item.response = unpack(item, part, elapsed)
+        except Exception as e:
+            for item in batch:
+                if item.response == None and item.error == None:
+                    item.error = e
+        finally:
+            for item in batch:
+                item.done.set()
+            self._slots.release()
+
+    def _send_each(self, batch):
+        for item in batch:
+            try:
+                item.response = super().get(item.url, params=item.params, headers=item.headers)
+            except Exception as e:
+                item.error = e
+
+def unpack(item: _BatchItem, part: dict, elapsed: datetime.timedelta) -> requests.Response:
+    """Rebuilds a Response from a serviced request of a batch envelope, whose body is base64 encoded."""
+    resp = requests.Response()
+    resp.status_code = int(part.get("status_code", 0))
+    resp.reason = part.get("status_text")
+    resp._content = base64.b64decode(part.get("body") or "")
+    resp.headers = CaseInsensitiveDict(dict((h.get("name"), h.get("value")) for h in part.get("headers") or []))
+    resp.encoding = "utf-8"
+    resp.url = item.url + ("?" + urlencode(item.params) if len(item.params) > 0 else "")
+    resp.elapsed = elapsed
+    return resp
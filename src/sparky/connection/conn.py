@@ -1,13 +1,33 @@
-import keyring
 import sqlite3
 import click
+import time
 from pathlib import Path
-from typing import Tuple
+from typing import List, Tuple
 import requests
+from . import db
+from .batch import BatchSession
+from .scheduler import DEFAULT_MAX_RETRIES, ScheduledSession, Scheduler
+from ..timings import mark
 import os, sys
 
-def setup_connection() -> Tuple[requests.Session, str]:
-    """Constructs the session using our profile and performs checks to ensure querying will go smoothly."""
+DEFAULT_PREFLIGHT_TTL = 60 # minutes
+
+# Minutes a successful pre-flight check is trusted for, set by 'sparky --preflight-ttl'. Kept here rather than read from
+# the click context, which worker threads connecting to several profiles at once don't have.
+preflight_ttl = DEFAULT_PREFLIGHT_TTL
+
+# Sessions kept open between commands by 'sparky shell', keyed by profile and connection settings. None outside the shell.
+_sessions = None
+
+def keep_sessions():
+    """Makes setup_connection hand back the same session (and its kept-alive connections) every time it is called
+    with the same profile and settings, for as long as the process lives."""
+    global _sessions
+    if _sessions == None:
+        _sessions = {}
+
+def get_selected_profile() -> Tuple[int, str, str, str]:
+    """Returns the rowid, profile name, user and URL of the selected profile."""
     try:
         wd = Path(__file__).parent.parent.resolve()
         conn = sqlite3.connect(os.path.join(wd, 'sparky.db'))
@@ -22,6 +42,51 @@ def setup_connection() -> Tuple[requests.Session, str]:
         sys.exit()
     finally:
         conn.close()
+    return sel_resp
+
+def get_profiles(names: List[str] = None) -> List[Tuple[int, str, str, str]]:
+    """Returns the rowid, profile name, user and URL of each named profile (names can also be row IDs), or of every
+    profile if no names are given."""
+    try:
+        wd = Path(__file__).parent.parent.resolve()
+        conn = sqlite3.connect(os.path.join(wd, 'sparky.db'))
+        cur = conn.cursor()
+        profs = cur.execute("""SELECT rowid, profile_name, user, url FROM profile ORDER BY rowid;""").fetchall()
+    except Exception as e:
+        click.secho("Error loading profiles during connection setup. Aborting with error: " + str(e), fg="red")
+        sys.exit()
+    finally:
+        conn.close()
+    if names == None:
+        if len(profs) == 0:
+            click.secho("You have no profiles. Type 'sparky profile new' to create a new one.", fg="red")
+            sys.exit()
+        return profs
+    ret = []
+    for name in names:
+        found = [p for p in profs if p[1] == name or str(p[0]) == name]
+        if len(found) == 0:
+            click.secho("No profile found with name or Row ID " + name + ".", fg="red")
+            sys.exit()
+        if found[0] not in ret:
+            ret.append(found[0])
+    return ret
+
+def setup_connection(workers: int = 1, profile: Tuple[int, str, str, str] = None, batch_size: int = 0, rate: float = 0,
+        max_retries: int = DEFAULT_MAX_RETRIES) -> Tuple[requests.Session, str]:
+    """Constructs the session using our profile and performs checks to ensure querying will go smoothly.
+    The session keeps enough pooled connections alive to be shared between the given number of workers. With a
+    batch size above 1, Table API requests made at the same time are sent together through the Batch API.
+    Every request goes through a Scheduler that starts at the given rate (0 for no limit until throttled) and
+    retries throttled requests up to max_retries times."""
+    import keyring
+    sel_resp = profile or get_selected_profile()
+    key = (sel_resp[0], sel_resp[2], sel_resp[3], workers, batch_size, rate, max_retries)
+    if _sessions != None and key in _sessions:
+        s, url = _sessions[key]
+        click.echo("Profile " + click.style(sel_resp[1], fg="green") + " is selected. (" + url + ")")
+        mark("connection (kept alive)")
+        return s, url
     # Make sure we can get the password
     pw = keyring.get_password("sparky - " + str(sel_resp[0]) + " - " + sel_resp[1], sel_resp[2])
     if pw == None:
@@ -38,11 +103,15 @@ def setup_connection() -> Tuple[requests.Session, str]:
     if not url.endswith("service-now.com"):
         url += ".service-now.com"
 
+    mark("credentials")
     click.echo("Profile " + click.style(sel_resp[1], fg="green") + " is selected. (" + url + ")")
-    
+
     # Do pre-flight check for access to instance and ability to query admin tables
-    s = requests.Session()
+    s = new_session(workers, batch_size, rate, max_retries)
     s.auth = (str(sel_resp[2]), pw)
+    if preflight_passed(sel_resp, url):
+        mark("pre-flight (cached)")
+        return keep(key, s, url)
     resp = s.get(url + '/api/now/table/sys_dictionary', params = {'sysparm_fields': 'sys_id', 'sysparm_limit': '1'}, headers={'Content-Type': 'application/json'})
     if resp.status_code == 401:
         click.secho("User credentials for the selected profile failed to authentcate.", fg="red")
@@ -51,9 +120,62 @@ def setup_connection() -> Tuple[requests.Session, str]:
         click.secho("The profile selected is not authorized to query admin tables. Please ensure your ServiceNow user has admin access.", fg="red")
         sys.exit()
     elif resp.status_code >= 200 and resp.status_code <= 299:
-        return s, url
+        save_preflight(sel_resp, url)
+        mark("pre-flight")
+        return keep(key, s, url)
     else:
         click.secho("Abnormal status code for instance (" + str(resp.status_code) + "), aborting.", fg="red")
         sys.exit()
 
+def new_session(workers: int = 1, batch_size: int = 0, rate: float = 0, max_retries: int = DEFAULT_MAX_RETRIES) -> requests.Session:
+    """Returns a session with its own Scheduler and a connection pool big enough for the given number of workers,
+    batching Table API requests if batch_size is above 1. It isn't logged in to anything yet."""
+    scheduler = Scheduler(workers, rate, max_retries)
+    s = BatchSession(batch_size, workers, scheduler=scheduler) if batch_size > 1 else ScheduledSession(scheduler)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+def keep(key: tuple, s: requests.Session, url: str) -> Tuple[requests.Session, str]:
+    if _sessions != None:
+        _sessions[key] = (s, url)
+    return s, url
+
+def preflight_passed(profile: Tuple[int, str, str, str], url: str) -> bool:
+    """Returns whether the profile passed the pre-flight check against the same URL and user recently enough to skip it."""
+    ttl = preflight_ttl
+    if ttl <= 0:
+        return False
+    conn = db.connect()
+    try:
+        row = conn.execute("SELECT checked_on FROM preflight WHERE profile_id = ? AND url = ? AND user = ?;", (profile[0], url, profile[2])).fetchone()
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+    return row != None and time.time() - row[0] < ttl * 60
+
+def save_preflight(profile: Tuple[int, str, str, str], url: str):
+    conn = db.connect()
+    try:
+        conn.execute("INSERT OR REPLACE INTO preflight VALUES (?, ?, ?, ?);", (profile[0], url, profile[2], time.time()))
+        conn.commit()
+    except sqlite3.Error:
+        pass
+    finally:
+        conn.close()
 
+def clear_preflight(profile_id: int):
+    """Makes the next connection with the profile run the pre-flight check again (and open a new session)."""
+    if _sessions != None:
+        for key in [k for k in _sessions if k[0] == profile_id]:
+            _sessions.pop(key)[0].close()
+    conn = db.connect()
+    try:
+        conn.execute("DELETE FROM preflight WHERE profile_id = ?;", (profile_id,))
+        conn.commit()
+    except sqlite3.Error:
+        pass
+    finally:
+        conn.close()
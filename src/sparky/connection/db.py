@@ -0,0 +1,8 @@
+import sqlite3
+from pathlib import Path
+import os
+
+def connect() -> sqlite3.Connection:
+    """Opens the sparky database that lives next to the package."""
+    wd = Path(__file__).parent.parent.resolve()
+    return sqlite3.connect(os.path.join(wd, 'sparky.db'))
@@ -0,0 +1,166 @@
+from collections import deque
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+import requests
+
+DEFAULT_MAX_RETRIES = 5
+
+# Statuses worth repeating the same request for. A 500 usually means the query itself upset the instance, so it
+# is left to the scan's own retry queue instead.
+RETRY_STATUSES = (429, 502, 503, 504)
+
+class Scheduler:
+    """Decides when requests may be sent, shared by every thread using a session.
+
+    Two limits adapt to the instance AIMD-style: the number of requests in flight and (once the instance has throttled
+    us) a token bucket rate. Both grow additively while requests succeed and are cut multiplicatively on a 429 or
+    when latency climbs far above the best seen so far, so throughput settles just under the instance's ceiling.
+    A Retry-After pauses every thread, not just the one that got it."""
+
+    def __init__(self, max_concurrency: int = 1, rate: float = 0, max_retries: int = DEFAULT_MAX_RETRIES, backoff: float = 0.5, max_backoff: float = 60):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.limit = float(self.max_concurrency)
+        self.rate = rate if rate > 0 else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.throttled = 0
+        self.retried = 0
+        self._tokens = 1.0
+        self._refilled = time.time()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._latency_floor = None
+        self._sent = deque()
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        with self._cond:
+            while True:
+                now = time.time()
+                if now < self._paused_until:
+                    self._cond.wait(self._paused_until - now)
+                    continue
+                if self._in_flight >= int(self.limit):
+                    self._cond.wait(0.5)
+                    continue
+                if self.rate != None:
+                    self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._refilled) * self.rate)
+                    self._refilled = now
+                    if self._tokens < 1:
+                        self._cond.wait((1 - self._tokens) / self.rate)
+                        continue
+                    self._tokens -= 1
+                self._in_flight += 1
+                self._sent.append(now)
+                return
+
+    def release(self, status: int, latency: float):
+        """Records the outcome of a request sent after acquire(). status is None if no response came back."""
+        with self._cond:
+            self._in_flight -= 1
+            now = time.time()
+            if status == 429:
+                self.throttled += 1
+                self._decrease(now, 0.8)
+            elif status != None and status < 500:
+                if self._latency_floor == None or latency < self._latency_floor:
+                    self._latency_floor = latency
+                if latency > 1 and latency > self._latency_floor * 4:
+                    # the instance is struggling to keep up even if it isn't saying so yet
+                    self._decrease(now, 0.9)
+                else:
+                    self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+                    if self.rate != None:
+                        self.rate += 0.1
+            self._cond.notify_all()
+
+    def pause(self, seconds: float):
+        """Holds back every request for the given number of seconds."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """How long to wait before retrying: what the instance asked for if it did, otherwise a jittered exponential backoff.
+        Either is capped at max_backoff, since a Retry-After pauses every thread and a bogus one would stall them all."""
+        if retry_after != None:
+            retry_after = min(retry_after, self.max_backoff)
+            self.pause(retry_after)
+            return retry_after
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def throughput(self) -> float:
+        """Requests per second sent over the last few seconds."""
+        with self._cond:
+            return self._throughput(time.time())
+
+    def _throughput(self, now: float) -> float:
+        while len(self._sent) > 0 and self._sent[0] < now - 5:
+            self._sent.popleft()
+        if len(self._sent) == 0:
+            return 0.0
+        # don't let the first few seconds of a scan look slower than they are
+        return len(self._sent) / max(now - self._sent[0], 1.0)
+
+    def _decrease(self, now: float, factor: float):
+        # A burst of 429s all report the same congestion, so only back off once per second
+        if now - self._last_decrease < 1:
+            return
+        self._last_decrease = now
+        self.limit = max(1.0, self.limit * factor)
+        self.rate = max(0.5, (self.rate or self._throughput(now) or 1.0) * factor)
+
+def retry_after(resp: requests.Response) -> float:
+    """Returns the number of seconds a Retry-After header asks for, or None."""
+    value = resp.headers.get("Retry-After")
+    if value == None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class ScheduledSession(requests.Session):
+    """A session whose requests all go through a Scheduler, retrying throttled or unavailable responses and dropped
+    connections up to the scheduler's max_retries before handing back the last response."""
+
+    def __init__(self, scheduler: Scheduler = None):
+        super().__init__()
+        self.scheduler = scheduler or Scheduler()
+
+    def request(self, method, url, *args, **kwargs):
+        attempt = 0
+        first = time.time()
+        while True:
+            self.scheduler.acquire()
+            start = time.time()
+            try:
+                resp = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.scheduler.release(None, time.time() - start)
+                if attempt >= self.scheduler.max_retries:
+                    raise
+                self.scheduler.retried += 1
+                time.sleep(self.scheduler.delay(attempt))
+                attempt += 1
+                continue
+            self.scheduler.release(resp.status_code, time.time() - start)
+            if resp.status_code not in RETRY_STATUSES or attempt >= self.scheduler.max_retries:
+                # kept for the --stats report, which wants the whole wait and not just the last attempt
+                resp.retries = attempt
+                resp.total_time = time.time() - first
+                return resp
+            self.scheduler.retried += 1
+            wait = self.scheduler.delay(attempt, retry_after(resp))
+            # hand the connection back to the pool rather than holding it while we wait
+            resp.close()
+            time.sleep(wait)
+            attempt += 1
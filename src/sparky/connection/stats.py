@@ -0,0 +1,116 @@
+from typing import List
+from urllib.parse import parse_qs, urlparse
+import re
+import threading
+
+# Set by --stats and --stats-json. Every Table and Aggregate API response and attachment download while this is on is recorded.
+enabled = False
+_requests = []
+_lock = threading.Lock()
+
+API_PATH = re.compile(r"/api/now/(?:v\d+/)?(table|stats|attachment)/([^/?]+)")
+LIKE_FIELD = re.compile(r"(?:^|\^)(?:OR)?([\w.]+)LIKE")
+
+def reset():
+    """Starts recording a new command, for commands run one after another in the same process."""
+    global enabled
+    enabled = False
+    with _lock:
+        del _requests[:]
+
+def record(resp, rows: int, error: str = None, size: int = None):
+    """Records a response once its records have been read. The field is whatever the query searched with LIKE, so
+    for a scan it's the fields of the table being scanned. size is the number of bytes of a streamed response,
+    whose content can't be looked at anymore."""
+    if not enabled:
+        return
+    url = urlparse(resp.url or "")
+    path = API_PATH.search(url.path)
+    query = parse_qs(url.query).get("sysparm_query", [""])[0]
+    fields = []
+    for field in LIKE_FIELD.findall(query):
+        if field not in fields:
+            fields.append(field)
+    entry = {
+        "api": path.group(1) if path != None else "",
+        "table": path.group(2) if path != None else url.path,
+        "field": ",".join(fields),
+        "ms": getattr(resp, "total_time", resp.elapsed.total_seconds()) * 1000,
+        "bytes": len(resp.content or b"") if size == None else size,
+        "rows": rows,
+        "status": resp.status_code,
+        "retries": getattr(resp, "retries", 0),
+        "error": error,
+    }
+    with _lock:
+        _requests.append(entry)
+
+def by_table() -> List[dict]:
+    """Sums up the recorded requests per table, slowest first."""
+    tables = {}
+    for r in list(_requests):
+        t = tables.setdefault(r["table"], {"table": r["table"], "fields": [], "requests": 0, "rows": 0, "bytes": 0, "ms": 0.0, "max_ms": 0.0, "retries": 0, "statuses": {}})
+        for field in r["field"].split(","):
+            if field != "" and field not in t["fields"]:
+                t["fields"].append(field)
+        t["requests"] += 1
+        t["rows"] += r["rows"]
+        t["bytes"] += r["bytes"]
+        t["ms"] += r["ms"]
+        t["max_ms"] = max(t["max_ms"], r["ms"])
+        t["retries"] += r["retries"]
+        t["statuses"][str(r["status"])] = t["statuses"].get(str(r["status"]), 0) + 1
+    return sorted(tables.values(), key=lambda t: t["ms"], reverse=True)
+
+def skipped() -> List[dict]:
+    """Returns the (table, status, error) of every request that didn't return records, once per table and status."""
+    ret = []
+    seen = set()
+    for r in list(_requests):
+        if r["status"] != 200 and (r["table"], r["status"]) not in seen:
+            seen.add((r["table"], r["status"]))
+            ret.append({"table": r["table"], "status": r["status"], "error": r["error"]})
+    return ret
+
+def summary() -> dict:
+    requests = list(_requests)
+    statuses = {}
+    for r in requests:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    return {
+        "requests": len(requests),
+        "retries": sum(r["retries"] for r in requests),
+        "rows": sum(r["rows"] for r in requests),
+        "bytes": sum(r["bytes"] for r in requests),
+        "ms": sum(r["ms"] for r in requests),
+        "statuses": statuses,
+    }
+
+def report(show: bool = True, filename: str = None, top: int = 10):
+    """Prints what was recorded to stderr, if show, and writes all of it to filename as JSON, if given."""
+    import click
+    totals = summary()
+    if show:
+        click.secho("\n[ " + str(totals["requests"]) + " requests, " + str(totals["retries"]) + " retries, " + str(totals["rows"]) + " rows, "
+            + "{:.1f}".format(totals["bytes"] / 1024.0) + " KB, " + "{:.1f}".format(totals["ms"] / 1000.0) + "s spent waiting on the instance ]", bold=True, err=True)
+        tables = by_table()
+        if len(tables) > 0:
+            click.secho("{:<40} {:<30} {:>8} {:>8} {:>10} {:>10} {:>10} {:>8}".format('Slowest tables', 'Fields', 'Requests', 'Rows', 'KB', 'Total ms', 'Max ms', 'Retries'),
+                fg="bright_white", bold=True, err=True)
+            for t in tables[:top]:
+                click.echo("{:<40} {:<30} {:>8} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}".format(t["table"], ",".join(t["fields"]), t["requests"], t["rows"],
+                    t["bytes"] / 1024.0, t["ms"], t["max_ms"], t["retries"]), err=True)
+        skips = skipped()
+        if len(skips) > 0:
+            click.secho("\nSkipped tables", fg="bright_white", bold=True, err=True)
+            for s in skips:
+                click.echo("{:<40} {:>4} {}".format(s["table"], s["status"], s["error"] or ""), err=True)
+        click.secho("\nStatus codes", fg="bright_white", bold=True, err=True)
+        for status, count in sorted(totals["statuses"].items()):
+            click.echo("{:<8} {:>8}".format(status, count), err=True)
+    if filename != None:
+        import json
+        with open(filename, "w") as file:
+            json.dump({"summary": totals, "tables": by_table(), "skipped": skipped(), "requests": list(_requests)}, file, indent=2)
+        if show:
+            click.secho("Stats written to " + filename, dim=True, err=True)
@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator, Tuple
+import queue
+import threading
+
+_DONE = object()
+
+class OrderedStream:
+    """Runs generator functions on a bounded thread pool and hands back what they yield in submission order.
+
+    Each task gets a small queue, so a task that finishes early only buffers a few items before it waits for the
+    consumer to catch up. Iterating the stream yields (key, items) for every task in the order it was submitted;
+    items must be consumed before moving on to the next task and re-raises whatever the task raised.
+    Use it as a context manager so that aborting mid-way stops every task that is still running."""
+
+    def __init__(self, workers: int, buffer: int = 2):
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._stop = threading.Event()
+        self._buffer = max(buffer, 1)
+        self._tasks = []
+
+    def submit(self, key: Any, fn: Callable[..., Iterator[Any]], *args, **kwargs):
+        q = queue.Queue(maxsize=self._buffer)
+        self._tasks.append((key, q, self._pool.submit(self._run, q, fn, args, kwargs)))
+
+    def __iter__(self) -> Iterator[Tuple[Any, Iterator[Any]]]:
+        for key, q, _ in self._tasks:
+            yield key, self._drain(q)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        for _, _, future in self._tasks:
+            future.cancel()
+        self._pool.shutdown()
+
+    def _run(self, q: queue.Queue, fn: Callable[..., Iterator[Any]], args, kwargs):
+        if self._stop.is_set():
+            return
+        try:
+            for item in fn(*args, **kwargs):
+                if not self._put(q, (True, item)):
+                    return
+        except BaseException as e:
+            self._put(q, (False, e))
+            return
+        self._put(q, (True, _DONE))
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """Waits for room in the queue, giving up if the stream was closed in the meantime."""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _drain(self, q: queue.Queue) -> Iterator[Any]:
+        while True:
+            ok, item = q.get()
+            if not ok:
+                raise item
+            if item is _DONE:
+                return
+            yield item
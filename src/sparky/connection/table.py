@@ -0,0 +1,88 @@
+from typing import Dict, Iterator, List
+import requests
+from . import stats
+
+DEFAULT_PAGE_SIZE = 1000
+
+class TableError(Exception):
+    """Raised when the Table API responds with something we can't read records from. Callers decide whether the
+    status code means the table should be skipped or the whole run aborted."""
+    def __init__(self, status_code: int, message: str = None):
+        super().__init__(message or "Received status code " + str(status_code))
+        self.status_code = status_code
+        self.message = message
+
+def get_pages(s: requests.Session, url: str, table: str, params: Dict[str, str], page_size: int = DEFAULT_PAGE_SIZE,
+        offset: int = 0) -> Iterator[List[dict]]:
+    """Yields the records matching params one page at a time using sysparm_limit/sysparm_offset, so only a single page
+    is ever held in memory and the instance's default row cap never silently truncates the results. offset skips
+    that many records first."""
+    params = dict(params)
+    query = params.get("sysparm_query", "")
+    # Offsets are only stable if the order is, so always sort by something that can't change between pages
+    if "ORDERBY" not in query:
+        params["sysparm_query"] = (query + "^" if query != "" else "") + "ORDERBYsys_id"
+    params["sysparm_limit"] = str(page_size)
+    params["sysparm_no_count"] = "true"
+    while True:
+        params["sysparm_offset"] = str(offset)
+        resp = s.get(url + "/api/now/table/" + table, params=params, headers={"Accept": "application/json"})
+        page = read_result(resp)
+        if len(page) > 0:
+            yield page
+        if len(page) < page_size:
+            return
+        offset += len(page)
+
+def get_records(s: requests.Session, url: str, table: str, params: Dict[str, str], page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[dict]:
+    """Same as get_pages, but yields the records one by one."""
+    for page in get_pages(s, url, table, params, page_size):
+        for record in page:
+            yield record
+
+def read_result(resp: requests.Response) -> List[dict]:
+    """Returns the result list of a Table API response, raising a TableError if there isn't one."""
+    try:
+        result = parse_result(resp)
+    except TableError as e:
+        stats.record(resp, 0, e.message)
+        raise
+    stats.record(resp, len(result))
+    return result
+
+def parse_result(resp: requests.Response) -> List[dict]:
+    try:
+        body = resp.json()
+    except ValueError:
+        raise TableError(resp.status_code, "Invalid response received (status " + str(resp.status_code) + ")")
+    if resp.status_code != 200 or body.get('result') == None:
+        error = body.get('error')
+        if isinstance(error, dict):
+            error = error.get('message')
+        raise TableError(resp.status_code, None if error == None else str(error))
+    result = body['result']
+    # A lookup by sys_id can come back as a single record instead of a list
+    if isinstance(result, dict):
+        return [result]
+    return result
+
+def count_records(s: requests.Session, url: str, table: str, query: str = None) -> int:
+    """Counts the records matching a query with the Aggregate API, which is far cheaper for the instance than
+    building a result set. Raises a TableError if the table can't be counted."""
+    params = {"sysparm_count": "true"}
+    if query != None:
+        params["sysparm_query"] = query
+    result = read_result(s.get(url + "/api/now/stats/" + table, params=params, headers={"Accept": "application/json"}))
+    return int(result[0].get('stats', {}).get('count') or 0)
+
+def count_by_class(s: requests.Session, url: str, table: str, query: str = None) -> Dict[str, int]:
+    """Counts the records of a table and everything that extends it, grouped by the class (table) they live in."""
+    params = {"sysparm_count": "true", "sysparm_group_by": "sys_class_name"}
+    if query != None:
+        params["sysparm_query"] = query
+    ret = {}
+    for group in read_result(s.get(url + "/api/now/stats/" + table, params=params, headers={"Accept": "application/json"})):
+        for field in group.get('groupby_fields') or []:
+            if field.get('field') == 'sys_class_name':
+                ret[field.get('value') or table] = int(group.get('stats', {}).get('count') or 0)
+    return ret
@@ -1,4 +1,7 @@
+from . import timings
+from .connection import stats
 import click
+import functools
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
@@ -6,9 +9,49 @@ CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
     help="A tool to help find code in any ServiceNow instance.",
     context_settings=CONTEXT_SETTINGS,
 )
-def cli() -> None:
+@click.option(
+    "--timings",
+    "show_timings",
+    help="Report how long startup, imports and connecting took once the command finishes.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--preflight-ttl",
+    help="Minutes a successful connection check of a profile is trusted for before checking again (0 checks every time).",
+    type=click.IntRange(0),
+    default=60,
+    show_default=True,
+)
+@click.option(
+    "--stats",
+    "show_stats",
+    help="Report the slowest tables, bytes downloaded, skipped tables and status codes of every request once the command finishes.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--stats-json",
+    help="Write every request the command made (table, fields, latency, bytes, rows, status and retries) to this file as JSON.",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+)
+@click.pass_context
+def cli(ctx: click.Context, show_timings: bool, preflight_ttl: int, show_stats: bool, stats_json: str) -> None:
+    if show_timings:
+        timings.enabled = True
+        timings.mark("imports")
+        ctx.call_on_close(timings.report)
+    if show_stats or stats_json != None:
+        stats.enabled = True
+        ctx.call_on_close(lambda: stats.report(show_stats, stats_json))
+    if ctx.get_parameter_source("preflight_ttl") != click.core.ParameterSource.DEFAULT:
+        # imported only when given, so commands that never connect don't load requests
+        from .connection import conn
+        conn.preflight_ttl = preflight_ttl
     from .cmd_funcs.profile import startup_profile
     startup_profile()
+    timings.mark("startup")
 
 @cli.command("version", help="Shows the current version.")
 def version_cmd() -> None:
@@ -50,6 +93,180 @@ def profile_edit():
     from .cmd_funcs.profile import edit_profile
     edit_profile()
 
+### SHARED OPTIONS
+
+PROFILE_OPTIONS = [
+    click.option(
+        "--profiles",
+        help="Comma separated list of profile names (or Row IDs) to search at the same time instead of the selected profile.",
+        type=str,
+        default=None,
+    ),
+    click.option(
+        "--all-profiles",
+        help="Search every profile at the same time instead of the selected profile.",
+        is_flag=True,
+        default=False,
+    ),
+]
+
+PATTERN_OPTIONS = [
+    click.option(
+        "-p",
+        "--pattern",
+        help="String to search for. Can be given more than once to search for several strings in the same pass. Asked for if not given.",
+        type=str,
+        multiple=True,
+    ),
+    click.option(
+        "--patterns-file",
+        help="File listing strings to search for, one per line. Combined with any --pattern.",
+        type=str,
+        default=None,
+    ),
+]
+
+SCAN_OPTIONS = [
+    click.option(
+        "-w",
+        "--workers",
+        help="Number of tables to scan concurrently. Results are still printed in a stable order.",
+        type=click.IntRange(1, 64),
+        default=1,
+        show_default=True,
+    ),
+    click.option(
+        "--page-size",
+        help="Number of records to request per page. Results are printed while later pages are still downloading.",
+        type=click.IntRange(1, 10000),
+        default=1000,
+        show_default=True,
+    ),
+    click.option(
+        "--local",
+        help="Search the local mirror created by 'sparky sync' instead of the instance.",
+        is_flag=True,
+        default=False,
+    ),
+    click.option(
+        "--regex",
+        help="Treat the query string as a regular expression. Requires --local.",
+        is_flag=True,
+        default=False,
+    ),
+    click.option(
+        "-i",
+        "--ignore-case",
+        help="Match the query string regardless of case. Requires --local.",
+        is_flag=True,
+        default=False,
+    ),
+    click.option(
+        "--cache-ttl",
+        help="Minutes to reuse the cached list of tables to scan before checking sys_dictionary for changes. 0 disables the cache.",
+        type=click.IntRange(0),
+        default=24 * 60,
+        show_default=True,
+    ),
+    click.option(
+        "--refresh-tables",
+        help="Reload the list of tables to scan from sys_dictionary instead of using the cached list.",
+        is_flag=True,
+        default=False,
+    ),
+    click.option(
+        "--batch-size",
+        help="Send this many table queries per request through the ServiceNow Batch API. Useful on high latency links. 0 sends every query on its own.",
+        type=click.IntRange(0, 100),
+        default=0,
+        show_default=True,
+    ),
+    click.option(
+        "--rate",
+        help="Maximum requests per second to start with. The rate adapts to how fast the instance lets us go either way. 0 starts without a limit.",
+        type=click.FloatRange(0),
+        default=0,
+        show_default=True,
+    ),
+    click.option(
+        "--max-retries",
+        help="Number of times a throttled (429) or unavailable request is retried, honoring Retry-After, before the table is queued for one last try at the end of the scan.",
+        type=click.IntRange(0, 20),
+        default=5,
+        show_default=True,
+    ),
+    click.option(
+        "--explain",
+        help="Show which tables a scan would query and which it would skip (covered by a parent table or empty), without running it.",
+        is_flag=True,
+        default=False,
+    ),
+    click.option(
+        "-C",
+        "--context",
+        help="Show the lines of every result that matched, with this many lines of context around them. The lines come with the results, so no extra requests are made.",
+        type=click.IntRange(0, 50),
+        default=None,
+    ),
+    click.option(
+        "--count-first",
+        help="Count the matches of every table with the Aggregate API first and only fetch records from tables that have any. Saves a lot of work on the instance for selective searches.",
+        is_flag=True,
+        default=False,
+    ),
+    click.option(
+        "--shard-size",
+        help="Split tables with more records than this into sys_id ranges that are scanned in parallel (0 disables). Needs the row counts from scan planning.",
+        type=click.IntRange(0),
+        default=50000,
+        show_default=True,
+    ),
+    click.option(
+        "--no-plan",
+        help="Query every table in the list, even those covered by a parent table or empty. The table hierarchy is cached for --cache-ttl minutes, row counts are taken again on every scan.",
+        is_flag=True,
+        default=False,
+    ),
+]
+
+OUTPUT_OPTIONS = [
+    click.option(
+        "--output",
+        "output_format",
+        help="How to write the results. jsonl and csv give one row per result (or matching line) for other tools to read; everything else the command prints then goes to stderr.",
+        type=click.Choice(["table", "jsonl", "csv"]),
+        default="table",
+        show_default=True,
+    ),
+    click.option(
+        "--out",
+        "out_file",
+        help="Write the results to this file instead of stdout. Rows are written in batches as they are found.",
+        type=str,
+        default=None,
+    ),
+]
+
+def with_options(options):
+    """Applies a list of shared options to a command, in the order they are listed."""
+    def decorator(fn):
+        for option in reversed(options):
+            fn = option(fn)
+        return fn
+    return decorator
+
+def with_output(fn):
+    """Adds the output options to a command and sends its results to the chosen sink while it runs."""
+    @functools.wraps(fn)
+    def wrapper(*args, output_format: str, out_file: str, **kwargs):
+        from .cmd_funcs import output
+        output.open_sink(output_format, out_file)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            output.close_sink()
+    return with_options(OUTPUT_OPTIONS)(wrapper)
+
 ### QUERY COMMANDS
 
 @cli.group("query", help="All commands for querying using the selected profile. Use the command 'sparky query -h' for additional options. Please note that these commands will not work if you have not both created and selected a profile.")
@@ -69,9 +286,13 @@ def query_cmd() -> None:
     default=None,
     required=False,
 )
-def query_script(filename: str):
+@with_options(SCAN_OPTIONS)
+@with_options(PATTERN_OPTIONS)
+@with_options(PROFILE_OPTIONS)
+@with_output
+def query_script(filename: str, **options):
     from .cmd_funcs.query import run_query
-    run_query("script", filename)
+    run_query("script", filename, **options)
 
 @query_cmd.command("html", help="Queries against HTML fields using the selected profile.")
 @click.option(
@@ -86,9 +307,13 @@ def query_script(filename: str):
     default=None,
     required=False,
 )
-def query_html(filename: str):
+@with_options(SCAN_OPTIONS)
+@with_options(PATTERN_OPTIONS)
+@with_options(PROFILE_OPTIONS)
+@with_output
+def query_html(filename: str, **options):
     from .cmd_funcs.query import run_query
-    run_query("html", filename)
+    run_query("html", filename, **options)
 
 @query_cmd.command("xml", help="Queries against XML fields using the selected profile.")
 @click.option(
@@ -103,23 +328,386 @@ def query_html(filename: str):
     default=None,
     required=False,
 )
-def query_xml(filename: str):
+@with_options(SCAN_OPTIONS)
+@with_options(PATTERN_OPTIONS)
+@with_options(PROFILE_OPTIONS)
+@with_output
+def query_xml(filename: str, **options):
     from .cmd_funcs.query import run_query
-    run_query("xml", filename)
-    
+    run_query("xml", filename, **options)
+
 @query_cmd.command("workflow", help="Performs queries against scripts in workflows.")
-def query_wf():
+@click.option(
+    "--page-size",
+    help="Number of records to request per page. Results are printed while later pages are still downloading.",
+    type=click.IntRange(1, 10000),
+    default=1000,
+    show_default=True,
+)
+@with_options(PROFILE_OPTIONS)
+@click.option(
+    "--all-workflows",
+    help="Search every published workflow instead of a single one.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--contains",
+    help="Search every published workflow whose name contains the name entered.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--chunk-size",
+    help="Number of workflow activities to search per request.",
+    type=click.IntRange(1, 500),
+    default=100,
+    show_default=True,
+)
+@with_output
+def query_wf(page_size: int, profiles: str, all_profiles: bool, all_workflows: bool, contains: bool, chunk_size: int):
+    from .cmd_funcs.fanout import parse_profiles
     from .cmd_funcs.query import query_workflow
-    query_workflow()
+    match = "all" if all_workflows else "contains" if contains else "exact"
+    query_workflow(page_size, parse_profiles(profiles, all_profiles), match, chunk_size)
 
+@query_cmd.command("resume", help="Finishes a script/HTML/XML scan that was interrupted, then prints all of its results. Only the tables the scan hadn't finished yet are queried. Defaults to the latest unfinished scan of the selected profile.")
+@click.option(
+    "--scan",
+    "scan_id",
+    help="ID of the scan to resume, as shown by --list.",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--list",
+    "list_only",
+    help="List the saved scans instead of resuming one.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "-w",
+    "--workers",
+    help="Number of tables to query concurrently.",
+    type=click.IntRange(1, 64),
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--page-size",
+    help="Number of records to request per page.",
+    type=click.IntRange(1, 10000),
+    default=1000,
+    show_default=True,
+)
+@with_output
+def query_resume(scan_id: int, list_only: bool, workers: int, page_size: int):
+    from .cmd_funcs.checkpoint import list_scans, resume_scan
+    if list_only:
+        list_scans()
+    else:
+        resume_scan(scan_id, workers, page_size)
+
+### SYNC
+
+@cli.command("sync", help="Mirrors the script/HTML/XML fields of the selected profile into a local full-text index. After the first run only records updated since the last sync are downloaded, and records that were emptied or deleted on the instance are dropped from the mirror. Use 'sparky query <type> --local' to search the mirror.")
+@click.option(
+    "-t",
+    "--type",
+    "query_types",
+    help="Field type to mirror. Can be given more than once. Defaults to all types.",
+    type=click.Choice(["script", "html", "xml"]),
+    multiple=True,
+)
+@click.option(
+    "--full",
+    help="Throw away the existing mirror for the synced types and download everything again.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "-w",
+    "--workers",
+    help="Number of tables to download concurrently.",
+    type=click.IntRange(1, 64),
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--page-size",
+    help="Number of records to request per page.",
+    type=click.IntRange(1, 10000),
+    default=1000,
+    show_default=True,
+)
+def sync_cmd(query_types, full: bool, workers: int, page_size: int) -> None:
+    from .cmd_funcs.sync import sync_mirror
+    sync_mirror(list(query_types) or ["script", "html", "xml"], full, workers, page_size)
+
+### DIFF
+
+@cli.command("diff", help="Shows which script/HTML/XML records differ between two profiles, and how. Each instance's content hashes are kept in sparky.db and only records updated since the last diff are read again, so after the first run only the records that actually differ are downloaded in full.")
+@click.argument("first")
+@click.argument("second")
+@click.option(
+    "-t",
+    "--type",
+    "query_type",
+    help="Field type to compare.",
+    type=click.Choice(["script", "html", "xml"]),
+    default="script",
+    show_default=True,
+)
+@click.option(
+    "-f",
+    "--filename",
+    help="File listing the tables and fields to compare instead of every field of the type. Example file format: sys_script_include,script",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--full",
+    help="Read every record of both instances again instead of only the ones updated since the last diff, rebuilding the manifests from scratch.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--summary",
+    help="Only list the records that differ, without downloading them to show the changed lines.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "-U",
+    "--unified",
+    help="Number of unchanged lines to show around each change.",
+    type=click.IntRange(0, 50),
+    default=3,
+    show_default=True,
+)
+@click.option(
+    "-w",
+    "--workers",
+    help="Number of tables to read concurrently.",
+    type=click.IntRange(1, 64),
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--page-size",
+    help="Number of records to request per page.",
+    type=click.IntRange(1, 10000),
+    default=1000,
+    show_default=True,
+)
+def diff_cmd(first: str, second: str, query_type: str, filename: str, full: bool, summary: bool, unified: int, workers: int, page_size: int) -> None:
+    from .cmd_funcs.diff import diff_profiles
+    diff_profiles([first, second], query_type, filename, full, workers, page_size, not summary, unified)
+
+### WATCH
+
+@cli.group("watch", help="Saved searches that are checked again later for new or changed hits. After the first check only records updated since the previous one are scanned, so a daily check costs a few small requests instead of a full scan.")
+def watch_cmd() -> None:
+    pass
+
+@watch_cmd.command("add", help="Saves a script/HTML/XML search of the selected profile under a name.")
+@click.argument("name")
+@click.option(
+    "-t",
+    "--type",
+    "query_type",
+    help="Field type to search.",
+    type=click.Choice(["script", "html", "xml"]),
+    default="script",
+    show_default=True,
+)
+@click.option(
+    "-f",
+    "--filename",
+    help="File listing the tables and fields to search instead of every field of the type. Example file format: sys_script_include,script",
+    type=str,
+    default=None,
+)
+@with_options(PATTERN_OPTIONS)
+def watch_add(name: str, query_type: str, filename: str, pattern, patterns_file: str) -> None:
+    from .cmd_funcs.query import get_patterns
+    from .cmd_funcs.watch import save_search
+    save_search(name, query_type, get_patterns(pattern, patterns_file), filename)
+
+@watch_cmd.command("list", help="Lists the saved searches and when they were last checked.")
+def watch_list() -> None:
+    from .cmd_funcs.watch import list_searches
+    list_searches()
+
+@watch_cmd.command("delete", help="Deletes a saved search.")
+@click.argument("name")
+def watch_delete(name: str) -> None:
+    from .cmd_funcs.watch import delete_search
+    delete_search(name)
+
+@watch_cmd.command("run", help="Checks saved searches (all of them unless names are given) for hits in records created or updated since the last check.")
+@click.argument("names", nargs=-1)
+@click.option(
+    "-w",
+    "--workers",
+    help="Number of tables to check and scan concurrently.",
+    type=click.IntRange(1, 64),
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--page-size",
+    help="Number of records to request per page.",
+    type=click.IntRange(1, 10000),
+    default=1000,
+    show_default=True,
+)
+@click.option(
+    "--batch-size",
+    help="Send this many table queries per request through the ServiceNow Batch API. 0 sends every query on its own.",
+    type=click.IntRange(0, 100),
+    default=0,
+    show_default=True,
+)
+@click.option(
+    "--rate",
+    help="Maximum requests per second to start with. 0 starts without a limit.",
+    type=click.FloatRange(0),
+    default=0,
+    show_default=True,
+)
+@click.option(
+    "--max-retries",
+    help="Number of times a throttled (429) or unavailable request is retried.",
+    type=click.IntRange(0, 20),
+    default=5,
+    show_default=True,
+)
+@click.option(
+    "-C",
+    "--context",
+    help="Show the lines of every result that matched, with this many lines of context around them.",
+    type=click.IntRange(0, 50),
+    default=None,
+)
+@click.option(
+    "--every",
+    help="Keep running and check again every this many minutes. 0 checks once.",
+    type=click.IntRange(0),
+    default=0,
+    show_default=True,
+)
+@with_output
+def watch_run(names, workers: int, page_size: int, batch_size: int, rate: float, max_retries: int, context: int, every: int) -> None:
+    from .cmd_funcs.watch import watch
+    watch(list(names), workers, page_size, batch_size, rate, max_retries, context, every)
+
+### SHELL
+
+@cli.command("shell", help="Starts an interactive shell for running many sparky commands in a row. Connections, sessions and caches stay warm between commands, so follow-up searches start right away.")
+def shell_cmd() -> None:
+    from .cmd_funcs.shell import run_shell
+    run_shell(cli)
 
 ### TEXT SEARCH
 @cli.command("textsearch", help="Text searches a single record in ServiceNow. Shows all case-sensitive matching instances.")
-def txt_cmd() -> None:
-    from .cmd_funcs.single_search import text_search
-    text_search()
+@with_options(PATTERN_OPTIONS)
+@with_options(PROFILE_OPTIONS)
+@click.option(
+    "-f",
+    "--file",
+    "targets_file",
+    help="Search every record listed in a file (one table,sys_id pair per line) in bulk instead of a single record.",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--from-scan",
+    help="Search the records found by the last query scan of the selected profile in bulk, showing the lines that matched. Uses the scan's strings unless patterns are given.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--scan",
+    "scan_id",
+    help="ID of the saved scan to use with --from-scan (see 'sparky query resume --list').",
+    type=int,
+    default=None,
+)
+@click.option(
+    "-w",
+    "--workers",
+    help="Number of chunks of records to fetch concurrently in bulk searches.",
+    type=click.IntRange(1, 64),
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--chunk-size",
+    help="Number of records to fetch per request in bulk searches.",
+    type=click.IntRange(1, 500),
+    default=100,
+    show_default=True,
+)
+@click.option(
+    "--attachments",
+    help="Search the files attached to the records instead of their fields. Use with --table, --file or --from-scan. Files are streamed, so their size doesn't matter, and gzip files are unpacked on the fly.",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--table",
+    help="With --attachments, search the attachments of every record of this table.",
+    type=str,
+    default=None,
+)
+@click.option(
+    "--file-name",
+    help="With --attachments, only search attachments whose file name contains this.",
+    type=str,
+    default=None,
+)
+@with_output
+def txt_cmd(pattern, patterns_file: str, profiles: str, all_profiles: bool, targets_file: str, from_scan: bool, scan_id: int, workers: int, chunk_size: int,
+        attachments: bool, table: str, file_name: str) -> None:
+    from .cmd_funcs.fanout import parse_profiles
+    from .cmd_funcs.query import get_patterns
+    from .cmd_funcs import single_search
+    if attachments:
+        from .cmd_funcs.attachments import attachment_search, attachment_search_scan
+        if profiles != None or all_profiles:
+            click.secho("Attachment searches run against a single profile and can't be combined with --profiles or --all-profiles.", fg="red")
+            return
+        if (table == None) == (targets_file == None and not from_scan and scan_id == None):
+            click.secho("Give exactly one of --table, --file or --from-scan to choose whose attachments to search.", fg="red")
+            return
+        if table != None:
+            attachment_search(get_patterns(pattern, patterns_file), table=table, file_name=file_name, workers=workers, chunk_size=chunk_size)
+        elif targets_file != None:
+            attachment_search(get_patterns(pattern, patterns_file), targets=single_search.get_targets_from_file(targets_file), file_name=file_name, workers=workers, chunk_size=chunk_size)
+        else:
+            attachment_search_scan(scan_id, get_patterns(pattern, patterns_file) if pattern or patterns_file else None, file_name, workers, chunk_size=chunk_size)
+        return
+    if table != None or file_name != None:
+        click.secho("--table and --file-name only apply to attachment searches (--attachments).", fg="red")
+        return
+    if targets_file != None or from_scan or scan_id != None:
+        if profiles != None or all_profiles:
+            click.secho("Bulk searches run against a single profile and can't be combined with --profiles or --all-profiles.", fg="red")
+            return
+        if targets_file != None:
+            single_search.bulk_text_search(single_search.get_targets_from_file(targets_file), get_patterns(pattern, patterns_file), workers=workers, chunk_size=chunk_size)
+        else:
+            single_search.bulk_search_scan(scan_id, get_patterns(pattern, patterns_file) if pattern or patterns_file else None, workers, chunk_size=chunk_size)
+        return
+    single_search.text_search(parse_profiles(profiles, all_profiles), get_patterns(pattern, patterns_file) if pattern or patterns_file else None)
 
 cli.add_command(version_cmd)
 cli.add_command(profile_cmd)
 cli.add_command(query_cmd)
-cli.add_command(txt_cmd)
\ No newline at end of file
+cli.add_command(sync_cmd)
+cli.add_command(watch_cmd)
+cli.add_command(diff_cmd)
+cli.add_command(txt_cmd)
+cli.add_command(shell_cmd)
\ No newline at end of file
@@ -0,0 +1,29 @@
+import time
+
+# Taken as early as possible, so the first step also covers importing click and the command modules
+START = time.perf_counter()
+
+enabled = False
+_marks = []
+
+def reset():
+    """Starts timing a new command, for commands run one after another in the same process."""
+    global START, enabled
+    START = time.perf_counter()
+    enabled = False
+    del _marks[:]
+
+def mark(label: str):
+    """Records how long everything since the previous mark took, if --timings was given."""
+    if enabled:
+        _marks.append((label, time.perf_counter()))
+
+def report():
+    import click
+    mark("command")
+    click.secho("\n{:<30} {:>10}".format('Step', 'ms'), fg="bright_white", bold=True, err=True)
+    prev = START
+    for label, at in _marks:
+        click.echo("{:<30} {:>10.1f}".format(label, (at - prev) * 1000), err=True)
+        prev = at
+    click.echo("{:<30} {:>10.1f}".format("total", (time.perf_counter() - START) * 1000), err=True)
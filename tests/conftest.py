@@ -0,0 +1,12 @@
+import sqlite3
+
+import pytest
+
+from sparky.connection import db
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Points sparky.db at a fresh file for the test, returning its path."""
+    path = str(tmp_path / "sparky.db")
+    monkeypatch.setattr(db, "connect", lambda: sqlite3.connect(path))
+    return path
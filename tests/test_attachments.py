@@ -0,0 +1,79 @@
+import json
+
+import requests
+
+from sparky.cmd_funcs import attachments
+from sparky.cmd_funcs.single_search import compile_fragments
+
+def chunks(text: str, size: int) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def matches(patterns: list, texts: list) -> list:
+    return [(term, line) for term, line, _, _ in attachments.search_stream(compile_fragments(patterns), iter(texts))]
+
+def test_matches_cut_between_chunks_are_found():
+    text = "one\ntwo needle\nthree\nneedle four\n"
+    for size in range(1, len(text) + 1):
+        assert matches(["needle"], chunks(text, size)) == [("needle", 2), ("needle", 4)], size
+
+def test_last_line_without_a_newline():
+    assert matches(["needle"], ["a\nb", "c nee", "dle"]) == [("needle", 2)]
+
+def test_line_numbers_carry_across_chunks():
+    text = "".join("line " + str(n) + ("needle" if n % 7 == 0 else "") + "\n" for n in range(1, 50))
+    assert [line for _, line in matches(["needle"], chunks(text, 13))] == [7, 14, 21, 28, 35, 42, 49]
+
+def test_long_lines_are_searched_in_pieces(monkeypatch):
+    monkeypatch.setattr(attachments, "MAX_LINE", 100)
+    monkeypatch.setattr(attachments, "OVERLAP", 10)
+    line = "x" * 95 + "needle" + "x" * 200 + "needle" + "x" * 50
+    for size in (7, 30, 64, 101):
+        found = matches(["needle"], chunks("first\n" + line + "\nneedle", size))
+        assert found == [("needle", 2), ("needle", 2), ("needle", 3)], size
+
+def test_long_line_cut_inside_a_match_reports_it_once(monkeypatch):
+    monkeypatch.setattr(attachments, "MAX_LINE", 20)
+    monkeypatch.setattr(attachments, "OVERLAP", 8)
+    # every chunk pushes the line past MAX_LINE, so it is cut at a different place inside a needle each time
+    line = ("ab" * 7 + "needle") * 10
+    for size in range(21, 40):
+        assert matches(["needle"], chunks(line, size)) == [("needle", 1)] * 10, size
+
+def test_snippets_of_long_lines_are_bounded():
+    line = "x" * 1000 + "needle" + "x" * 1000
+    (_, _, text, _), = attachments.search_stream(compile_fragments(["needle"]), iter([line]))
+    assert "needle" in text
+    assert len(text) <= attachments.MAX_SNIPPET + 6
+
+def test_decode_joins_newlines_and_characters_cut_between_chunks():
+    data = "é\r\nb\rc".encode("utf-8")
+    texts = list(attachments.decode(iter([data[:1], data[1:3], data[3:]])))
+    assert "".join(texts) == "é\nb\nc"
+
+class FakeAttachments:
+    """Answers sys_attachment lookups, understanding table_name= and table_sys_idIN terms."""
+
+    def __init__(self, records: list):
+        self.records = records
+        self.queries = []
+
+    def get(self, url, params=None, **kwargs):
+        query = params.get("sysparm_query", "")
+        self.queries.append(query)
+        rows = self.records
+        for term in query.split("^"):
+            if term.startswith("table_name="):
+                rows = [r for r in rows if r["table_name"] == term[len("table_name="):]]
+            elif term.startswith("table_sys_idIN"):
+                rows = [r for r in rows if r["table_sys_id"] in term[len("table_sys_idIN"):].split(",")]
+        resp = requests.Response()
+        resp.status_code = 200
+        resp._content = json.dumps({"result": rows if params.get("sysparm_offset") == "0" else []}).encode()
+        return resp
+
+def test_attachments_of_child_class_records_are_found():
+    # a scan of task finds incidents, whose attachments are filed under incident
+    s = FakeAttachments([{"sys_id": "a1", "table_name": "incident", "table_sys_id": "i1"}, {"sys_id": "a2", "table_name": "task", "table_sys_id": "t1"}])
+    found = list(attachments.list_attachments(s, "", targets=[("task", "i1"), ("task", "t1"), ("incident", "i1")], chunk_size=10))
+    assert [i["sys_id"] for i in found] == ["a1", "a2"]
+    assert s.queries == ["table_sys_idINi1,t1^ORDERBYsys_id"]
@@ -0,0 +1,153 @@
+import base64
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from sparky.connection.batch import BatchSession
+from sparky.connection.scheduler import Scheduler
+from sparky.connection.table import TableError, read_result
+
+class Envelope:
+    """What the stand-in instance does with batch calls, and what it was sent."""
+
+    def __init__(self):
+        self.batch_status = 200
+        self.batch_body = None # raw bytes to send instead of a batch envelope
+        self.unserviced = set() # ids of rest_requests left unserviced
+        self.posts = []
+        self.gets = []
+        self.lock = threading.Lock()
+
+def handler(envelope: Envelope):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            with envelope.lock:
+                envelope.gets.append(self.path)
+            self.reply(200, json.dumps({"result": [{"sys_id": "direct", "url": self.path}]}).encode(), "application/json")
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+            with envelope.lock:
+                envelope.posts.append(body)
+            if envelope.batch_body != None:
+                return self.reply(envelope.batch_status, envelope.batch_body, "text/html")
+            if envelope.batch_status != 200:
+                return self.reply(envelope.batch_status, b'{"error": {"message": "no batch here"}}', "application/json")
+            serviced, unserviced = [], []
+            for item in body["rest_requests"]:
+                if item["id"] in envelope.unserviced:
+                    unserviced.append(item["id"])
+                    continue
+                result = json.dumps({"result": [{"sys_id": "batched", "url": item["url"]}]}).encode()
+                serviced.append({"id": item["id"], "status_code": 200, "status_text": "OK", "body": base64.b64encode(result).decode(),
+                    "headers": [{"name": "Content-Type", "value": "application/json"}, {"name": "X-Served-By", "value": "batch"}]})
+            self.reply(200, json.dumps({"batch_request_id": body["batch_request_id"], "serviced_requests": serviced,
+                "unserviced_requests": unserviced}).encode(), "application/json")
+
+        def reply(self, status: int, data: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+    return Handler
+
+@pytest.fixture
+def instance():
+    envelope = Envelope()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler(envelope))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield envelope, "http://127.0.0.1:" + str(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+def session(batch_size: int) -> BatchSession:
+    # a long linger, so a batch only goes out once every request of the test is in it
+    return BatchSession(batch_size, linger=5, scheduler=Scheduler(batch_size, max_retries=0))
+
+def get_all(s: BatchSession, urls: list) -> list:
+    """Sends every GET from its own thread, the way scan workers do, and returns the responses in order."""
+    responses = [None] * len(urls)
+    errors = []
+
+    def get(n):
+        try:
+            responses[n] = s.get(urls[n], params={"sysparm_limit": "1"}, headers={"Accept": "application/json"})
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=get, args=(n,)) for n in range(len(urls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    if len(errors) > 0:
+        raise errors[0]
+    return responses
+
+def test_gets_are_packed_into_one_batch_call(instance):
+    envelope, url = instance
+    urls = [url + "/api/now/table/u_table_" + str(n) for n in range(4)]
+    responses = get_all(session(4), urls)
+    assert len(envelope.posts) == 1
+    assert envelope.gets == []
+    sent = sorted(item["url"] for item in envelope.posts[0]["rest_requests"])
+    assert sent == sorted("/api/now/table/u_table_" + str(n) + "?sysparm_limit=1" for n in range(4))
+    for n, resp in enumerate(responses):
+        assert resp.json()["result"][0]["url"] == "/api/now/table/u_table_" + str(n) + "?sysparm_limit=1"
+
+def test_batch_bodies_and_headers_are_unpacked(instance):
+    envelope, url = instance
+    responses = get_all(session(2), [url + "/api/now/table/incident", url + "/api/now/stats/incident"])
+    for resp in responses:
+        assert resp.status_code == 200
+        assert resp.headers["x-served-by"] == "batch"
+        assert resp.json()["result"][0]["sys_id"] == "batched"
+    assert responses[0].url == url + "/api/now/table/incident?sysparm_limit=1"
+
+@pytest.mark.parametrize("status", [400, 404, 405])
+def test_falls_back_to_single_requests_without_batch_api(instance, status):
+    envelope, url = instance
+    envelope.batch_status = status
+    s = session(3)
+    responses = get_all(s, [url + "/api/now/table/u_table_" + str(n) for n in range(3)])
+    assert len(envelope.posts) == 1
+    assert len(envelope.gets) == 3
+    assert all(resp.json()["result"][0]["sys_id"] == "direct" for resp in responses)
+    # once the instance turned out not to have the Batch API, it isn't asked again
+    s.get(url + "/api/now/table/u_table_3")
+    assert len(envelope.posts) == 1
+    assert len(envelope.gets) == 4
+
+def test_unserviced_requests_are_sent_one_by_one(instance):
+    envelope, url = instance
+    envelope.unserviced = {"1", "2"}
+    responses = get_all(session(3), [url + "/api/now/table/u_table_" + str(n) for n in range(3)])
+    assert len(envelope.posts) == 1
+    assert len(envelope.gets) == 2
+    assert sorted(resp.json()["result"][0]["sys_id"] for resp in responses) == ["batched", "direct", "direct"]
+
+def test_batch_answering_with_a_login_page_raises_a_table_error(instance):
+    envelope, url = instance
+    envelope.batch_body = b"<html><body>Log in</body></html>"
+    with pytest.raises(TableError) as e:
+        get_all(session(2), [url + "/api/now/table/u_table_0", url + "/api/now/table/u_table_1"])
+    assert e.value.status_code == 200
+    assert "JSON" in e.value.message
+
+def test_batch_failing_with_a_non_json_error_page_raises_a_table_error(instance):
+    envelope, url = instance
+    envelope.batch_status = 503
+    envelope.batch_body = b"<html><body>Service unavailable</body></html>"
+    for resp in get_all(session(2), [url + "/api/now/table/u_table_0", url + "/api/now/table/u_table_1"]):
+        with pytest.raises(TableError) as e:
+            read_result(resp)
+        assert e.value.status_code == 503
@@ -0,0 +1,61 @@
+import sqlite3
+
+from sparky.cmd_funcs import checkpoint
+
+def finished_scan(conn: sqlite3.Connection, search_id: int = None) -> int:
+    scan_id = checkpoint.start_scan(conn, 1, "script", ["needle"], [("u_table", ["script"], "")], search_id)
+    checkpoint.mark_done(conn, scan_id, 0)
+    assert checkpoint.finish_scan(conn, scan_id)
+    return scan_id
+
+def scan_ids(conn: sqlite3.Connection) -> list:
+    return [row[0] for row in conn.execute("SELECT id FROM scan ORDER BY id;")]
+
+def test_a_finished_query_replaces_the_older_ones(database):
+    conn = sqlite3.connect(database)
+    finished_scan(conn)
+    latest = finished_scan(conn)
+    assert scan_ids(conn) == [latest]
+
+def test_checks_of_saved_searches_leave_queries_alone(database):
+    conn = sqlite3.connect(database)
+    query_scan = finished_scan(conn)
+    first_check = finished_scan(conn, search_id=7)
+    other_search = finished_scan(conn, search_id=8)
+    second_check = finished_scan(conn, search_id=7)
+    assert scan_ids(conn) == [query_scan, other_search, second_check]
+    assert first_check not in scan_ids(conn)
+    # 'sparky textsearch --from-scan' still finds the user's own query
+    profile_id, patterns, hits = checkpoint.scan_hits(query_scan)
+    assert patterns == ["needle"]
+
+def test_checkpointed_saves_hits_under_their_unit(database):
+    conn = sqlite3.connect(database)
+    units = [("u_a", ["script"], ""), ("u_b", ["script"], "sys_id<80"), ("u_b", ["script"], "sys_id>=80")]
+    scan_id = checkpoint.start_scan(conn, 1, "script", ["needle", "pin"], units)
+    matches = [(0, "u_a", "script", {"sys_id": "a1", "name": "A"}, "needle"), (2, "u_b", "script", {"sys_id": "b9", "sys_name": "B"}, "pin")]
+    assert list(checkpoint.checkpointed(conn, scan_id, iter(matches))) == [m[1:] for m in matches]
+    assert conn.execute("SELECT seq, tbl, field, sys_id, name, pattern FROM scan_hit ORDER BY rowid;").fetchall() == [
+        (0, "u_a", "script", "a1", "A", "needle"), (2, "u_b", "script", "b9", "B", "pin")]
+
+def test_replay_of_a_resumed_scan(database):
+    conn = sqlite3.connect(database)
+    units = [("u_a", ["script"], ""), ("u_b", ["script"], ""), ("u_c", ["script"], "")]
+    scan_id = checkpoint.start_scan(conn, 1, "script", ["needle"], units)
+    first = [(0, "u_a", "script", {"sys_id": "a1"}, "needle"), (1, "u_b", "script", {"sys_id": "b1"}, "needle")]
+    list(checkpoint.checkpointed(conn, scan_id, iter(first)))
+    checkpoint.mark_done(conn, scan_id, 0)
+    assert not checkpoint.finish_scan(conn, scan_id)
+
+    # a resumed scan only runs the units left, numbered from 0, and drops what the unfinished ones found before
+    conn.execute("DELETE FROM scan_hit WHERE scan_id = ? AND seq IN (1, 2);", (scan_id,))
+    seqs = [1, 2]
+    resumed = [(0, "u_b", "script", {"sys_id": "b1"}, "needle"), (1, "u_c", "script", {"sys_id": "c1"}, "needle")]
+    list(checkpoint.checkpointed(conn, scan_id, iter(resumed), seqs))
+    for n in range(2):
+        checkpoint.mark_done(conn, scan_id, seqs[n])
+    assert checkpoint.finish_scan(conn, scan_id)
+
+    profile_id, patterns, hits = checkpoint.scan_hits(scan_id)
+    assert (profile_id, patterns) == (1, ["needle"])
+    assert hits == [("u_a", "script", "a1"), ("u_b", "script", "b1"), ("u_c", "script", "c1")]
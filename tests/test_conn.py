@@ -0,0 +1,29 @@
+import sqlite3
+import threading
+
+from click.testing import CliRunner
+
+from sparky import main
+from sparky.cmd_funcs import profile
+from sparky.connection import conn
+
+PROFILE = (1, "dev", "admin", "https://dev.service-now.com")
+
+def passed_in_thread() -> bool:
+    """Asks preflight_passed from a worker thread, the way multi-profile scans connect."""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(conn.preflight_passed(PROFILE, PROFILE[3])))
+    thread.start()
+    thread.join()
+    return result[0]
+
+def test_preflight_ttl_option_reaches_worker_threads(database, monkeypatch):
+    monkeypatch.setattr(profile, "startup_profile", lambda: None)
+    monkeypatch.setattr(conn, "preflight_ttl", conn.DEFAULT_PREFLIGHT_TTL)
+    sqlite3.connect(database).execute("CREATE TABLE preflight (profile_id int primary key, url text, user text, checked_on real);")
+    conn.save_preflight(PROFILE, PROFILE[3])
+    assert passed_in_thread()
+    result = CliRunner().invoke(main.cli, ["--preflight-ttl", "0", "version"])
+    assert result.exit_code == 0
+    assert conn.preflight_ttl == 0
+    assert not passed_in_thread()
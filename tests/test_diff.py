@@ -0,0 +1,28 @@
+import sqlite3
+
+from sparky.cmd_funcs import diff
+from tests.test_sync import FakeTable, record
+
+PROFILE = (1, "dev", "admin", "https://dev.service-now.com")
+
+def manifest(database: str) -> dict:
+    conn = sqlite3.connect(database)
+    return dict(((sys_id, hash) for sys_id, hash in conn.execute("SELECT sys_id, hash FROM manifest ORDER BY sys_id;")))
+
+def test_refresh_drops_emptied_and_deleted_records(database):
+    table = FakeTable([record(n, "2024-01-01 10:00:00") for n in range(5)])
+    assert diff.refresh_manifest(table, "", PROFILE, [("u_table", "script")], page_size=2) == 5
+    assert len(manifest(database)) == 5
+
+    table.records[0].update(script="", sys_updated_on="2024-01-02 10:00:00")
+    table.records[2].update(script="gs.warn();", sys_updated_on="2024-01-02 10:00:00")
+    del table.records[1]
+    diff.refresh_manifest(table, "", PROFILE, [("u_table", "script")], page_size=2)
+    after = manifest(database)
+    assert sorted(after) == ["%032x" % n for n in (2, 3, 4)]
+    assert after["%032x" % 2] == diff.content_hash("gs.warn();")
+
+def test_refresh_reads_only_what_changed(database):
+    table = FakeTable([record(n, "2024-01-01 10:00:00") for n in range(3)])
+    diff.refresh_manifest(table, "", PROFILE, [("u_table", "script")])
+    assert diff.refresh_manifest(table, "", PROFILE, [("u_table", "script")]) == 0
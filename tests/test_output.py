@@ -0,0 +1,18 @@
+import io
+
+import pytest
+
+from sparky.cmd_funcs import output
+
+def test_a_sink_without_a_format_cannot_be_created():
+    class Unformatted(output.Sink):
+        pass
+    with pytest.raises(TypeError):
+        Unformatted(io.StringIO())
+
+def test_jsonl_rows_keep_the_column_order():
+    file = io.StringIO()
+    sink = output.JsonlSink(file)
+    sink.write({"text": "var x;", "table": "sys_script", "extra": 1})
+    sink.close()
+    assert file.getvalue() == '{"instance": null, "table": "sys_script", "field": null, "sys_id": null, "name": null, "pattern": null, "line": null, "text": "var x;", "extra": 1}\n'
@@ -0,0 +1,39 @@
+import json
+
+import requests
+
+from sparky.cmd_funcs import planner
+
+class FakeInstance:
+    """Answers the sys_db_object and Aggregate API requests of scan planning from in-memory row counts."""
+
+    def __init__(self, counts: dict):
+        self.counts = counts
+        self.stats = []
+
+    def get(self, url, params=None, **kwargs):
+        resp = requests.Response()
+        resp.status_code = 200
+        if "/api/now/stats/" in url:
+            table = url.split("/api/now/stats/")[1]
+            self.stats.append(table)
+            result = {"stats": {"count": str(self.counts.get(table, 0))}}
+        else:
+            result = [{"name": t, "super_class.name": ""} for t in self.counts] if params.get("sysparm_offset") == "0" else []
+        resp._content = json.dumps({"result": result}).encode()
+        return resp
+
+def test_tables_counted_empty_on_an_earlier_run_are_counted_again(database):
+    s = FakeInstance({"u_empty": 0, "u_filled": 3})
+    scan, skipped = planner.plan_scan(s, "", 1, [("u_empty", "script"), ("u_filled", "script")], ttl=1440)
+    assert scan == [("u_filled", "script")]
+    assert skipped == [("u_empty", "script", "empty")]
+
+    # the cached count of u_empty is still 0 and well within the ttl, but the table has records now
+    s.counts["u_empty"] = 2
+    s.stats = []
+    scan, skipped = planner.plan_scan(s, "", 1, [("u_empty", "script"), ("u_filled", "script")], ttl=1440)
+    assert scan == [("u_empty", "script"), ("u_filled", "script")]
+    assert skipped == []
+    assert sorted(s.stats) == ["u_empty", "u_filled"]
+    assert planner.table_sizes(1) == {"u_empty": 2, "u_filled": 3}
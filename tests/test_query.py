@@ -0,0 +1,90 @@
+import json
+import socket
+import sqlite3
+
+import pytest
+import requests
+
+from sparky.cmd_funcs import query
+from sparky.connection.scheduler import ScheduledSession, Scheduler
+
+def closed_port() -> int:
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def test_lost_connection_keeps_the_scan_resumable(database, capsys):
+    s = ScheduledSession(Scheduler(1, max_retries=0))
+    with pytest.raises(query.ScanAborted):
+        query.generic_lookup(s, "http://127.0.0.1:" + str(closed_port()), [("u_table", "script")], ["needle"], profile_id=1, query_type="script")
+    out = capsys.readouterr().out
+    assert "Lost the connection to the instance" in out
+    assert "sparky query resume --scan 1" in out
+    conn = sqlite3.connect(database)
+    assert conn.execute("SELECT finished FROM scan WHERE id = 1;").fetchone() == (0,)
+    assert conn.execute("SELECT done FROM scan_unit WHERE scan_id = 1;").fetchall() == [(0,)]
+
+def in_shard(sys_id: str, shard: str) -> bool:
+    for term in shard.split("^"):
+        if term.startswith("sys_id>=") and not sys_id >= term[len("sys_id>="):]:
+            return False
+        if term.startswith("sys_id<") and not sys_id < term[len("sys_id<"):]:
+            return False
+    return True
+
+def test_small_tables_are_not_sharded():
+    assert query.shard_queries(50000, 50000) == [""]
+    assert query.shard_queries(10, 0) == [""]
+
+def test_shards_cover_every_record_exactly_once():
+    sys_ids = ["%032x" % n for n in range(0, 2 ** 128, 2 ** 120 // 3)] + ["0" * 32, "f" * 32, "7f" + "0" * 30, "80" + "0" * 30]
+    for size in (50001, 120000, 10 ** 7):
+        shards = query.shard_queries(size, 50000)
+        assert 1 < len(shards) <= query.MAX_SHARDS
+        for sys_id in sys_ids:
+            assert sum(1 for shard in shards if in_shard(sys_id, shard)) == 1, (size, sys_id)
+
+def test_shards_are_in_sys_id_order():
+    shards = query.shard_queries(200000, 50000)
+    assert shards == ["sys_id<40", "sys_id>=40^sys_id<80", "sys_id>=80^sys_id<c0", "sys_id>=c0"]
+
+def test_matched_fields_attributes_hits_to_fields_and_patterns():
+    record = {"script": "var gr = new GlideRecord('incident');", "condition": "current.active", "u_other": None}
+    assert query.matched_fields(record, ["script", "condition", "u_other"], ["gliderecord", "ACTIVE"]) == [("script", "gliderecord"), ("condition", "ACTIVE")]
+
+def test_matched_fields_keeps_hits_it_cannot_attribute():
+    record = {"script": "nothing here", "condition": ""}
+    assert query.matched_fields(record, ["script", "condition"], ["needle"]) == [("script,condition", "needle")]
+    assert query.matched_fields(record, ["script", "condition"], ["needle", "pin"]) == [("script,condition", "")]
+
+def test_match_query_ors_every_field_and_pattern():
+    assert query.match_query(["script", "condition"], ["a b", "c"]) == "scriptLIKEa%20b^ORconditionLIKEa%20b^ORscriptLIKEc^ORconditionLIKEc"
+
+class FlakyTable:
+    """Serves the records of a table in pages, failing with a 503 the first time the given offset is asked for."""
+
+    def __init__(self, records: list, fail_at: int):
+        self.records = records
+        self.fail_at = fail_at
+        self.offsets = []
+
+    def get(self, url, params=None, **kwargs):
+        offset = int(params["sysparm_offset"])
+        self.offsets.append(offset)
+        resp = requests.Response()
+        if offset == self.fail_at and self.offsets.count(offset) == 1:
+            resp.status_code = 503
+            resp._content = b'{"error": {"message": "busy"}}'
+            return resp
+        resp.status_code = 200
+        resp._content = json.dumps({"result": self.records[offset:offset + int(params["sysparm_limit"])]}).encode()
+        return resp
+
+def test_retry_carries_on_from_the_last_record():
+    records = [{"sys_id": "%032x" % n, "name": str(n), "script": "needle"} for n in range(5)]
+    s = FlakyTable(records, 2)
+    hits = list(query.scan(s, "", [("u_table", ["script"], "")], ["needle"], page_size=2, on_warning=lambda message: None))
+    assert [i["sys_id"] for _, _, _, i, _ in hits] == [r["sys_id"] for r in records]
+    assert s.offsets == [0, 2, 2, 4]
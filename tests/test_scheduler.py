@@ -0,0 +1,76 @@
+import time
+
+import requests
+from requests.adapters import BaseAdapter
+
+from sparky.connection.scheduler import ScheduledSession, Scheduler, retry_after
+
+class Raw:
+    def __init__(self):
+        self.released = False
+
+    def release_conn(self):
+        self.released = True
+
+class Throttling(BaseAdapter):
+    """Answers with a 429 asking for a day's pause, then with a 200."""
+
+    def __init__(self, throttled: int, wait: str = "86400"):
+        super().__init__()
+        self.throttled = throttled
+        self.wait = wait
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        resp = requests.Response()
+        resp.raw = Raw()
+        resp._content = b"{}"
+        resp.request = request
+        resp.url = request.url
+        resp.status_code = 429 if len(self.sent) < self.throttled else 200
+        if resp.status_code == 429:
+            resp.headers["Retry-After"] = self.wait
+        self.sent.append(resp)
+        return resp
+
+    def close(self):
+        pass
+
+def session(adapter: Throttling, max_backoff: float = 0.05, max_retries: int = 5) -> ScheduledSession:
+    s = ScheduledSession(Scheduler(1, max_retries=max_retries, max_backoff=max_backoff))
+    s.mount("https://", adapter)
+    return s
+
+def test_retry_after_is_capped_at_max_backoff():
+    scheduler = Scheduler(max_backoff=2)
+    before = time.time()
+    assert scheduler.delay(0, 86400) == 2
+    assert scheduler._paused_until <= before + 2.5
+
+def test_throttled_request_is_retried_without_waiting_a_day():
+    adapter = Throttling(2)
+    start = time.time()
+    resp = session(adapter).get("https://dev.service-now.com/api/now/table/incident")
+    assert resp.status_code == 200
+    assert resp.retries == 2
+    assert time.time() - start < 5
+
+def test_throttled_connections_go_back_to_the_pool_before_retrying():
+    adapter = Throttling(2)
+    session(adapter).get("https://dev.service-now.com/api/now/table/incident")
+    assert [resp.raw.released for resp in adapter.sent] == [True, True, False]
+
+def test_last_throttled_response_is_handed_back_open():
+    adapter = Throttling(5)
+    resp = session(adapter, max_retries=1).get("https://dev.service-now.com/api/now/table/incident")
+    assert resp.status_code == 429
+    assert not resp.raw.released
+
+def test_retry_after_reads_seconds_and_dates():
+    resp = requests.Response()
+    resp.headers["Retry-After"] = "3"
+    assert retry_after(resp) == 3
+    resp.headers["Retry-After"] = "Wed, 21 Oct 2015 07:28:00 GMT"
+    assert retry_after(resp) == 0
+    resp.headers["Retry-After"] = "soon"
+    assert retry_after(resp) == None
@@ -0,0 +1,38 @@
+import re
+
+from sparky.cmd_funcs import single_search
+
+def test_line_starts():
+    assert single_search.line_starts("a\nbc\n\nd") == [0, 2, 5, 6]
+    assert single_search.line_starts("") == [0]
+
+def test_search_reports_line_numbers():
+    fragment = single_search.compile_fragments(["needle"])
+    value = "first\nneedle here\nnothing\n\nand a needle at the end"
+    assert single_search.search(fragment, value) == [("needle", 2, "needle here", "needle"), ("needle", 5, "and a needle at the end", "needle")]
+
+def test_search_counts_every_newline_style():
+    fragment = single_search.compile_fragments(["needle"])
+    assert [r[1] for r in single_search.search(fragment, "a\r\nb\rneedle\nc\r\nneedle")] == [3, 5]
+
+def test_search_tries_every_pattern_on_a_matching_line_once():
+    fragment = single_search.compile_fragments(["foo", "bar"])
+    value = "foo bar foo\nbar\nnone"
+    assert single_search.search(fragment, value) == [("foo", 1, "foo bar foo", "foo"), ("bar", 1, "foo bar foo", "bar"), ("bar", 2, "bar", "bar")]
+
+def test_search_finds_matches_on_the_first_and_last_line():
+    fragment = single_search.compile_fragments(["x"])
+    assert [r[1] for r in single_search.search(fragment, "x\n\nx")] == [1, 3]
+
+def test_search_without_a_match():
+    assert single_search.search(single_search.compile_fragments(["needle"]), None) == []
+    assert single_search.search(single_search.compile_fragments(["needle"]), "hay\nstack") == []
+
+def test_search_honours_flags():
+    fragment = single_search.compile_fragments([re.escape("a.b")], re.IGNORECASE)
+    assert single_search.search(fragment, "axb\nA.B") == [("A.B", 2, "A.B", re.escape("a.b"))]
+
+def test_first_line():
+    fragment = single_search.compile_fragments(["needle"])
+    assert single_search.first_line(fragment, "a\r\n  needle  \nneedle") == (2, "needle")
+    assert single_search.first_line(fragment, "hay") == (None, None)
@@ -0,0 +1,112 @@
+import json
+import sqlite3
+
+import requests
+
+from sparky.cmd_funcs import sync
+
+class FakeTable:
+    """Answers the Table and Aggregate API requests sync sends for a single table held in memory. Only the query
+    terms sync uses are understood."""
+
+    def __init__(self, records: list):
+        self.records = records
+        self.queries = []
+
+    def matches(self, record: dict, query: str) -> bool:
+        for term in query.split("^"):
+            if term == "" or term.startswith("ORDERBY"):
+                continue
+            if term.endswith("ISNOTEMPTY"):
+                ok = record.get(term[:-len("ISNOTEMPTY")], "") != ""
+            else:
+                for op in (">=", ">", "="):
+                    if op in term:
+                        field, value = term.split(op, 1)
+                        actual = record.get(field, "")
+                        ok = actual >= value if op == ">=" else actual > value if op == ">" else actual == value
+                        break
+            if not ok:
+                return False
+        return True
+
+    def get(self, url, params=None, **kwargs):
+        query = params.get("sysparm_query", "")
+        self.queries.append(query)
+        rows = [r for r in self.records if self.matches(r, query)]
+        resp = requests.Response()
+        resp.status_code = 200
+        if "/api/now/stats/" in url:
+            resp._content = json.dumps({"result": {"stats": {"count": str(len(rows))}}}).encode()
+            return resp
+        keys = [term[len("ORDERBY"):] for term in query.split("^") if term.startswith("ORDERBY")]
+        rows.sort(key=lambda r: tuple(r.get(k, "") for k in keys))
+        limit = int(params.get("sysparm_limit", 10000))
+        offset = int(params.get("sysparm_offset", 0))
+        resp._content = json.dumps({"result": rows[offset:offset + limit]}).encode()
+        return resp
+
+def record(n: int, updated_on: str, script: str = "gs.info();") -> dict:
+    return {"sys_id": "%032x" % n, "name": "record " + str(n), "sys_updated_on": updated_on, "script": script}
+
+def fetch(table: FakeTable, high_water: str = None, high_water_id: str = None, page_size: int = 2) -> list:
+    return [r for page in sync.fetch_changes(table, "", "u_table", "script", high_water, high_water_id, page_size) for r in page]
+
+def test_records_sharing_a_timestamp_are_not_lost_between_pages():
+    same = "2024-01-01 10:00:00"
+    records = [record(n, same) for n in range(5)] + [record(5, "2024-01-01 10:00:01"), record(6, "2024-01-01 10:00:02")]
+    seen = fetch(FakeTable(records), page_size=2)
+    assert [r["sys_id"] for r in seen] == [r["sys_id"] for r in records]
+
+def test_picks_up_after_the_high_water_mark():
+    same = "2024-01-01 10:00:00"
+    records = [record(n, same) for n in range(4)] + [record(4, "2024-01-01 10:00:05")]
+    seen = fetch(FakeTable(records), same, "%032x" % 1)
+    assert [r["sys_id"] for r in seen] == ["%032x" % n for n in (2, 3, 4)]
+
+def test_an_unchanged_field_costs_a_single_request():
+    table = FakeTable([record(0, "2024-01-01 10:00:00"), record(1, "2024-01-01 10:00:05")])
+    assert fetch(table, "2024-01-01 10:00:05", "%032x" % 1) == []
+    assert table.queries == ["sys_updated_on>=2024-01-01 10:00:05^ORDERBYsys_updated_on^ORDERBYsys_id"]
+
+def test_a_second_holding_more_than_a_page_is_read_past():
+    same = "2024-01-01 10:00:00"
+    records = [record(n, same) for n in range(7)] + [record(7, "2024-01-01 10:00:01")]
+    seen = fetch(FakeTable(records), same, "%032x" % 2, page_size=2)
+    assert [r["sys_id"] for r in seen] == ["%032x" % n for n in range(3, 8)]
+
+def test_a_mark_without_a_sys_id_rereads_its_whole_second():
+    same = "2024-01-01 10:00:00"
+    records = [record(0, "2023-12-31 00:00:00")] + [record(n, same) for n in range(1, 4)]
+    seen = fetch(FakeTable(records), same, "")
+    assert [r["sys_id"] for r in seen] == ["%032x" % n for n in (1, 2, 3)]
+
+def test_only_the_first_sync_skips_empty_fields():
+    table = FakeTable([record(0, "2024-01-01 10:00:00", ""), record(1, "2024-01-01 10:00:00")])
+    assert [r["sys_id"] for r in fetch(table)] == ["%032x" % 1]
+    # later syncs need to see emptied fields to drop them
+    assert [r["sys_id"] for r in fetch(table, "2023-01-01 00:00:00", "")] == ["%032x" % 0, "%032x" % 1]
+
+def test_tables_without_sys_updated_on_are_paged_by_sys_id():
+    records = [record(n, "") for n in range(5)]
+    assert [r["sys_id"] for r in fetch(FakeTable(records))] == [r["sys_id"] for r in records]
+
+def test_deleted_records_are_only_listed_when_the_count_is_off():
+    table = FakeTable([record(0, "2024-01-01 10:00:00"), record(1, "2024-01-01 10:00:00")])
+    known = set(r["sys_id"] for r in table.records)
+    assert sync.deleted_records(table, "", "u_table", "script", known) == []
+    assert len(table.queries) == 1
+    del table.records[0]
+    table.records.append(record(2, "2024-01-01 10:00:00", ""))
+    assert sync.deleted_records(table, "", "u_table", "script", known) == ["%032x" % 0]
+
+def test_drop_record_removes_the_full_text_entry():
+    conn = sqlite3.connect(":memory:")
+    fts = sync.setup_mirror(conn, 1)
+    cur = conn.cursor()
+    sync.store_record(cur, fts, 1, "script", "u_table", "script", record(0, "2024-01-01 10:00:00", "var needle = 1;"))
+    assert cur.execute("SELECT count(*) FROM " + fts + " WHERE content MATCH 'needle';").fetchone()[0] == 1
+    assert sync.drop_record(cur, fts, 1, "u_table", "script", "%032x" % 0)
+    assert not sync.drop_record(cur, fts, 1, "u_table", "script", "%032x" % 0)
+    assert cur.execute("SELECT count(*) FROM " + fts + " WHERE content MATCH 'needle';").fetchone()[0] == 0
+    assert cur.execute("SELECT count(*) FROM mirror_record;").fetchone()[0] == 0
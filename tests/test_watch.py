@@ -0,0 +1,57 @@
+import json
+
+import requests
+
+from sparky.cmd_funcs import watch
+
+def test_delta_filters():
+    tables = ["unchanged", "changed", "new", "unreadable"]
+    marks = {"unchanged": ("2024-01-02 00:00:00", ["a"]), "changed": ("2024-01-01 00:00:00", ["a", "b"])}
+    latest = {"unchanged": ("2024-01-02 00:00:00", ["a"]), "changed": ("2024-01-03 00:00:00", ["c"]), "new": ("2024-01-04 00:00:00", ["d"])}
+    filters, unchanged = watch.delta_filters(tables, marks, latest)
+    assert unchanged == ["unchanged"]
+    assert filters == {
+        # the second of the mark is scanned again, without the records the previous run saw in it
+        "changed": "sys_updated_on>2024-01-01 00:00:00^ORsys_idNOT INa,b^sys_updated_on>=2024-01-01 00:00:00"
+            + "^sys_updated_on<2024-01-03 00:00:00^ORsys_idINc^sys_updated_on<=2024-01-03 00:00:00",
+        "new": "sys_updated_on<2024-01-04 00:00:00^ORsys_idINd^sys_updated_on<=2024-01-04 00:00:00",
+        "unreadable": "",
+    }
+
+def test_records_updated_in_the_second_of_the_mark_are_not_lost():
+    marks = {"u_table": ("2024-01-01 00:00:00", ["a"])}
+    filters, unchanged = watch.delta_filters(["u_table"], marks, {"u_table": ("2024-01-01 00:00:00", ["a", "b"])})
+    assert unchanged == []
+    assert filters["u_table"].startswith("sys_updated_on>2024-01-01 00:00:00^ORsys_idNOT INa^sys_updated_on>=2024-01-01 00:00:00^")
+
+def test_marks_without_sys_ids_fall_back_to_whole_seconds():
+    marks = {"u_table": ("2024-01-01 00:00:00", None)}
+    filters, unchanged = watch.delta_filters(["u_table"], marks, {"u_table": ("2024-01-01 00:00:00", ["a"])})
+    assert unchanged == ["u_table"]
+    filters, unchanged = watch.delta_filters(["u_table"], marks, {"u_table": ("2024-01-02 00:00:00", None)})
+    assert filters == {"u_table": "sys_updated_on>2024-01-01 00:00:00^sys_updated_on<=2024-01-02 00:00:00"}
+
+def test_a_table_that_lost_its_latest_update_is_scanned_whole():
+    filters, unchanged = watch.delta_filters(["emptied"], {"emptied": ("2024-01-01 00:00:00", ["a"])}, {})
+    assert filters == {"emptied": ""}
+    assert unchanged == []
+
+class FakeLatest:
+    def __init__(self, records: list):
+        self.records = records
+
+    def get(self, url, params=None, **kwargs):
+        resp = requests.Response()
+        resp.status_code = 200
+        rows = sorted(self.records, key=lambda r: r["sys_updated_on"], reverse=True)[:int(params["sysparm_limit"])]
+        resp._content = json.dumps({"result": rows}).encode()
+        return resp
+
+def test_latest_update_lists_the_records_of_its_second():
+    s = FakeLatest([{"sys_id": "a", "sys_updated_on": "2024-01-02 00:00:00"}, {"sys_id": "b", "sys_updated_on": "2024-01-02 00:00:00"},
+        {"sys_id": "c", "sys_updated_on": "2024-01-01 00:00:00"}])
+    assert watch.latest_update(s, "", "u_table") == ("2024-01-02 00:00:00", ["a", "b"])
+    s.records = [{"sys_id": str(n), "sys_updated_on": "2024-01-02 00:00:00"} for n in range(watch.SEEN_LIMIT + 1)]
+    assert watch.latest_update(s, "", "u_table") == ("2024-01-02 00:00:00", None)
+    s.records = []
+    assert watch.latest_update(s, "", "u_table") == None